@@ -15,9 +15,9 @@ Version: 2015jan28 by salvadordura@gmail.com
 
 from neuron import h
 import arminterface
-from numpy import array, zeros, pi, ones, cos, sin, mean
-from pylab import concatenate, figure, show, ion, ioff, pause,xlabel, ylabel, plot, Circle, sqrt, arctan, arctan2, close
+from numpy import array, zeros, pi, ones, cos, sin, mean, concatenate, sqrt, arctan, arctan2, in1d
 from copy import copy
+from time import time
 from random import uniform, seed, sample, randint
 
 
@@ -73,6 +73,7 @@ class Arm:
     #%% setupDummyArm
     def setupDummyArm(self):
         if self.anim:
+            from pylab import figure, ion, Circle # Only import matplotlib when plotting
             ion()
             self.fig = figure() # create figure
             l = 1.1*sum(self.armLen)
@@ -96,6 +97,7 @@ class Arm:
         shvel = self.angVel[SH] + (dataReceived[1]-dataReceived[0]) - (friction * self.angVel[SH])# update velocities based on incoming commands (accelerations) and friction
         elvel = self.angVel[EL] + (dataReceived[3]-dataReceived[2]) - (friction * self.angVel[EL])
         if self.anim:
+            from pylab import show, pause
             self.circle.center = self.targetPos
             self.line.set_data([0, elpos[0], handpos[0]], [0, elpos[1], handpos[1]]) # update line in figure
             self.ax.set_title('Time = %.1f ms, shoulder: pos=%.2f rad, vel=%.2f, acc=%.2f ; elbow: pos = %.2f rad, vel = %.2f, acc=%.2f' % (float(self.duration), shang, shvel, dataReceived[0] - (friction * shvel), elang, elvel, dataReceived[1] - (friction * elvel) ), fontsize=10)
@@ -116,19 +118,13 @@ class Arm:
             self.initArmMovement = self.initArmMovement + s.testTime
         
 
+    #%% Set the rate of the local PMd cells (every other one) according to the PMd inputs of the current target; only the cells that changed are written
     def setPMdInput(self, s):
-        for c in range(0, s.popnumbers[s.PMd], 2):
-            try: 
-                gid = s.popGidStart[s.PMd] + c # find gid of PMd 
-                lid = s.gidDic[gid] # find local index corresponding to gid
-                if (gid in s.targetPMdInputs[s.targetid]):  # if gid in PMdinputs for this target
-                    #print "yes:",gid
-                    s.cells[lid].interval=1000/s.maxPMdRate # set low interval (in ms as a function of rate)
-                else: # if angle not in range -> low firing rate
-                    s.cells[lid].interval=1000/s.minPMdRate # set high interval (in ms as a function of rate)
-                    #print "no:",gid
-            except:
-                pass # local index corresponding to gid not found in this node
+        active = in1d(self.PMdLocalGids, s.targetPMdInputs[s.targetid]) # if gid in PMdinputs for this target
+        for i in (active != self.PMdActive).nonzero()[0]:
+            if active[i]: self.PMdLocalCells[i].interval=1000/s.maxPMdRate # set low interval (in ms as a function of rate)
+            else: self.PMdLocalCells[i].interval=1000/s.minPMdRate # set high interval (in ms as a function of rate)
+        self.PMdActive = active
 
     #%% plot motor commands
     def RLcritic(self, t):
@@ -152,6 +148,7 @@ class Arm:
 
     #%% plot joint angles
     def plotTraj(self, filename):
+        from pylab import figure, xlabel, ylabel, Circle # Only import matplotlib when plotting
         fig = figure() 
         l = 1.1*sum(self.armLen)
         ax = fig.add_subplot(111, autoscale_on=False, xlim=(-l/2, +l), ylim=(-l/2, +l)) # create subplot
@@ -168,6 +165,7 @@ class Arm:
 
     #%% plot joint angles
     def plotAngs(self):
+        from pylab import figure, xlabel, ylabel # Only import matplotlib when plotting
         fig = figure() 
         ax = fig.add_subplot(111) # create subplot
         sh = [x[SH] for x in self.angAll]
@@ -185,6 +183,7 @@ class Arm:
 
     #%% plot motor commands
     def plotMotorCmds(self):
+        from pylab import figure, xlabel, ylabel # Only import matplotlib when plotting
         fig = figure() 
         ax = fig.add_subplot(111) # create subplot
         shext = [x[SH_EXT] for x in self.motorCmdAll]
@@ -202,6 +201,7 @@ class Arm:
 
     #%% plot RL critic signal and error
     def plotRL(self):
+        from pylab import figure, xlabel, ylabel # Only import matplotlib when plotting
         fig = figure() 
         ax = fig.add_subplot(111) # create subplot
         ax.plot(self.errorAll, 'r', label='error')
@@ -240,13 +240,28 @@ class Arm:
         self.critic = 0 # critic signal (1=reward; -1=punishment)
         self.criticAll = [] # list with all critic
         self.randDur = 0 # initialize explor movs duration
+        self.randMus = 0 # muscle group of the current explor mov
         self.initArmMovement = int(s.initArmMovement) # start arm movement after x msec
         self.trial = 0 # trial number
 
         # motor command encoding
         self.vec = h.Vector()
+        self.commTime = 0 # time spent in control loop collectives (allreduce of motor commands + broadcast of arm state) (s)
+        self.commSteps = 0 # number of steps with collectives
+        self.armHost = s.armhost and s.nhosts > 1 # whether worker0 is reserved for the arm and critic (no cells)
+        self.hostCritic = 0 # critic calculated by the arm host, sent to the workers at the next step
+        self.armLocal = s.colocatearm # whether the motor command and proprioceptive cells are all on worker0
+        self.armDelay = s.armDelay # steps by which the musculoskeletal arm feedback is delayed (0 = wait for the arm every step)
+        self.armWaitTime = 0 # time spent waiting for the musculoskeletal arm (s)
+        self.armSteps = 0 # number of steps exchanging data with the musculoskeletal arm
+        self.armReadySteps = 0 # number of those steps in which its reply was ready without waiting
+        self.armPending = 0 # number of motor commands sent to the musculoskeletal arm whose reply has not been read
+        self.armTime = 0 # time of the last motor command sent to the musculoskeletal arm
         self.cmdmaxrate = s.cmdmaxrate # maximum spikes for motor command (normalizing value)
         self.cmdtimewin = s.cmdtimewin # spike time window for shoulder motor command (ms)
+        self.cmdLocalIds = [[s.gidDic[gid] for gid in s.motorCmdCellRange[i] if gid in s.gidDic] for i in range(s.nMuscles)] # local ids of the cells of each muscle on this node
+        self.cmdSpikesRead = [[0]*len(ids) for ids in self.cmdLocalIds] # number of spikes of each of those cells already added to the window
+        self.cmdWinSpikes = [array([]) for i in range(s.nMuscles)] # spike times of each muscle within the motor command time window
 
 
         # proprioceptive encoding
@@ -265,6 +280,11 @@ class Arm:
             self.prange[c+1,0] = currentPval # elbow lower range
             self.prange[c+1,1] = currentPval + angInterval # elbow higher range
             currentPval += angInterval
+        pLocal = [c for c in range(self.numPcells) if self.pStart + c in s.gidDic] # P cells on this node
+        self.pLocalCells = [s.cells[s.gidDic[self.pStart + c]] for c in pLocal] # their NSLOCs
+        self.pLocalJoints = array([c % 2 for c in pLocal], dtype='int') # joint encoded by each one (SH or EL)
+        self.pLocalRange = self.prange[pLocal,:].reshape(-1,2) # and its range
+        self.pLocalHigh = -ones(len(pLocal)) # whether each one fires at the high rate (-1 = not set yet)
 
 
         # initialize dummy or musculoskeletal arm 
@@ -282,11 +302,277 @@ class Arm:
         
         # set PMd inputs
         if s.PMdinput == 'targetSplit': 
+            self.PMdLocalGids = array([gid for gid in range(s.popGidStart[s.PMd], s.popGidStart[s.PMd] + s.popnumbers[s.PMd], 2) if gid in s.gidDic], dtype='int') # PMd cells set by setPMdInput() on this node
+            self.PMdLocalCells = [s.cells[s.gidDic[gid]] for gid in self.PMdLocalGids]
+            self.PMdActive = -ones(len(self.PMdLocalGids)) # whether each one fires at the high rate (-1 = not set yet)
             self.setPMdInput(s) # set PMd inputs
 
+        # exploratory movements
+        if s.explorMovs and (self.type == 'dummyArm' or self.type == 'musculoskeletal'):
+            self.setupExplorSources(s) # local background sources of each muscle group / EB5 cell
+            self.setupExplorSchedule(s) # explor movs of the whole run
+        else:
+            self.explorSchedule = []
+            self.explorNext = 0
+
     ################################          
     ### RUN     
     ################################
+    #%% reduceMotorCmd: sum the motor commands of all nodes with a single allreduce
+    def reduceMotorCmd(self, s):
+        commStart = time()
+        s.pc.allreduce(self.vec.from_python(self.motorCmd), 1) # sum
+        self.motorCmd = self.vec.to_python()
+        self.commTime += time() - commStart
+
+    #%% broadcastState: send the arm state, critic signal and trial/target from worker0 to all workers with a single broadcast; returns the critic
+    def broadcastState(self, s, critic):
+        commStart = time()
+        if s.rank == 0:
+            state = list(self.ang) + list(self.angVel) + list(self.handPos) + [critic, self.trial, s.targetid]
+            s.pc.broadcast(self.vec.from_python(state), 0)
+        else:
+            s.pc.broadcast(self.vec, 0)
+            state = self.vec.to_python()
+            self.ang = state[0:2]
+            self.angVel = state[2:4]
+            self.handPos = state[4:6]
+            critic = state[6]
+            self.trial = int(state[7])
+            s.targetid = int(state[8])
+        self.commTime += time() - commStart
+        self.commSteps += 1
+        return critic
+
+    #%% normalizeMotorCmd: normalize the summed motor command and apply antagonist inhibition (only worker0)
+    def normalizeMotorCmd(self, s):
+        self.motorCmd = [x / self.cmdmaxrate for x in self.motorCmd]  # normalize motor command 
+        if s.antagInh: # antagonist inhibition
+            if self.motorCmd[SH_EXT] > self.motorCmd[SH_FLEX]: # sh ext > sh flex
+                self.motorCmd[SH_FLEX] =  self.motorCmd[SH_FLEX]**2 / self.motorCmd[SH_EXT] / s.antagInh
+            elif self.motorCmd[SH_EXT] < self.motorCmd[SH_FLEX]: # sh flex > sh ext
+                self.motorCmd[SH_EXT] = self.motorCmd[SH_EXT]**2 / self.motorCmd[SH_FLEX] / s.antagInh
+            if self.motorCmd[EL_EXT] > self.motorCmd[EL_FLEX]: # el ext > el flex
+                self.motorCmd[EL_FLEX] = self.motorCmd[EL_FLEX]**2 / self.motorCmd[EL_EXT] / s.antagInh
+            elif self.motorCmd[EL_EXT] < self.motorCmd[EL_FLEX]: # el ext > el flex
+                self.motorCmd[EL_EXT] = self.motorCmd[EL_EXT]**2 / self.motorCmd[EL_FLEX] / s.antagInh
+
+    #%% moveArm: send the motor command to the virtual arm, receive the new position and calculate the error (only worker0)
+    def moveArm(self, t, s):
+        if self.type == 'musculoskeletal': # MUSCULOSKELETAL
+            try:
+                dataReceived = self.exchangeArmData(t)
+            except:
+                dataReceived = [self.ang[SH], self.ang[EL]]
+            if not dataReceived or dataReceived==[-3,-3]:  # if error receiving packet
+                dataReceived = [self.ang[SH], self.ang[EL]]  # use previous packet
+                print 'Missed packet at t=%.2f',t
+        elif self.type == 'dummyArm': # DUMMYARM
+            dataReceived = self.runDummyArm(self.motorCmd) # run dummyArm
+        elif self.type == 'randomOutput': # RANDOMOUTPUT
+            dataReceived = [0,0] 
+            dataReceived[0] = uniform(self.minPval, self.maxPval) # generate 2 random values  
+            dataReceived[1] = uniform(self.minPval, self.maxPval)  
+        if self.type == 'musculoskeletal':
+            [self.ang[SH], self.ang[EL]] = dataReceived
+            self.handPos = self.angles2pos(self.ang, self.armLen) 
+            self.angVel[SH] = self.angVel[EL] = 0 
+        else:
+            [self.ang[SH], self.ang[EL], self.angVel[SH], self.angVel[EL], self.handPos[SH], self.handPos[EL]] = dataReceived # map data received to shoulder and elbow angles
+
+        #### Calculate error between hand and target for interval between RL updates 
+        if self.initArmMovement: # do not update between trials
+            self.error = sqrt((self.handPos[X] - self.targetPos[X])**2 + (self.handPos[Y] - self.targetPos[Y])**2)
+
+    #%% updateProprio: update the proprio pop ASC (only the local P cells that switched between high and low rate)
+    def updateProprio(self):
+        angs = array(self.ang)[self.pLocalJoints] # angle encoded by each local P cell
+        high = (angs >= self.pLocalRange[:,0]) & (angs < self.pLocalRange[:,1]) # in angle in range -> high firing rate
+        for i in (high != self.pLocalHigh).nonzero()[0]:
+            if high[i]: self.pLocalCells[i].interval=1000/self.maxPrate # interval in ms as a function of rate
+            else: self.pLocalCells[i].interval=1000/self.minPrate # if angle not in range -> low firing rate
+        self.pLocalHigh = high
+
+    #%% runArmHost: step with a dedicated arm host (worker0, without cells). A single allreduce sums the spike counts of the workers and carries the arm state and critic
+    # that worker0 calculated after the previous exchange; worker0 then moves the arm while the workers already simulate the next step, so they see the arm one step later
+    def runArmHost(self, t, s):
+        commStart = time()
+        if s.rank == 0: state = list(self.ang) + list(self.angVel) + list(self.handPos) + [self.hostCritic]
+        else: state = [0]*7
+        counts = [0]*s.nMuscles
+        if self.type == 'dummyArm' or self.type == 'musculoskeletal':
+            self.updateCmdSpikes(t, s) # no motor command cells on worker0
+            if t > self.initArmMovement: counts = [int((self.cmdWinSpikes[i] < t).sum()) for i in range(s.nMuscles)] # spikes within (t-cmdtimewin, t)
+        s.pc.allreduce(self.vec.from_python(counts + state), 1) # sum
+        data = self.vec.to_python()
+        self.commTime += time() - commStart
+        self.commSteps += 1
+
+        if s.rank == 0: # move the arm and calculate the critic, both sent at the next step
+            if t > self.initArmMovement and (self.type == 'dummyArm' or self.type == 'musculoskeletal'):
+                self.motorCmd = data[:s.nMuscles]
+                self.normalizeMotorCmd(s)
+            self.moveArm(t, s)
+            self.hostCritic = 0
+            if s.useRL and (t - s.timeoflastRL >= s.RLinterval): # if time for next RL
+                s.timeoflastRL = t
+                self.hostCritic = self.RLcritic(t) # get critic signal (-1, 0 or 1)
+            return 0 # no STDP mechanisms on worker0
+        else:
+            state = data[s.nMuscles:]
+            self.ang = state[0:2]
+            self.angVel = state[2:4]
+            self.handPos = state[4:6]
+            self.updateProprio() # update proprio pop ASC
+            if s.useRL and (t - s.timeoflastRL >= s.RLinterval): s.timeoflastRL = t # keep in step with worker0
+            return state[6] # critic of the previous step
+
+    #%% runArmLocal: step with the spinal cord and proprioceptive cells on worker0, so the motor command and ASC rates are calculated there; the critic is broadcast at RL updates
+    def runArmLocal(self, t, s):
+        if self.type == 'dummyArm' or self.type == 'musculoskeletal':
+            self.updateCmdSpikes(t, s) # every step, so each update only handles the spikes since the last one
+            if t > self.initArmMovement and s.rank == 0:
+                self.motorCmd = [float((self.cmdWinSpikes[i] < t).sum()) for i in range(s.nMuscles)] # spikes within (t-cmdtimewin, t)
+                self.normalizeMotorCmd(s)
+        if s.rank == 0: self.moveArm(t, s)
+
+        critic = 0
+        if s.useRL and (t - s.timeoflastRL >= s.RLinterval): # if time for next RL
+            s.timeoflastRL = t
+            if s.rank == 0: critic = self.RLcritic(t) # get critic signal (-1, 0 or 1)
+            commStart = time()
+            s.pc.broadcast(self.vec.from_python([critic]), 0)
+            critic = self.vec[0]
+            self.commTime += time() - commStart
+            self.commSteps += 1
+
+        self.updateProprio() # update proprio pop ASC (only worker0 has P cells)
+        return critic
+
+    #%% reportComm: print the mean time per step spent in control loop collectives (max over nodes, and mean over the nodes other than worker0), and waiting for the musculoskeletal arm
+    def reportComm(self, s):
+        commTime = self.commTime / max(self.commSteps,1)
+        s.pc.allreduce(self.vec.from_python([commTime]), 2) # max
+        maxTime = self.vec[0]
+        s.pc.allreduce(self.vec.from_python([commTime if s.rank > 0 else 0]), 1) # sum
+        if s.rank == 0: print('  Control loop collectives: %0.3f ms per step (max over %i nodes, %i steps); %0.3f ms mean over workers 1-%i (%s)' % (maxTime*1e3, s.nhosts, self.commSteps, self.vec[0]/max(s.nhosts-1,1)*1e3, s.nhosts-1, 'motor and proprioceptive cells on worker0' if self.armLocal else 'worker0 reserved for the arm' if self.armHost else 'worker0 also simulates cells'))
+        if s.rank == 0 and self.type == 'musculoskeletal': print('  Musculoskeletal arm: waited %0.3f ms per step (feedback delay %i steps; reply ready without waiting in %0.0f%% of steps)' % (self.armWaitTime / max(self.armSteps,1) * 1e3, self.armDelay, 100.0 * self.armReadySteps / max(self.armSteps,1)))
+
+    #%% exchangeArmData: send the motor command to the musculoskeletal arm and receive joint angles; with armDelay > 0 the reply is the one to the command of armDelay steps before, computed by the arm while the network ran
+    def exchangeArmData(self, t):
+        waitStart = time()
+        if self.armDelay == 0:
+            dataReceived = arminterface.sendAndReceiveDataPackets(t, self.interval, self.motorCmd[0], self.motorCmd[1], self.motorCmd[2], self.motorCmd[3])
+            self.armSteps += 1
+        else:
+            if not arminterface.sendDataPackets(t, self.interval, self.motorCmd[0], self.motorCmd[1], self.motorCmd[2], self.motorCmd[3]):
+                self.armWaitTime += time() - waitStart
+                return [-3]*2 # error code: no reply will come for this step, so nothing is added to the pending replies
+            self.armPending += 1
+            self.armTime = t
+            if self.armPending <= self.armDelay: # no feedback yet
+                dataReceived = [self.ang[SH], self.ang[EL]]
+            else:
+                if arminterface.dataReady(): self.armReadySteps += 1 # the arm's time was hidden behind the network step
+                dataReceived = arminterface.receiveDataPackets(t, self.interval)
+                self.armPending -= 1
+                self.armSteps += 1
+        self.armWaitTime += time() - waitStart
+        return dataReceived
+
+    #%% drainArmData: read the replies of the musculoskeletal arm still pending at the end of a run (armDelay > 0), at the times the next steps would have read them
+    def drainArmData(self):
+        for i in range(self.armPending):
+            arminterface.receiveDataPackets(self.armTime + (i+1)*self.interval, self.interval)
+        self.armPending = 0
+
+    #%% updateCmdSpikes: add the spikes recorded since the last step to the window of each muscle, and drop those older than cmdtimewin
+    def updateCmdSpikes(self, t, s):
+        for i in range(s.nMuscles):
+            spikes = [self.cmdWinSpikes[i]]
+            for j,c in enumerate(self.cmdLocalIds[i]):
+                nspikes = int(s.hostspikevecs[c].size())
+                if nspikes > self.cmdSpikesRead[i][j]: # only copy the new spikes of this cell
+                    spikes.append(array(s.hostspikevecs[c].c(self.cmdSpikesRead[i][j], nspikes-1)))
+                    self.cmdSpikesRead[i][j] = nspikes
+            spikes = concatenate(spikes)
+            self.cmdWinSpikes[i] = spikes[spikes > t-self.cmdtimewin]
+
+    #%% setupExplorSources: index the local background sources changed by exploratory movements
+    def setupExplorSources(self, s):
+        self.targetCells = range(s.popGidStart[s.EB5], s.popGidEnd[s.EB5]+1) # EB5 cell gids
+        cmdMuscle = dict((gid, imus) for imus in range(s.nMuscles) for gid in s.motorCmdCellRange[imus]) # muscle group of each motor command cell
+        IDSCoffset = int(s.popGidStart[s.IDSC]) - int(s.popGidStart[s.EDSC]) # gid of the IDSC cell paired with each EDSC cell
+        self.explorCmdSources = [[] for imus in range(s.nMuscles)] # sources of the motor command cells of each muscle group
+        self.explorIDSCSources = [[] for imus in range(s.nMuscles)] # sources of the IDSC cells paired with them
+        self.explorOtherIDSCSources = [] # sources of the IDSC cells not paired with any motor command cell
+        self.explorEB5Sources = [] # (gid, source) of the EB5 cells
+        for gid, x in zip(s.backgroundgid, s.backgroundsources):
+            if gid in cmdMuscle: self.explorCmdSources[cmdMuscle[gid]].append(x)
+            elif s.cellpops[gid] == s.IDSC:
+                if gid-IDSCoffset in cmdMuscle: self.explorIDSCSources[cmdMuscle[gid-IDSCoffset]].append(x)
+                else: self.explorOtherIDSCSources.append(x)
+            if s.cellpops[gid] == s.EB5: self.explorEB5Sources.append((gid, x))
+
+    #%% setupExplorSchedule: precompute the exploratory movements of the whole run (same update times and random draws as updating them in run())
+    def setupExplorSchedule(self, s):
+        self.explorSchedule = [] # (time, muscle group, multiplier, duration, EB5 cells) of each explor mov
+        self.explorNext = 0 # index of the next explor mov to apply
+        t, timeoflastexplor, randDur = 0, s.timeoflastexplor, self.randDur
+        while round(t) < s.duration: # times at which runSim calls run()
+            t = min(s.duration, t+s.loopstep)
+            if t-timeoflastexplor >= randDur: # if time to update exploratory movement
+                seed(s.id32('%d'%(int(t)+s.randseed))) # init seed
+                randMus = int(uniform(0,s.nMuscles)) # select random muscle group
+                randMul = uniform(s.explorMovsFactor/5,s.explorMovsFactor) # select random multiplier
+                randDur = uniform(s.explorMovsDur/5, s.explorMovsDur) # select random duration
+                randCells = []
+                if s.explorMovs == 2:
+                    randNumCells = randint(1, int(s.explorCellsFraction*len(self.targetCells))) # num of cells to stimumales
+                    randCells = sample(self.targetCells, int(randNumCells)) # select random gids
+                timeoflastexplor = t
+                self.explorSchedule.append((t, randMus, randMul, randDur, randCells))
+
+    #%% applyExplorMov: set the rates of the background sources for the latest scheduled exploratory movement
+    def applyExplorMov(self, t, s):
+        while self.explorNext < len(self.explorSchedule) and self.explorSchedule[self.explorNext][0] <= t: self.explorNext += 1
+        _, self.randMus, self.randMul, self.randDur, self.randCells = self.explorSchedule[self.explorNext-1]
+        self.randNumCells = len(self.randCells)
+        if s.explorMovs == 1: # add random noise to EDSC+IDSC population
+            for x in self.explorCmdSources[self.randMus] + self.explorIDSCSources[self.randMus]: # chosen muscle cells
+                x.interval = (self.randMul*s.backgroundrateExplor)**-1*1e3  # increase firing
+            if s.nMuscles > 1:
+                for x in [x for imus in range(s.nMuscles) if imus != self.randMus for x in self.explorCmdSources[imus] + self.explorIDSCSources[imus]] + self.explorOtherIDSCSources:
+                    x.interval = s.backgroundrateMin**-1*1e3 # otherwise set to minimum
+            #if s.rank==0: print 'exploratory movement, randMus',self.randMus,' strength:',self.randMul,' duration:', self.randDur
+        elif s.explorMovs == 2: # add random noise to EB5 population
+            randCells = set(self.randCells)
+            for gid, x in self.explorEB5Sources:
+                if gid in randCells: x.interval = s.backgroundrateExplor**-1*1e3  # increase input
+                else: x.interval = s.backgroundrateMin**-1*1e3  # set to normal level
+            #print 'Nodes:', s.rank,' - exploratory movement, numcells:',self.randNumCells,' strength:',self.randMul,' duration:', self.randDur, 'cells:', self.randCells
+
+    #%% getState: state of the arm, trials and motor command window, for checkpoints
+    def getState(self):
+        return dict((var, copy(getattr(self, var))) for var in ['ang', 'angVel', 'handPos', 'motorCmd', 'error', 'critic', 'hostCritic', 'errorAll', 'trial', 'initArmMovement', 'targetid', 'targetPos', 'explorNext', 'cmdWinSpikes'])
+
+    #%% setState: restore the state saved by getState() at time t, and set the ASC, PMd and exploratory movement inputs accordingly
+    def setState(self, state, t, s):
+        for var in state: setattr(self, var, state[var])
+        self.updateProprio() # all local P cells, since pLocalHigh is not set yet
+        if s.PMdinput == 'targetSplit': self.setPMdInput(s)
+        if self.explorNext > 0: self.applyExplorMov(t, s) # exploratory movement in progress
+
+    #%% resetExplorMovs: remove the noise added by exploratory movements
+    def resetExplorMovs(self, s):
+        if s.explorMovs == 1: # remove explor movs related noise to cells
+            for x in [x for imus in range(s.nMuscles) for x in self.explorCmdSources[imus]] + self.explorIDSCSources[self.randMus]:
+                x.interval = 0.0001**-1*1e3
+                x.noise = s.backgroundnoise # Fractional noise in timing
+        elif s.explorMovs == 2: # remove explor movs related noise to cells
+            for gid, x in self.explorEB5Sources:  # for all input background netstims of EB5 cells
+                x.interval = s.backgroundrate**-1*1e3  # set to normal level
+
     def run(self, t, s): #pc, cells, gidVec, gidDic, cellsperhost=[], hostspikevecs=[]): 
 
         # Append to list the the value of relevant variables for this time step (only worker0)
@@ -305,39 +591,10 @@ class Arm:
         ############################
         if self.type == 'dummyArm' or self.type == 'musculoskeletal': 
             ## Exploratory movements
-            if s.explorMovs and t-s.timeoflastexplor >= self.randDur: # if time to update exploratory movement
-                seed(s.id32('%d'%(int(t)+s.randseed))) # init seed
-                self.randMus = int(uniform(0,s.nMuscles)) # select random muscle group
-                self.randMul = uniform(s.explorMovsFactor/5,s.explorMovsFactor) # select random multiplier
-                self.randDur = uniform(s.explorMovsDur/5, s.explorMovsDur) # select random duration
+            if self.explorNext < len(self.explorSchedule) and t >= self.explorSchedule[self.explorNext][0]: # if time to update exploratory movement
+                self.applyExplorMov(t, s) # precomputed in setup
                 s.timeoflastexplor = t
 
-                if s.explorMovs == 1: # add random noise to EDSC+IDSC population
-                    IDSCgids = array(s.motorCmdCellRange[self.randMus]) - int(s.popGidStart[s.EDSC]) + int(s.popGidStart[s.IDSC]) 
-                    IDSCgidsInverse = [j for j in range(s.popGidStart[s.IDSC],s.popGidEnd[s.IDSC]+1) if j not in list(IDSCgids)]
-                    for (i,x) in enumerate(s.backgroundsources): # for all background input netstims
-                        if s.backgroundgid[i] in s.motorCmdCellRange[self.randMus] or s.backgroundgid[i] in list(IDSCgids): # if connected to chosen muscle cells
-                            #print s.backgroundgid[i]
-                            x.interval = (self.randMul*s.backgroundrateExplor)**-1*1e3  # increase firing
-                        elif s.backgroundgid[i] in [y for z in range(s.nMuscles) if z != self.randMus for y in s.motorCmdCellRange[z]+IDSCgidsInverse]:
-                            x.interval = s.backgroundrateMin**-1*1e3 # otherwise set to minimum
-                    #if s.rank==0: print 'exploratory movement, randMus',self.randMus,' strength:',self.randMul,' duration:', self.randDur
-                    #print 'IDSC cells:', IDSCgids   
-                    #print 'IDSC inverse cells:', IDSCgidsInverse
-
-                
-                elif s.explorMovs == 2: # add random noise to EB5 population
-                    self.targetCells = range(s.popGidStart[s.EB5], s.popGidEnd[s.EB5]+1) # EB5 cell gids
-                    self.randNumCells = randint(1, int(s.explorCellsFraction*len(self.targetCells))) # num of cells to stimumales
-                    self.randCells = sample(self.targetCells, int(self.randNumCells)) # select random gids
-                    for (i,x) in enumerate(s.backgroundsources):  # for all input background netstims
-                        if s.backgroundgid[i] in self.randCells:  # if connectd to selected random cells
-                            x.interval = s.backgroundrateExplor**-1*1e3  # increase input
-                        elif s.backgroundgid[i] in [y for y in self.targetCells if y not in self.randCells]:  # for the rest of cells
-                            x.interval = s.backgroundrateMin**-1*1e3  # set to normal level
-                    #if s.rank==0: 
-                    #print 'Nodes:', s.rank,' - exploratory movement, numcells:',self.randNumCells,' strength:',self.randMul,' duration:', self.randDur, 'cells:', self.randCells    
-
 
             ## Reset arm and set target after every trial -start from center etc
             if s.trialReset and t-s.timeoflastreset > s.testTime: 
@@ -347,92 +604,46 @@ class Arm:
                 if s.PMdinput == 'targetSplit': self.setPMdInput(s)
 
 
+        ## Spinal cord and proprioceptive cells on worker0: only the critic is communicated
+        if self.armLocal: return self.runArmLocal(t, s)
+
+        ## Dedicated arm host: the motor command and the arm state travel in one collective
+        if self.armHost: return self.runArmHost(t, s)
+
+        if self.type == 'dummyArm' or self.type == 'musculoskeletal': 
             ## Only move after initial period - avoids initial transitory spiking period (NSLOC sync spikes), and allows for variables with history to clear
             # can be justified as preparatory period (eg. watiing for go cue)
+            self.updateCmdSpikes(t, s) # every step, so each update only handles the spikes since the last one
             if t > self.initArmMovement:
                 ## Gather spikes #### from all vectors to then calculate motor command 
                 for i in range(s.nMuscles):
-                    cmdVecs = [array(s.hostspikevecs[x]) for x in range(s.cellsperhost) if (s.gidVec[x] in s.motorCmdCellRange[i])]
-                    self.motorCmd[i] = sum([len(x[(x < t) * (x > t-self.cmdtimewin)]) for x in cmdVecs])
-                    s.pc.allreduce(self.vec.from_python([self.motorCmd[i]]), 1) # sum
-                    self.motorCmd[i] = self.vec.to_python()[0]       
+                    self.motorCmd[i] = int((self.cmdWinSpikes[i] < t).sum()) # spikes within (t-cmdtimewin, t)
+                self.reduceMotorCmd(s) # sum over nodes
             # else:
             #     for i in range(s.nMuscles): # stimulate all muscles equivalently so arm doesnt move
             #         self.motorCmd[i] = 0.2 * self.cmdmaxrate
 
                 ## Calculate final motor command 
-                if s.rank==0:  
-                    self.motorCmd = [x / self.cmdmaxrate for x in self.motorCmd]  # normalize motor command 
-                    if s.antagInh: # antagonist inhibition
-                        if self.motorCmd[SH_EXT] > self.motorCmd[SH_FLEX]: # sh ext > sh flex
-                            self.motorCmd[SH_FLEX] =  self.motorCmd[SH_FLEX]**2 / self.motorCmd[SH_EXT] / s.antagInh
-                        elif self.motorCmd[SH_EXT] < self.motorCmd[SH_FLEX]: # sh flex > sh ext
-                            self.motorCmd[SH_EXT] = self.motorCmd[SH_EXT]**2 / self.motorCmd[SH_FLEX] / s.antagInh
-                        if self.motorCmd[EL_EXT] > self.motorCmd[EL_FLEX]: # el ext > el flex
-                            self.motorCmd[EL_FLEX] = self.motorCmd[EL_FLEX]**2 / self.motorCmd[EL_EXT] / s.antagInh
-                        elif self.motorCmd[EL_EXT] < self.motorCmd[EL_FLEX]: # el ext > el flex
-                            self.motorCmd[EL_EXT] = self.motorCmd[EL_EXT]**2 / self.motorCmd[EL_FLEX] / s.antagInh
+                if s.rank==0: self.normalizeMotorCmd(s)
              
 
         ############################
         # ALL arms: Send motor command to virtual arm; receive new position; update proprioceptive population (ASC)
         ############################
         # Worker 0 sends motor commands and receives data from virtual arm
-        #print "t=%f , self.initArmMovement=%f"%(t, self.initArmMovement)
-        if s.rank == 0:
-            if self.type == 'musculoskeletal': # MUSCULOSKELETAL
-                try:
-                    dataReceived = arminterface.sendAndReceiveDataPackets(t, self.interval, self.motorCmd[0], self.motorCmd[1], self.motorCmd[2], self.motorCmd[3])
-                except:
-                    dataReceived = [self.ang[SH], self.ang[EL]]
-                if not dataReceived or dataReceived==[-3,3]:  # if error receiving packet
-                    dataReceived = [self.ang[SH], self.ang[EL]]  # use previous packet
-                    print 'Missed packet at t=%.2f',t
-            elif self.type == 'dummyArm': # DUMMYARM
-                dataReceived = self.runDummyArm(self.motorCmd) # run dummyArm
-            elif self.type == 'randomOutput': # RANDOMOUTPUT
-                dataReceived = [0,0] 
-                dataReceived[0] = uniform(self.minPval, self.maxPval) # generate 2 random values  
-                dataReceived[1] = uniform(self.minPval, self.maxPval)  
-            # broadcast dataReceived  to other workers.   
-            n = s.pc.broadcast(self.vec.from_python(dataReceived), 0) # convert python list to hoc vector for broadcast data received from arm
-        else: # other workers
-            n = s.pc.broadcast(self.vec, 0)  # receive shoulder and elbow angles from worker0 so can compare with cells in this worker
-            dataReceived = self.vec.to_python()  
-        if self.type == 'musculoskeletal':
-            [self.ang[SH], self.ang[EL]] = dataReceived
-            self.handPos = self.angles2pos(self.ang, self.armLen) 
-            self.angVel[SH] = self.angVel[EL] = 0 
-        else:
-            [self.ang[SH], self.ang[EL], self.angVel[SH], self.angVel[EL], self.handPos[SH], self.handPos[EL]] = dataReceived # map data received to shoulder and elbow angles
-        #[self.ang[SH], self.ang[EL], self.angVel[SH], self.angVel[EL]] = dataReceived # map data received to shoulder and elbow angles      
-        
-        #### Update proprio pop ASC
-        for c in range(0, self.numPcells, 2):
-            try: 
-                id = s.gidDic[self.pStart + c] # find local index corresponding to gid
-                if (self.ang[SH] >= self.prange[c,0] and self.ang[SH] < self.prange[c,1]):  # in angle in range -> high firing rate
-                    s.cells[id].interval=1000/self.maxPrate # interval in ms as a function of rate
-                else: # if angle not in range -> low firing rate
-                    s.cells[id].interval=1000/self.minPrate # interval in ms as a function of rate
-            except:
-                pass # local index corresponding to gid not found in this node
-            try: 
-                id = s.gidDic[self.pStart + c + 1] # find local index corresponding to gid
-                if (self.ang[EL] >= self.prange[c+1,0] and self.ang[EL] < self.prange[c+1,1]):  # in angle in range -> high firing rate
-                    s.cells[id].interval=1000/self.maxPrate # interval in ms as a function of rate
-                else: # if angle not in range -> low firing rate
-                    s.cells[id].interval=1000/self.minPrate # interval in ms as a function of rate 
-            except:
-                pass # local index corresponding to gid not found in this node
+        if s.rank == 0: self.moveArm(t, s)
 
+        # RL critic signal (calculated by worker0)
+        critic = 0
+        if s.useRL and (t - s.timeoflastRL >= s.RLinterval): # if time for next RL
+            s.timeoflastRL = t
+            if s.rank == 0: critic = self.RLcritic(t) # get critic signal (-1, 0 or 1)
 
-        #### Calculate error between hand and target for interval between RL updates 
-        if s.rank == 0 and self.initArmMovement: # do not update between trials
-            #print 't=%.2f, xpos=%.2f'%(t,self.targetPos[X])
-            self.error = sqrt((self.handPos[X] - self.targetPos[X])**2 + (self.handPos[Y] - self.targetPos[Y])**2)
-            
-        return self.critic
+        # broadcast arm state (data received from arm), critic and target to other workers so can compare with cells in this worker
+        critic = self.broadcastState(s, critic)
+        
+        self.updateProprio() # update proprio pop ASC
+        return critic
 
 
     ################################
@@ -443,17 +654,7 @@ class Arm:
             print('\nClosing random output virtual arm...')
 
         if self.type == 'dummyArm':
-            if s.explorMovs == 1: # remove explor movs related noise to cells
-                for imus in range(s.nMuscles):
-                    IDSCgids = array(s.motorCmdCellRange[self.randMus]) - int(s.popGidStart[s.EDSC]) + int(s.popGidStart[s.IDSC]) 
-                    for (i,x) in enumerate(s.backgroundsources):
-                        if s.backgroundgid[i] in s.motorCmdCellRange[imus]+list(IDSCgids):
-                            x.interval = 0.0001**-1*1e3
-                            x.noise = s.backgroundnoise # Fractional noise in timing
-            elif s.explorMovs == 2: # remove explor movs related noise to cells
-                for (i,x) in enumerate(s.backgroundsources):  # for all input background netstims
-                    if s.backgroundgid[i] in self.targetCells:  # for the rest of cells
-                        x.interval = s.backgroundrate**-1*1e3  # set to normal level
+            if s.explorMovs: self.resetExplorMovs(s) # remove explor movs related noise to cells
 
             if s.trialReset:
                 s.timeoflastreset = 0
@@ -463,6 +664,7 @@ class Arm:
                 print('\nClosing dummy virtual arm ...') 
 
                 if self.anim:
+                    from pylab import ioff, close
                     ioff() # turn interactive mode off
                     close(self.fig) # close arm animation graph 
                 if self.graphs: # plot graphs
@@ -472,17 +674,7 @@ class Arm:
                     #self.plotRL()
         
         if self.type == 'musculoskeletal':
-            if s.explorMovs == 1: # remove explor movs related noise to cells
-                for imus in range(s.nMuscles):
-                    IDSCgids = array(s.motorCmdCellRange[self.randMus]) - int(s.popGidStart[s.EDSC]) + int(s.popGidStart[s.IDSC]) 
-                    for (i,x) in enumerate(s.backgroundsources):
-                        if s.backgroundgid[i] in s.motorCmdCellRange[imus]+list(IDSCgids):
-                            x.interval = 0.0001**-1*1e3
-                            x.noise = s.backgroundnoise # Fractional noise in timing
-            elif s.explorMovs == 2: # remove explor movs related noise to cells
-                for (i,x) in enumerate(s.backgroundsources):  # for all input background netstims
-                    if s.backgroundgid[i] in self.targetCells:  # for the rest of cells
-                        x.interval = s.backgroundrate**-1*1e3  # set to normal level
+            if s.explorMovs: self.resetExplorMovs(s) # remove explor movs related noise to cells
 
             if s.trialReset:
                 s.timeoflastreset = 0
@@ -490,6 +682,7 @@ class Arm:
 
             if s.rank == 0:
                 print('\nClosing dummy virtual arm ...') 
+                self.drainArmData() # so the replies of the last steps are saved too
                 arminterface.closeSavePlot(self.duration/1000.0, self.interval)
 
                 if self.graphs: # plot graphs
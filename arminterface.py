@@ -57,8 +57,10 @@ msmAnim  = 0
 # Flag to plot MSM graphs
 msmGraphs = 0
 
-#if msmGraphs or saveDataMuscles:
-import armGraphs 	# to plot muscskel arm graphs
+## Import the module to plot muscskel arm graphs only when needed, since it imports matplotlib
+def importArmGraphs():
+	global armGraphs
+	import armGraphs 	# to plot muscskel arm graphs
 
 
 class PipeReader(object):
@@ -108,6 +110,7 @@ def setup(secLength, msecInterval, shInit, elInit, targetx, targety, damping, sh
 	
 	# if plot MSM graphs initialize required arrays (numJoints, numMusBranches and n declared in armGraphs.py)
 	if msmGraphs:
+		importArmGraphs()
 		# Create arrays to store received data
 		n = int(secLength*1000/msecInterval) # calculate number of samples
 		#n = n - 1
@@ -193,26 +196,23 @@ def setup(secLength, msecInterval, shInit, elInit, targetx, targety, damping, sh
 			savedDataSent = []
 			savedDataReceived = []
 
+#
+# Send the motor commands and wait for the joint angles computed by the virtual arm
+#
 def sendAndReceiveDataPackets(simtime, msecInterval, data1, data2, data3, data4):
+	if not sendDataPackets(simtime, msecInterval, data1, data2, data3, data4):
+		return [-3]*2  # error code indicating virtual arm pipe is not available
+	return receiveDataPackets(simtime, msecInterval)
+
+#
+# Send the motor commands to the virtual arm without waiting for its reply (read later with receiveDataPackets); returns False if the packet could not be sent
+#
+def sendDataPackets(simtime, msecInterval, data1, data2, data3, data4):
 	# input variables
 	global packetID
-	global muscleLengthID
-	global jointAngleID
 	global verbose
-	global anglesReceived   
-	global savedDataSent
-	global savedDataReceived
-	global jointAnglesSeq
-	global musLengthsSeq
-	global muscleLengthBranch
-	global wamForwardType
-	global packetID
-	global jointAngleID
-	global time1
-	global msmReady
 	global proc_stdout
 	global armReady
-	global inputbuffer
 
 	# concatenate input arguments into a list
 	data = [data1, data2,data3,data4]
@@ -246,9 +246,35 @@ def sendAndReceiveDataPackets(simtime, msecInterval, data1, data2, data3, data4)
 			print(str(musclesExcSend))
 	except:
 		print "timeout while sending packet to msarm"
-		dataReceived = [-3]*numJoints  # error code indicating virtual arm pipe is not available
-		dataReceived2 = [0]*numMuscles
-			
+		return False # virtual arm pipe is not available
+	return True
+
+#
+# Check whether the reply of the virtual arm to the oldest packet sent can be read without waiting
+#
+def dataReady():
+	if inputbuffer.tell() < len(inputbuffer.getvalue()): # unread lines in buffer
+		return True
+	ready, _, _ = select.select([proc_stdout], [], [], 0.0)
+	return len(ready) > 0
+
+#
+# Wait for the reply of the virtual arm to the oldest packet sent, and return the joint angles
+#
+def receiveDataPackets(simtime, msecInterval):
+	# input variables
+	global packetID
+	global muscleLengthID
+	global jointAngleID
+	global verbose
+	global anglesReceived   
+	global savedDataReceived
+	global jointAnglesSeq
+	global musLengthsSeq
+	global muscleLengthBranch
+	global proc_stdout
+	global inputbuffer
+
 	#####################
 	# Receive packets 
 	#####################
@@ -395,6 +421,7 @@ def closeSavePlot(secLength, msecInterval, filestem=''):
 	# save muscle data to file
 	if saveDataMuscles:	
 		msmFolder = '' # data files saved locally
+		importArmGraphs()
 #		# Read data from .pnt files
 		jointPosSeq,musExcSeq, musActSeq, musForcesSeq = armGraphs.readPntFiles(msmFolder, pntFile, secLength, msecInterval)
 		with open("%s-muscles.p"%(filestem),'w') as f:
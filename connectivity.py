@@ -0,0 +1,381 @@
+"""
+connectivity.py
+
+Functions to generate the distance-dependent connectivity used by
+network.createNetwork()
+
+Two connection rules are available, selected with s.connmethod:
+- 'bernoulli': test every presynaptic candidate against its probability
+- 'sampled': draw the expected number of presynaptic partners for each
+  population pair directly from the distance-weighted distribution
+
+The random numbers of the 'bernoulli' rule are selected with s.connrandom:
+- 'seeded': a stream seeded per postsynaptic cell (original behaviour)
+- 'philox': a counter-based generator keyed by randseed, with one number
+  per (pre, post) pair, so results don't depend on the number of hosts
+
+Usage example:
+    import connectivity
+    connectivity.buildSpatialIndex() # optional, only if s.connspatialindex
+    connectivity.buildSamplingTables() # only if s.connmethod == 'sampled'
+    preids = connectivity.connPreIds(gid)
+    distances, distances3d = connectivity.cellDistances(gid, preids)
+
+If s.conncachedir is set, positions and connections are saved to (and
+loaded from) .npy files named by a hash of the parameters that determine
+them -- see connCacheParams().
+
+Version: 2016aug01
+"""
+
+from numpy import array, arange, zeros, sqrt, exp, log, pi, cos, sin, arccos, minimum, transpose, concatenate, unique, searchsorted, cumsum, interp, mean, std, save, load, ones, setdiff1d
+from numpy.random import seed, rand, permutation
+import shared as s
+import os
+import hashlib
+
+
+###############################################################################
+### Distances
+###############################################################################
+
+## 2d distances between cells at positions (xs, ys) and postsynaptic cell gid
+def planeDistances(gid, xs, ys):
+    if s.toroidal:
+        xpath=(abs(xs-s.xlocs[gid]))**2
+        xpath2=(s.modelsize-abs(xs-s.xlocs[gid]))**2
+        xpath[xpath2<xpath]=xpath2[xpath2<xpath]
+        ypath=(abs(ys-s.ylocs[gid]))**2
+        ypath2=(s.modelsize-abs(ys-s.ylocs[gid]))**2
+        ypath[ypath2<ypath]=ypath2[ypath2<ypath]
+        return sqrt(xpath + ypath) # Calculate all pairwise distances
+    return sqrt((xs-s.xlocs[gid])**2 + (ys-s.ylocs[gid])**2) # Calculate all pairwise distances
+
+## Distances (2d and 3d) between presynaptic cells preids and postsynaptic cell gid -- same expressions as the all-to-all version so results are bit-identical
+def cellDistances(gid, preids):
+    if s.toroidal:
+        xpath=(abs(s.xlocs[preids]-s.xlocs[gid]))**2
+        xpath2=(s.modelsize-abs(s.xlocs[preids]-s.xlocs[gid]))**2
+        xpath[xpath2<xpath]=xpath2[xpath2<xpath]
+        ypath=(abs(s.ylocs[preids]-s.ylocs[gid]))**2
+        ypath2=(s.modelsize-abs(s.ylocs[preids]-s.ylocs[gid]))**2
+        ypath[ypath2<ypath]=ypath2[ypath2<ypath]
+        zpath=(abs(s.zlocs[preids]-s.zlocs[gid]))**2
+        distances = sqrt(xpath + ypath) # Calculate all pairwise distances
+        distances3d = sqrt(xpath + ypath + zpath) # Calculate all pairwise 3d distances
+    else:
+        distances = sqrt((s.xlocs[preids]-s.xlocs[gid])**2 + (s.ylocs[preids]-s.ylocs[gid])**2) # Calculate all pairwise distances
+        distances3d = sqrt((s.xlocs[preids]-s.xlocs[gid])**2 + (s.ylocs[preids]-s.ylocs[gid])**2 + (s.zlocs[preids]-s.zlocs[gid])**2) # Calculate all pairwise distances
+    return distances, distances3d
+
+
+###############################################################################
+### Spatial index
+###############################################################################
+
+## Distance beyond which no connection probability can exceed s.connmincutoffprob
+def connCutoff():
+    maxprob = s.scaleconnprob.max() * s.connprobs.max() # Largest possible probability at distance 0
+    if maxprob <= s.connmincutoffprob: return 0.0
+    return s.connfalloff.max() * log(maxprob/s.connmincutoffprob) # Solve maxprob*exp(-d/falloff) = connmincutoffprob
+
+## Build a KD-tree over the 2d cell positions (periodic if toroidal) so only nearby presynaptic candidates are visited
+def buildSpatialIndex():
+    from scipy.spatial import cKDTree
+    points = transpose([s.xlocs, s.ylocs])
+    if s.toroidal: s.conntree = cKDTree(points % s.modelsize, boxsize=s.modelsize) # Periodic boundaries match the toroidal distances
+    else: s.conntree = cKDTree(points)
+    s.conncutoff = connCutoff()
+    if s.rank==0: print('  Using spatial index with cutoff = %0.0f um' % s.conncutoff)
+
+## For each postsynaptic population, the gids of the presynaptic population blocks that can project to it (nonzero connprobs)
+def buildPopBlocks():
+    s.connprepops = [[prepop for prepop in range(s.npops) if s.connprobs[prepop,postpop] > 0] for postpop in range(s.npops)] # Presynaptic populations of each population
+    s.connpreblocks = [] # Presynaptic candidate gids of each population
+    for postpop in range(s.npops):
+        blocks = [arange(s.popGidStart[prepop], s.popGidEnd[prepop]+1, dtype='int') for prepop in s.connprepops[postpop]]
+        s.connpreblocks.append(concatenate(blocks) if len(blocks) else array([], dtype='int'))
+    s.connpretables = [] # Positions, probability prefactors and length constants of the candidates of each population, gathered once
+    for postpop in range(s.npops):
+        cand = s.connpreblocks[postpop]
+        prefactor = s.scaleconnprob[s.EorI[cand],s.popEorI[postpop]] * s.connprobs[s.cellpops[cand],postpop]
+        s.connpretables.append((s.xlocs[cand], s.ylocs[cand], prefactor, s.connfalloff[s.EorI[cand]]))
+    if s.rank==0: print('  Connection candidates per cell reduced to %0.0f%% by population-pair pruning' % (100.0*mean([len(s.connpreblocks[pop]) for pop in s.cellpops])/s.ncells))
+
+## Sorted gids of presynaptic candidates for postsynaptic cell gid
+def connCandidates(gid):
+    postpop = s.cellpops[gid]
+    if s.connspatialindex:
+        cand = array(s.conntree.query_ball_point([s.xlocs[gid], s.ylocs[gid]], s.conncutoff), dtype='int')
+        cand = cand[s.connprobs[s.cellpops[cand],postpop] > 0] # Only populations that can project to this one
+        cand.sort() # Keep the same order as the all-to-all version
+        return cand
+    return s.connpreblocks[postpop]
+
+
+###############################################################################
+### Random numbers
+###############################################################################
+
+## Uniform random numbers in [0,1) for the counters (pre, post) under key, using the Philox2x32-10 counter-based generator (Salmon et al., 2011)
+def philoxUniform(pre, post, key):
+    x0 = array(pre, dtype='uint64') & 0xFFFFFFFF
+    x1 = array(post, dtype='uint64') & 0xFFFFFFFF
+    x1 = x1 + zeros(x0.shape, dtype='uint64') # Broadcast a single postsynaptic gid
+    k = int(key) & 0xFFFFFFFF
+    for iround in range(10):
+        product = x0 * 0xD256D193 # Fits in 64 bits since both factors are 32 bits
+        x0, x1 = ((product >> 32) ^ k ^ x1), (product & 0xFFFFFFFF)
+        k = (k + 0x9E3779B9) & 0xFFFFFFFF # Bump the key (Weyl sequence)
+    return ((x0 >> 5) * 67108864.0 + (x1 >> 6)) / 9007199254740992.0 # 53 random bits from the two output words
+
+## Random numbers used to test the connections from presynaptic candidates cand (sorted) onto postsynaptic cell gid, using the stream selected by s.connrandom
+def connRands(gid, cand):
+    if s.connrandom == 'seeded': # Sequential stream seeded per postsynaptic cell
+        seed(s.id32('%d'%(s.randseed+gid))) # Reset random number generator
+        return rand(cand[-1]+1)[cand] # Same stream as drawing s.ncells of them, truncated after the last candidate
+    elif s.connrandom == 'philox': # Counter-based: each (pre, post) pair has its own number, independent of which cells are generated where or in what order
+        return philoxUniform(cand, gid, s.id32('%d'%s.randseed))
+    else: raise Exception('Undefined connection random stream "%s"' % s.connrandom) # No match? Cause an error
+
+
+###############################################################################
+### Connection rules
+###############################################################################
+
+## Presynaptic gids for postsynaptic cell gid using the rule selected by s.connmethod
+def connPreIds(gid):
+    if s.connmethod == 'bernoulli': return connPreIdsBernoulli(gid)
+    elif s.connmethod == 'sampled': return connPreIdsSampled(gid)
+    else: raise Exception('Undefined connection method "%s"' % s.connmethod) # No match? Cause an error
+
+## Presynaptic gids for postsynaptic cell gid using the distance-dependent Bernoulli rule
+def connPreIdsBernoulli(gid):
+    cand = connCandidates(gid)
+    if s.PMdinput == 'Plexon' and s.cellpops[gid] == s.ER5: # PMd->ER5 conn (full conn)
+        PMdId = (gid % s.server.numPMd) + s.ncells - s.server.numPMd #CHECK THIS!
+        cand = unique(concatenate([cand, [PMdId]])) # make sure it's a candidate
+    if len(cand) == 0: return array([], dtype='int')
+    rands = connRands(gid, cand) # Random numbers for checking each connection
+    if s.PMdinput == 'Plexon':
+        rands[(cand >= s.popGidStart[s.PMd]) & (cand <= s.popGidEnd[s.PMd])] = 1
+    if s.connspatialindex or len(cand) != len(s.connpreblocks[s.cellpops[gid]]): # Arbitrary candidates
+        distances = planeDistances(gid, s.xlocs[cand], s.ylocs[cand])
+        connprobs = s.scaleconnprob[s.EorI[cand],s.EorI[gid]] * s.connprobs[s.cellpops[cand],s.cellpops[gid]] * exp(-distances/s.connfalloff[s.EorI[cand]]) # Calculate pairwise probabilities
+    else: # Candidates are the population blocks, use the gathered tables
+        xs, ys, prefactor, falloff = s.connpretables[s.cellpops[gid]]
+        connprobs = prefactor * exp(-planeDistances(gid, xs, ys)/falloff) # Calculate pairwise probabilities
+    connprobs[cand==gid] = 0 # Prohibit self-connections using the cell's GID
+    if s.PMdinput == 'Plexon' and s.cellpops[gid] == s.ER5:
+        iPMd = searchsorted(cand, PMdId)
+        connprobs[iPMd] = s.connprobs[s.PMd,s.ER5] # to make this connected to ER5
+        rands[iPMd] = 0 # to make this connect to ER5
+    makethisconnection = connprobs>rands # Perform test to see whether or not this connection should be made
+    return array(cand[makethisconnection],dtype='int') # Presynaptic cell IDs
+
+
+###############################################################################
+### Sampled (fixed in-degree) rule
+###############################################################################
+
+## Length of the circle of radius r that lies inside the network (square of side modelsize, wrapped if toroidal)
+def circlePerimeter(r):
+    L = float(s.modelsize)
+    if not s.toroidal: return 2*pi*r # Edge effects are ignored for non-toroidal networks
+    perim = 2*pi*r
+    outer = r > L/2 # circle wraps around the torus
+    perim[outer] = 2*r[outer]*(pi - 4*arccos(minimum(L/(2*r[outer]),1)))
+    perim[r > L/sqrt(2)] = 0
+    return perim
+
+## Expected number of presynaptic partners from prepop onto one cell of postpop, with a distance grid and the CDF of their distances
+def pairDistanceTable(prepop, postpop):
+    nbins = 2000 # Number of radial bins used to tabulate the distance distribution
+    L = float(s.modelsize)
+    rgrid = (L/sqrt(2) if s.toroidal else L*sqrt(2)) * arange(nbins+1)/float(nbins)
+    perim = circlePerimeter(rgrid)
+    prob = s.scaleconnprob[s.popEorI[prepop],s.popEorI[postpop]] * s.connprobs[prepop,postpop] * exp(-rgrid/s.connfalloff[s.popEorI[prepop]])
+    density = minimum(prob,1) * perim * s.popnumbers[prepop] / L**2 # Expected number of presynaptic partners per um of distance
+    binmass = (density[1:]+density[:-1])/2 * (rgrid[1:]-rgrid[:-1]) # Trapezoidal integration
+    ndegree = binmass.sum()
+    cdf = concatenate([[0], cumsum(binmass)/ndegree])
+    return ndegree, rgrid, cdf
+
+## Precompute, for each nonzero population pair, the expected in-degree and the inverse CDF of connection distances, plus a KD-tree per presynaptic population
+def buildSamplingTables():
+    from scipy.spatial import cKDTree
+    L = float(s.modelsize)
+    s.conntables = {} # key = (prepop, postpop); value = (expected in-degree, distance grid, CDF)
+    s.poptrees = [] # KD-tree of 2d positions for each population
+    for prepop in range(s.npops):
+        points = transpose([s.xlocs[s.cellpops==prepop], s.ylocs[s.cellpops==prepop]])
+        if s.toroidal: s.poptrees.append(cKDTree(points % L, boxsize=L))
+        else: s.poptrees.append(cKDTree(points))
+        for postpop in range(s.npops):
+            if s.connprobs[prepop,postpop] <= 0: continue
+            if s.PMdinput == 'Plexon' and prepop == s.PMd: continue # PMd is wired explicitly
+            s.conntables[(prepop,postpop)] = pairDistanceTable(prepop, postpop)
+    if s.rank==0: print('  Using sampled connectivity for %i population pairs' % len(s.conntables))
+
+## Presynaptic gids for postsynaptic cell gid sampled from the distance-weighted distribution of each population pair. Each sampled location is snapped to the
+## nearest cell, so cells with more empty space around them (and, without s.toroidal, cells near the edges) are chosen more often: the in-degree and spatial
+## statistics only approximate the Bernoulli rule (see compareDegrees())
+def connPreIdsSampled(gid):
+    maxrounds = 10 # Number of times to redraw positions that hit an already-chosen cell
+    L = float(s.modelsize)
+    postpop = s.cellpops[gid]
+    seed(s.id32('%d'%(s.randseed+gid))) # Reset random number generator
+    preids = []
+    for prepop in range(s.npops):
+        if (prepop,postpop) not in s.conntables: continue
+        ndegree, rgrid, cdf = s.conntables[(prepop,postpop)]
+        npre = int(ndegree) + int(rand() < ndegree-int(ndegree)) # Fixed in-degree: expected value, rounded stochastically
+        npre = min(npre, s.popnumbers[prepop] - (prepop==postpop)) # Can't have more partners than cells
+        chosen = array([], dtype='int')
+        for iround in range(maxrounds):
+            nleft = npre - len(chosen)
+            if nleft <= 0: break
+            dist = interp(rand(nleft), cdf, rgrid) # Inverse-CDF sampling of connection distances
+            angle = 2*pi*rand(nleft)
+            points = transpose([s.xlocs[gid] + dist*cos(angle), s.ylocs[gid] + dist*sin(angle)])
+            if s.toroidal: points = points % L
+            nearest = array(s.poptrees[prepop].query(points)[1], dtype='int') + s.popGidStart[prepop] # Presynaptic cell closest to each sampled location
+            nearest = nearest[nearest != gid] # Prohibit self-connections
+            nearest = setdiff1d(nearest, chosen) # New cells only (sorted by gid)
+            chosen = concatenate([chosen, permutation(nearest)[:nleft]]) # Random subsample, so that the highest gids aren't the ones dropped
+        preids.append(chosen)
+    if s.PMdinput == 'Plexon' and s.cellpops[gid] == s.ER5: # PMd->ER5 conn (full conn)
+        preids.append([(gid % s.server.numPMd) + s.ncells - s.server.numPMd])
+    if len(preids) == 0: return array([], dtype='int')
+    return unique(concatenate(preids)).astype('int')
+
+## In-degree (mean, std) from each presynaptic population, for a list of postsynaptic cells
+def degreeStats(gids, rule):
+    degrees = zeros((len(gids), s.npops))
+    for i,gid in enumerate(gids):
+        preids = rule(gid)
+        for prepop in s.cellpops[preids]: degrees[i,prepop] += 1
+    return mean(degrees,0), std(degrees,0)
+
+## Compare the in-degree statistics of the sampled rule with the Bernoulli rule on a subset of postsynaptic cells
+def compareDegrees(gids):
+    print('  In-degree of sampled vs Bernoulli rule (mean +/- std over %i cells on host %i):' % (len(gids), s.rank))
+    for postpop in unique(s.cellpops[gids]):
+        popgids = [gid for gid in gids if s.cellpops[gid] == postpop]
+        sampledmean, sampledstd = degreeStats(popgids, connPreIdsSampled)
+        bernoullimean, bernoullistd = degreeStats(popgids, connPreIdsBernoulli)
+        for prepop in range(s.npops):
+            if sampledmean[prepop] or bernoullimean[prepop]:
+                print('    %s->%s: sampled %0.1f +/- %0.1f; Bernoulli %0.1f +/- %0.1f' % (s.popnames[prepop], s.popnames[postpop], sampledmean[prepop], sampledstd[prepop], bernoullimean[prepop], bernoullistd[prepop]))
+
+
+###############################################################################
+### Compact storage
+###############################################################################
+
+conndtype = [('pre','i4'), ('post','i4'), ('dist','f4'), ('delay','f4'), ('receptor','u1'), ('weight','f4')] # One row per nonzero receptor weight of each connection
+
+## Pack the connection arrays [pre, post, distances, delays, weights] into one structured array with a row per nonzero receptor weight (a single zero-weight row for connections without any)
+def packConnections(conndata):
+    pre, post, distances, delays, weights = conndata
+    weights = array(weights).reshape(len(pre), s.nreceptors)
+    nonzero = weights != 0
+    nonzero[~nonzero.any(1), 0] = True # Keep connections with all weights zero
+    conns, receptors = nonzero.nonzero() # Row-major, so the rows of a connection are consecutive with increasing receptor
+    packed = zeros(len(conns), dtype=conndtype)
+    packed['pre'] = array(pre)[conns]
+    packed['post'] = array(post)[conns]
+    packed['dist'] = array(distances)[conns]
+    packed['delay'] = array(delays)[conns]
+    packed['receptor'] = receptors
+    packed['weight'] = weights[conns, receptors]
+    return packed
+
+## Whether each row of packed connections is the first row of a connection
+def connStartRows(packed):
+    isstart = ones(len(packed), dtype='bool')
+    isstart[1:] = (packed['pre'][1:] != packed['pre'][:-1]) | (packed['post'][1:] != packed['post'][:-1]) | (packed['receptor'][1:] <= packed['receptor'][:-1])
+    return isstart
+
+## Number of connections in conndata (packed or not)
+def numConnections(conndata):
+    if s.conncompact: return int(connStartRows(conndata).sum())
+    return len(conndata[0])
+
+## Connection arrays [pre, post, distances, delays, weights] from conndata -- returned unchanged if not packed
+def unpackConnections(conndata):
+    if not s.conncompact: return conndata
+    isstart = connStartRows(conndata)
+    connids = cumsum(isstart) - 1 # Connection of each row
+    weights = zeros((int(isstart.sum()), s.nreceptors))
+    weights[connids, conndata['receptor']] = conndata['weight']
+    starts = isstart.nonzero()[0]
+    return [array(conndata['pre'][starts], dtype='int'), array(conndata['post'][starts], dtype='int'), array(conndata['dist'][starts], dtype='float'), array(conndata['delay'][starts], dtype='float'), weights]
+
+
+###############################################################################
+### On-disk cache
+###############################################################################
+
+## Parameters that determine positions and connections -- any change gives a different cache key
+def connCacheParams():
+    params = ['randseed', 'ncells', 'popnumbers', 'cellpops', 'cellnames', 'modelsize', 'corticalthick', 'popyfrac', 'toroidal',
+        'connprobs', 'scaleconnprob', 'connfalloff', 'connweights', 'scaleconnweight', 'receptorweight', 'mindelay', 'velocity',
+        'connmethod', 'connrandom', 'connspatialindex', 'conncompact', 'connmincutoffprob', 'PMdinput', 'motorCmdStartCell', 'motorCmdEndCell', 'nMuscles', 'nhosts', 'placement', 'gidhosts']
+    values = [getattr(s, param) for param in params]
+    if s.PMdinput == 'Plexon': # PMd->ER5 wiring depends on the number of Plexon PMd cells
+        params.append('server.numPMd')
+        values.append(s.server.numPMd)
+    return params, values
+
+## Hash of the parameters in connCacheParams()
+def connCacheKey():
+    md5 = hashlib.md5('conncache-v2'.encode())
+    for param, value in zip(*connCacheParams()):
+        value = array(value)
+        md5.update(('%s %s %s;' % (param, value.dtype, value.shape)).encode())
+        md5.update(value.tobytes())
+    return md5.hexdigest()
+
+## File names of the cached positions (shared by all hosts) and connections of this host
+def connCacheFiles():
+    stem = os.path.join(s.conncachedir, s.conncachekey)
+    positionsfile = stem + '_positions.npy'
+    if s.conncompact: connfiles = ['%s_host%i_conn.npy' % (stem, s.rank)]
+    else: connfiles = ['%s_host%i_conn%i.npy' % (stem, s.rank, pp) for pp in range(s.nconnpars)]
+    return positionsfile, connfiles
+
+## Whether positions and connections of this host are already in the cache
+def connCacheExists():
+    s.conncachekey = connCacheKey()
+    positionsfile, connfiles = connCacheFiles()
+    return all([os.path.exists(f) for f in [positionsfile]+connfiles])
+
+## Write an array to file, via a temporary file so that concurrent runs never read a partial file
+def saveCacheArray(filename, data):
+    tmpfile = '%s.%i.tmp' % (filename, os.getpid())
+    with open(tmpfile, 'wb') as f: save(f, data)
+    os.rename(tmpfile, filename)
+
+## Load cell positions from the cache
+def loadCachedPositions():
+    positionsfile, connfiles = connCacheFiles()
+    s.xlocs, s.ylocs, s.zlocs = load(positionsfile) # Small, so load into memory
+    if s.rank==0: print('  Loaded cell positions from connectivity cache %s' % positionsfile)
+
+## Load connections of this host from the cache (memory-mapped, read only)
+def loadCachedConnections():
+    positionsfile, connfiles = connCacheFiles()
+    if s.conncompact: s.conndata = load(connfiles[0], mmap_mode='r')
+    else: s.conndata = [load(f, mmap_mode='r') for f in connfiles]
+
+## Save positions (host 0) and connections of this host to the cache
+def saveConnCache():
+    if not os.path.exists(s.conncachedir):
+        try: os.makedirs(s.conncachedir)
+        except OSError: pass # Created by another host in the meantime
+    positionsfile, connfiles = connCacheFiles()
+    if s.rank==0: saveCacheArray(positionsfile, array([s.xlocs, s.ylocs, s.zlocs]))
+    if s.conncompact: saveCacheArray(connfiles[0], s.conndata)
+    else:
+        for pp in range(s.nconnpars): saveCacheArray(connfiles[pp], s.conndata[pp])
@@ -27,6 +27,8 @@ simdatadir = '../data/16jul26_'+evolAlgorithm # folder to save sim results
 
 num_islands = 6 # number of islands
 numproc = 16 # number of cores per job
+concurrenttests = 0 # train each candidate, then test each target in a job of its own started from the trained network, both at the same time
+numproctest = numproc/2 # number of cores per test job (concurrenttests); the two test jobs of a candidate are pinned to disjoint cores of its node
 musculoskeletalArm = 1 # need to know cause requires extra core
 max_migrants = 1 #
 migration_interval = 5
@@ -158,14 +160,21 @@ def parallel_evaluation_pbs(candidates, args):
         for itarget in targets_eval:            
             with open('%s_params'% (outfilestem), 'w') as f: # save current candidate params to file 
                 pickle.dump(c, f)
-            command = 'mpirun -machinefile %s/nodes%d -np %d nrniv -python -mpi main.py outfilestem="%s" targetid=%d'%(simdatadir, i+1, numproc, outfilestem, itarget) # set command to run
+            mpirun = 'mpirun %s -np %d nrniv -python -mpi '
+            hosts = '-machinefile %s/nodes%d'%(simdatadir, i+1)
+            command = 'main.py optimrun=1 outfilestem="%s" targetid=%d conncachedir="%s/conncache"'%(outfilestem, itarget, simdatadir) # set command to run
 
 
             for iparam, param in enumerate(c): # add all param names and values dynamically
                 paramstring = ' %s=%r' % (pNames[iparam], param)
                 command += paramstring
 
-            command += ' > %s.run &' % (outfilestem)  # to save to file and run in background
+            if concurrenttests: # train and save the trained network, then test both targets from it at the same time; the last test to finish saves the fitness
+                train = mpirun%(hosts, numproc) + command + ' "testtargets=[]" checkpointout="%s_trained" > %s.run' % (outfilestem, outfilestem)
+                tests = [mpirun%('-rf %s/nodes%d_test%d'%(simdatadir, i+1, itest), numproctest) + command + ' "testtargets=[%d]" checkpointin="%s_trained" > %s_test%d.run &' % (itest, outfilestem, outfilestem, itest) for itest in [0, 1]] # rankfiles written by the batch script
+                command = '(%s && (%s %s wait)) &' % (train, tests[0], tests[1]) # to save to file and run in background
+            else:
+                command = mpirun%(hosts, numproc) + command + ' > %s.run &' % (outfilestem)  # to save to file and run in background
 
             commandList.append(command)
 
@@ -232,6 +241,12 @@ cd '/home/salvadord/m1ms/sim/'
     simdatadir, simdatadir, simdatadir, simdatadir, simdatadir)
 
 
+    if concurrenttests: # rankfile of each test job: numproctest cores of the node of its candidate, the first ones for target 0 and the next ones for target 1
+        for icand in range(len(candidates)):
+            for itest in [0, 1]:
+                job_string += """awk 'NR==%d {for (r = 0; r < %d; r++) print "rank "r"="$1" slot="(%d+r)}' %s/nodeslist > %s/nodes%d_test%d\n""" % (icand+1, numproctest, itest*numproctest, simdatadir, simdatadir, icand+1, itest)
+        job_string += '\n'
+
     print job_string # print sbatch script
 
     batchfile = '%s/gen_%d.sbatch'%(simdatadir, ngen)
@@ -1,5 +1,4 @@
-import matplotlib
-# matplotlib.use('Agg') # needed for hpc batch sims
+# import matplotlib; matplotlib.use('Agg') # needed for hpc batch sims (matplotlib is otherwise only imported when plotting)
 
 import sys
 from numpy import mean, zeros
@@ -17,7 +16,7 @@ for argv in sys.argv[1:]: # Skip first argument, which is file name
     harg = arg[0].split('.')+[''] # Separate out variable name; '' since if split fails need to still have an harg[1]
     if len(arg)==2:
         if hasattr(s,arg[0]) or hasattr(s,harg[1]): # Check that variable exists
-            if arg[0] == 'outfilestem':
+            if arg[0] in ['outfilestem', 'conncachedir', 'placementcalib', 'runmode', 'checkpointout', 'checkpointin']: # string arguments
                 exec('s.'+arg[0]+'="'+arg[1]+'"') # Actually set variable 
                 if s.rank==0: # messages only come from Master  
                     print('  Setting %s=%s' %(arg[0],arg[1]))
@@ -35,9 +34,11 @@ for argv in sys.argv[1:]: # Skip first argument, which is file name
 ###############################################################################
 ### Run model
 ###############################################################################
+importstart = time()
 import network
+if s.rank==0: print('  Imported network modules in %0.2f s' % (time()-importstart))
 
-network.runTrainTest2targets()
-#network.runTrainTest2targetsOptim()
+if s.optimrun: network.runTrainTest2targetsOptim()
+else: network.runTrainTest2targets()
 
 #from pylab import show; show()  # needed for hpc batch sims
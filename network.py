@@ -25,15 +25,19 @@ Version: 2014feb21 by cliffk
 ### IMPORT MODULES
 ###############################################################################
 
-from pylab import seed, rand, sqrt, exp, transpose, ceil, concatenate, array, zeros, ones, vstack, show, disp, mean, inf, concatenate, unique, delete
+from numpy import sqrt, exp, transpose, ceil, concatenate, array, zeros, ones, vstack, disp, mean, inf, unique, delete, sort, isnan, isinf, arange, argsort, searchsorted
+from numpy.random import seed, rand
 from time import time, sleep
 from datetime import datetime
 from scipy.io import savemat, loadmat 
 import pickle
+import os
+import sys
 
 from neuron import h, init, run # Import NEURON
 import shared as s # Import all shared variables and parameters
-import analysis
+import connectivity
+import placement
 from arm import Arm # Class with arm methods and variables
 
 
@@ -58,6 +62,7 @@ def runTrainTest2targets():
     s.PMdconnprob = 2.4
 
     s.useArm = 'dummyArm' #'musculoskeletal'
+    if s.testtargets != [0, 1]: raise Exception('testtargets needs runTrainTest2targetsOptim (optimrun=1)') # this one always tests both targets
 
     s.numTrials = ceil(s.trainTime/1000)
     s.trialTargets = [i%2 for i in range(int(s.numTrials+1))] # set target for each trial
@@ -86,11 +91,14 @@ def runTrainTest2targets():
     s.antagInh = 0 # enable exploratory movements
     s.duration = s.trainTime # train time
 
-    setupSim()
-    runSim()
-    finalizeSim()
-    #saveData()
-    plotData()
+    if s.checkpointin != '': loadCheckpoint(s.checkpointin) # trained weights
+    else:
+        setupSim()
+        runSim()
+        if s.checkpointout != '': saveCheckpoint(s.checkpointout)
+        finalizeSim()
+        #saveData()
+        plotData()
 
     # test target 0
     s.backgroundrate=s.backgroundrateTest # 300
@@ -164,6 +172,7 @@ def runTrainTest2targetsOptim():
     s.targetid=s.trialTargets[0]
   
     verystart=time() # store initial time
+    if len(s.testtargets) == 1 and s.checkpointin == '': raise Exception('Testing a single target needs the trained network from checkpointin') # to combine its error with the one of the other target
 
     s.plotraster = 0 # set plotting params
     s.plotconn = 0
@@ -188,19 +197,23 @@ def runTrainTest2targetsOptim():
     addBackground()
 
     # run train
-    setupSim()
-    runSim()
-    finalizeSim()
-    #saveData()
-    #plotData()
-    if s.rank == 0: # save png of traj
-        s.arm.plotTraj(s.outfilestem+'_train.png')  # save traj fig to file 
-        analysis.plotweightchanges(s.outfilestem+'_train_weights.png')
+    if s.checkpointin != '': loadCheckpoint(s.checkpointin) # trained weights
+    else:
+        setupSim()
+        runSim()
+        if s.checkpointout != '': saveCheckpoint(s.checkpointout)
+        finalizeSim()
+        #saveData()
+        #plotData()
+        if s.rank == 0: # save png of traj
+            import analysis # Only import matplotlib when plotting
+            s.arm.plotTraj(s.outfilestem+'_train.png')  # save traj fig to file 
+            analysis.plotweightchanges(s.outfilestem+'_train_weights.png')
 
-    test = 1
+    test = len(s.testtargets) > 0
     s.savemat = 1
     if test:
-        # test target 0
+        # test target 0 and target 1
         #s.backgroundrate=s.backgroundrateTest # 300
         #s.cmdmaxrate=s.cmdmaxrateTest # 15
         addBackground()
@@ -209,33 +222,20 @@ def runTrainTest2targetsOptim():
         s.explorMovs = 0 # disable exploratory movements
         s.duration = s.testTime # testing time
         s.armMinimalSave = 0 # save only arm related data
-        
-        s.targetid = 0
-        setupSim()
-        runSim()
-        finalizeSim()
-        saveData()
-        #plotData()
-
-        if s.rank == 0: # save error to file
-            error0 = mean(s.arm.errorAll)
-            print 'Target error for target ',s.targetid,' is:', error0 
-            s.arm.plotTraj(s.outfilestem+'_t0.png') 
-            analysis.plotraster(s.outfilestem+'_t0_raster.png')
-
-        # test target 1
-        s.targetid = 1
-        setupSim()
-        runSim()
-        finalizeSim()
-        saveData()
-        #plotData()
 
-        if s.rank == 0: # save error to file
-            error1 = mean(s.arm.errorAll)
+        if len(s.testtargets) == 1: errors = saveTestError(s.testtargets[0], runTest(s.testtargets[0])) # in a job of its own, at the same time as the job of the other target
+        elif s.forktests and not s.ismpi: errors = dict(zip(s.testtargets, forkTests(s.testtargets))) # concurrently, each from the trained network
+        else:
+            if s.forktests and s.rank == 0: print('  Running the tests one after the other: forktests needs a single process without MPI (with MPI, test each target in a job of its own with testtargets)')
+            trainedweights = [stdpWeight(ps) for ps in range(s.nstdpconns)] # each test starts from the trained network, as with forktests and testtargets
+            errors = {}
+            for targetid in s.testtargets:
+                for ps, weight in enumerate(trainedweights): setStdpWeight(ps, weight) # undo the changes of the previous test
+                errors[targetid] = runTest(targetid)
+
+        if s.rank == 0 and errors is not None: # save error to file
+            error0, error1 = errors[0], errors[1]
             print 'Target error for target 0=', error0, '; target 1=', error1 
-            s.arm.plotTraj(s.outfilestem+'_t1.png') 
-            analysis.plotraster(s.outfilestem+'_t1_raster.png')
 
             errorMean = (error0+error1)/2
             errorFitness = errorMean + abs(error0-error1)  # fitness penalizes difference between target errors
@@ -259,6 +259,81 @@ def runTrainTest2targetsOptim():
     if (s.plotraster==False and s.plotconn==False and s.plotweightchanges==False): h.quit() # Quit extra processes, or everything if plotting wasn't requested (since assume non-interactive)
 
 
+# test the trained network on one target (batch, no graphics); returns the mean error (on worker0)
+def runTest(targetid):
+    s.targetid = targetid
+    setupSim()
+    runSim()
+    finalizeSim()
+    saveData()
+    #plotData()
+
+    error = None
+    if s.rank == 0: # save error to file
+        error = mean(s.arm.errorAll)
+        print 'Target error for target ',s.targetid,' is:', error 
+        import analysis
+        s.arm.plotTraj(s.outfilestem+'_t%d.png' % targetid) 
+        analysis.plotraster(s.outfilestem+'_t%d_raster.png' % targetid)
+    return error
+
+
+# test the trained network on each target in a forked copy of this (single host) process, all at the same time; returns the error of each target
+def forkTests(targetids):
+    pids = []
+    sys.stdout.flush() # otherwise each child prints the output buffered so far again
+    for targetid in targetids:
+        filename = '%s_target_%d_testerror' % (s.outfilestem, targetid)
+        if os.path.exists(filename): os.remove(filename) # left over from an interrupted run
+        pid = os.fork()
+        if pid == 0: # child: a copy of the trained network
+            status = 1
+            try:
+                import random
+                random.seed() # different temporary file names for each musculoskeletal arm
+                error = runTest(targetid)
+                with open(filename, 'wb') as f:
+                    pickle.dump(error, f)
+                status = 0
+            except:
+                import traceback
+                traceback.print_exc() # the parent then reports the failed test
+            sys.stdout.flush()
+            os._exit(status) # skip the exit handlers of the parent
+        pids.append(pid)
+
+    statuses = [os.waitpid(pid, 0)[1] for pid in pids] # wait for all the tests before reporting a failed one
+    errors = []
+    for targetid, status in zip(targetids, statuses):
+        if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0: raise Exception('Test of target %d failed (wait status %d)' % (targetid, status))
+        filename = '%s_target_%d_testerror' % (s.outfilestem, targetid)
+        with open(filename, 'rb') as f:
+            errors.append(pickle.load(f))
+        os.remove(filename)
+    return errors
+
+
+# save the test error of one target, from a job testing only that target (testtargets) from the trained network of checkpointin; once the jobs of both targets
+# have saved theirs, returns the error of each target (on worker0), otherwise None
+def saveTestError(targetid, error):
+    if s.rank != 0: return None
+    trained = os.path.getmtime('%s_host0.pkl' % s.checkpointin) # identifies the trained network, so that errors of earlier runs aren't combined with this one
+    filename = '%s_target_%d_testerror' % (s.outfilestem, targetid)
+    tmpfile = '%s.%i.tmp' % (filename, os.getpid())
+    with open(tmpfile, 'wb') as f:
+        pickle.dump((trained, error), f)
+    os.rename(tmpfile, filename) # so that the other job never reads a partial file
+
+    errors = {}
+    for othertarget in [0, 1]:
+        try:
+            with open('%s_target_%d_testerror' % (s.outfilestem, othertarget), 'rb') as f:
+                othertrained, errors[othertarget] = pickle.load(f)
+        except IOError: return None # not saved yet: the job of that target combines the errors
+        if othertrained != trained: return None # from another trained network: the job of that target hasn't finished
+    return errors
+
+
 ###############################################################################
 ### Create Network
 ###############################################################################
@@ -289,13 +364,56 @@ def createNetwork():
         else: raise Exception('Undefined cell class "%s"' % s.cellclasses[c]) # No match? Cause an error
 
 
+    ## Set plastic connections based on plasConnsType (from evol alg)
+    if s.plastConnsType == 0:
+        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC]] # only spinal cord 
+    elif s.plastConnsType == 1:
+        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC], [s.ER2,s.ER5], [s.ER5,s.EB5], [s.ER2,s.EB5], [s.ER5,s.ER2]] # + L2-L5
+    elif s.plastConnsType == 2:
+        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC], [s.ER2,s.ER5], [s.ER5,s.EB5], [s.ER2,s.EB5], [s.ER5,s.ER2],\
+        [s.ER5,s.ER6], [s.ER6,s.ER5], [s.ER6,s.EB5]] # + L6
+    elif s.plastConnsType == 3:
+        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC], [s.ER2,s.ER5], [s.ER5,s.EB5], [s.ER2,s.EB5], [s.ER5,s.ER2],\
+         [s.ER5,s.ER6], [s.ER6,s.ER5], [s.ER6,s.EB5], \
+         [s.ER2,s.IL2], [s.ER2,s.IF2], [s.ER5,s.IL5], [s.ER5,s.IF5], [s.EB5,s.IL5], [s.EB5,s.IF5]] # + Inh
+    # same with additional plasticity between PMd->L5A
+    elif s.plastConnsType == 4: 
+        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC], [s.PMd,s.ER5]] # only spinal cord + pmd
+    elif s.plastConnsType == 5:
+        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC], [s.PMd,s.ER5], # spinal cord + pmd
+         [s.ER2,s.ER5], [s.ER5,s.EB5], [s.ER2,s.EB5], [s.ER5,s.ER2]] # + L2-L5
+    elif s.plastConnsType == 6:
+        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC], [s.PMd,s.ER5], # spinal cord + pmd
+        [s.ER2,s.ER5], [s.ER5,s.EB5], [s.ER2,s.EB5], [s.ER5,s.ER2], # + L2-L5
+        [s.ER5,s.ER6], [s.ER6,s.ER5], [s.ER6,s.EB5]] # + L6
+    elif s.plastConnsType == 7:
+        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC], [s.PMd,s.ER5], # spinal cord + pmd 
+        [s.ER2,s.ER5], [s.ER5,s.EB5], [s.ER2,s.EB5], [s.ER5,s.ER2], # + L2-L5
+        [s.ER5,s.ER6], [s.ER6,s.ER5], [s.ER6,s.EB5], # + L6
+        [s.ER2,s.IL2], [s.ER2,s.IF2], [s.ER5,s.IL5], [s.ER5,s.IF5], [s.EB5,s.IL5], [s.EB5,s.IF5]]  # + Inh
+
+
+    ## Assign cells to hosts
+    placement.placeCells() # Host of each gid (s.gidhosts) and estimated load of each host
+
+
     ## Set positions
-    seed(s.id32('%d'%s.randseed)) # Reset random number generator
-    s.xlocs = s.modelsize*rand(s.ncells) # Create random x locations
-    s.ylocs = s.modelsize*rand(s.ncells) # Create random y locations
-    s.zlocs = rand(s.ncells) # Create random z locations
-    for c in range(s.ncells): 
-        s.zlocs[c] = s.corticalthick * (s.zlocs[c]*(s.popyfrac[s.cellpops[c]][1]-s.popyfrac[s.cellpops[c]][0]) + s.popyfrac[s.cellpops[c]][0])  # calculate based on yfrac for population and corticalthick 
+    s.nconnpars = 5 # Connection parameters: pre- and post- cell ID, weight, distances, delays
+    s.conncached = s.conncachedir != '' and connectivity.connCacheExists() # Whether positions and connections of this network were saved by a previous run
+    if s.conncached:
+        connectivity.loadCachedPositions()
+    else:
+        seed(s.id32('%d'%s.randseed)) # Reset random number generator
+        s.xlocs = s.modelsize*rand(s.ncells) # Create random x locations
+        s.ylocs = s.modelsize*rand(s.ncells) # Create random y locations
+        s.zlocs = rand(s.ncells) # Create random z locations
+        for c in range(s.ncells): 
+            s.zlocs[c] = s.corticalthick * (s.zlocs[c]*(s.popyfrac[s.cellpops[c]][1]-s.popyfrac[s.cellpops[c]][0]) + s.popyfrac[s.cellpops[c]][0])  # calculate based on yfrac for population and corticalthick 
+
+
+        connectivity.buildPopBlocks() # Presynaptic population blocks that can project to each population
+        if s.connspatialindex: connectivity.buildSpatialIndex() # Index positions so only nearby presynaptic candidates are visited
+        if s.connmethod == 'sampled': connectivity.buildSamplingTables() # Expected in-degree and distance distribution for each population pair
 
 
     ## Actually create the cells
@@ -303,10 +421,10 @@ def createNetwork():
     s.hostspikevecs = [] # Empty list for storing host-specific spike vectors
     s.cellsperhost = 0
     if s.PMdinput == 'Plexon': ninnclDic = len(s.innclDic) # number of PMd created in this worker
-    for c in xrange(int(s.rank), s.ncells, s.nhosts):
+    for c in (s.gidhosts == s.rank).nonzero()[0]: # gids assigned to this host, in increasing order
         s.dummies.append(h.Section()) # Create fake sections
-        gid = c
-        if s.cellnames[gid] == 'PMd':
+        gid = int(c)
+        if s.cellpops[gid] == s.PMd:
             if s.PMdinput == 'Plexon':
                 cell = celltypes[gid](cellid = gid) # create an NSLOC
                 s.inncl.append(h.NetCon(None, cell))  # This netcon receives external spikes
@@ -324,7 +442,7 @@ def createNetwork():
                 cell.number = s.backgroundnumber
                 cell.interval = s.backgroundrateMin**-1*1e3
                 
-        elif s.cellnames[gid] == 'ASC':
+        elif s.cellpops[gid] == s.ASC:
             cell = celltypes[gid](cellid = gid) #create an NSLOC    
         else: 
             if s.cellclasses[gid]==3: 
@@ -344,7 +462,10 @@ def createNetwork():
         s.spikerecorders.append(spikerecorder)
         s.pc.cell(gid, s.spikerecorders[s.cellsperhost])
         s.cellsperhost += 1 # contain cell numbers per host including PMd and P
-    print('  Number of cells on node %i: %i ' % (s.rank,len(s.cells)))
+    localpops = s.cellpops[s.gidVec] # Population of each local cell
+    s.popLocalIds = [(localpops == pop).nonzero()[0] for pop in range(s.npops)] # Local ids of the cells of each population on this host
+    s.izhiLocalIds = (~s.cellartificial[s.gidVec]).nonzero()[0] # Local ids of the Izhikevich cells (all but PMd and ASC) on this host
+    print('  Number of cells on node %i: %i (estimated load: %0.0f%% of mean)' % (s.rank, len(s.cells), 100*s.hostloads[s.rank]/s.hostloads[s.cellhosts].mean()))
     s.pc.barrier()
 
 
@@ -356,104 +477,65 @@ def createNetwork():
      
 
     ## Calculate distances and probabilities
-    if s.rank==0: print('Calculating connection probabilities (est. time: %i s)...' % (s.performance*s.cellsperhost**2/3e4))
-    conncalcstart = s.time() # See how long connecting the cells takes
-    s.nconnpars = 5 # Connection parameters: pre- and post- cell ID, weight, distances, delays
-    s.conndata = [[] for i in range(s.nconnpars)] # List for storing connections
-    nPostCells = 0
-    EDSCpre = [] # to keep track of EB5->EDSC connection and replicate in EB5->IDSC
-    for c in range(s.cellsperhost): # Loop over all postsynaptic cells on this host (has to be postsynaptic because of gid_connect)
-        gid = s.gidVec[c] # Increment global identifier       
-        if s.cellnames[gid] == 'PMd' or s.cellnames[gid] == 'ASC':
-            # There are no presynaptic connections for PMd or ASC.
-            continue
-        nPostCells += 1
-        if s.toroidal: 
-            xpath=(abs(s.xlocs-s.xlocs[gid]))**2
-            xpath2=(s.modelsize-abs(s.xlocs-s.xlocs[gid]))**2
-            xpath[xpath2<xpath]=xpath2[xpath2<xpath]
-            ypath=(abs(s.ylocs-s.ylocs[gid]))**2
-            ypath2=(s.modelsize-abs(s.ylocs-s.ylocs[gid]))**2
-            ypath[ypath2<ypath]=ypath2[ypath2<ypath]
-            zpath=(abs(s.zlocs-s.zlocs[gid]))**2
-            distances = sqrt(xpath + ypath) # Calculate all pairwise distances
-            distances3d = sqrt(xpath + ypath + zpath) # Calculate all pairwise 3d distances
-        else: 
-            distances = sqrt((s.xlocs-s.xlocs[gid])**2 + (s.ylocs-s.ylocs[gid])**2) # Calculate all pairwise distances
-            distances3d = sqrt((s.xlocs-s.xlocs[gid])**2 + (s.ylocs-s.ylocs[gid])**2 + (s.zlocs-s.zlocs[gid])**2) # Calculate all pairwise distances
-        allconnprobs = s.scaleconnprob[s.EorI,s.EorI[gid]] * s.connprobs[s.cellpops,s.cellpops[gid]] * exp(-distances/s.connfalloff[s.EorI]) # Calculate pairwise probabilities
-        allconnprobs[gid] = 0 # Prohibit self-connections using the cell's GID
-        seed(s.id32('%d'%(s.randseed+gid))) # Reset random number generator  
-        allrands = rand(s.ncells) # Create an array of random numbers for checking each connection  
-        if s.PMdinput == 'Plexon':
-            for c in xrange(s.popGidStart[s.PMd], s.popGidEnd[s.PMd] + 1):
-                allrands[c] = 1
-            if s.cellnames[gid] == 'ER5': # PMd->ER5 conn (full conn)
-                PMdId = (gid % s.server.numPMd) + s.ncells - s.server.numPMd #CHECK THIS!
-                allconnprobs[PMdId] = s.connprobs[s.PMd,s.ER5] # to make this connected to ER5
-                allrands[PMdId] = 0 # to make this connect to ER5
-                distances[PMdId] = 300 # to make delay 5 in conndata[3] 
-        makethisconnection = allconnprobs>allrands # Perform test to see whether or not this connection should be made
-        preids = array(makethisconnection.nonzero()[0],dtype='int') # Return True elements of that array for presynaptic cell IDs
-        if s.PMdinput == 'targetSplit' and s.cellnames[gid] == 'ER5': # PMds 0-47 -> ER5 0-47 ; PMds 48-95 -> ER5 48-95 
-            if gid < s.popGidStart[s.ER5] + s.popnumbers[s.ER5]/2:
-                prePMd = [(x - s.popGidStart[s.ER5])%(s.popnumbers[s.PMd]/2) + s.popGidStart[s.PMd] for x in range(gid, gid+1)] # input from 2 PMds  
-            else:
-                prePMd = [(x - s.popGidStart[s.ER5])%(s.popnumbers[s.PMd]/2) + s.popGidStart[s.PMd] + s.popnumbers[s.PMd]/2 for x in range(gid, gid+1)] # input from 2 PMds  
-            if array(prePMd).all() < s.popGidEnd[s.PMd]: 
-                #print 'prePMd=%d to ER5=%d:'%(prePMd[0],gid)
-                preids = concatenate([preids, prePMd])
-        if s.cellnames[gid] == 'EDSC': # save EDSC presyn cells to replicate in IDSC, and add inputs from IDSC
-            EDSCpre.append(array(preids)) # save EDSC presyn cells before adding IDSC input
-            invPops = [1, 0, 3, 2] # each postsyn ESDC cell will receive input from all the antagonistic muscle IDSCs
-            IDSCpre = [s.motorCmdCellRange[invPops[i]] - s.popGidStart[s.EDSC] + s.popGidStart[s.IDSC] for i in range(s.nMuscles) if gid in s.motorCmdCellRange[i]][0]
-            preids = concatenate([preids, IDSCpre]) # add IDSC presynaptic input to EDSC 
-        elif s.cellnames[gid] == 'IDSC': # use same presyn cells as for EDSC (antagonistic inhibition)
-            preids = array(EDSCpre.pop(0))
-        postids = array(gid+zeros(len(preids)),dtype='int') # Post-synaptic cell IDs
-        s.conndata[0].append(preids) # Append pre-cell ID
-        s.conndata[1].append(postids) # Append post-cell ID
-        s.conndata[2].append(distances[preids]) # Distances
-        s.conndata[3].append(s.mindelay + distances3d[preids]/float(s.velocity)) # Calculate the delays
-        wt1 = s.scaleconnweight[s.EorI[preids],s.EorI[postids]] # N weight scale factors -- WARNING, might be flipped
-        wt2 = s.connweights[s.cellpops[preids],s.cellpops[postids],:] # NxM inter-population weights
-        wt3 = s.receptorweight[:] # M receptor weights
-        finalweights = transpose(wt1*transpose(wt2*wt3)) # Multiply out population weights with receptor weights to get NxM matrix
-        s.conndata[4].append(finalweights) # Initialize weights to 0, otherwise get memory leaks
-    for pp in range(s.nconnpars): s.conndata[pp] = array(concatenate([s.conndata[pp][c] for c in range(nPostCells)])) # Turn pre- and post- cell IDs lists into vectors
-    s.nconnections = len(s.conndata[0]) # Find out how many connections we're going to make
+    if s.conncached:
+        if s.rank==0: print('Loading connections from connectivity cache (key %s)...' % s.conncachekey)
+        conncalcstart = s.time() # See how long loading the connections takes
+        connectivity.loadCachedConnections()
+    else:
+        if s.rank==0: print('Calculating connection probabilities (est. time: %i s)...' % (s.performance*s.cellsperhost**2/3e4))
+        conncalcstart = s.time() # See how long connecting the cells takes
+        s.conndata = [[] for i in range(s.nconnpars)] # List for storing connections
+        nPostCells = 0
+        EDSCpre = [] # to keep track of EB5->EDSC connection and replicate in EB5->IDSC
+        for c in range(s.cellsperhost): # Loop over all postsynaptic cells on this host (has to be postsynaptic because of gid_connect)
+            gid = s.gidVec[c] # Increment global identifier       
+            if s.cellartificial[gid]:
+                # There are no presynaptic connections for PMd or ASC.
+                continue
+            nPostCells += 1
+            preids = connectivity.connPreIds(gid) # Presynaptic cell IDs chosen by the distance-dependent rule
+            if s.PMdinput == 'targetSplit' and s.cellpops[gid] == s.ER5: # PMds 0-47 -> ER5 0-47 ; PMds 48-95 -> ER5 48-95 
+                if gid < s.popGidStart[s.ER5] + s.popnumbers[s.ER5]/2:
+                    prePMd = [(x - s.popGidStart[s.ER5])%(s.popnumbers[s.PMd]/2) + s.popGidStart[s.PMd] for x in range(gid, gid+1)] # input from 2 PMds  
+                else:
+                    prePMd = [(x - s.popGidStart[s.ER5])%(s.popnumbers[s.PMd]/2) + s.popGidStart[s.PMd] + s.popnumbers[s.PMd]/2 for x in range(gid, gid+1)] # input from 2 PMds  
+                if array(prePMd).all() < s.popGidEnd[s.PMd]: 
+                    #print 'prePMd=%d to ER5=%d:'%(prePMd[0],gid)
+                    preids = concatenate([preids, prePMd])
+            if s.cellpops[gid] == s.EDSC: # save EDSC presyn cells to replicate in IDSC, and add inputs from IDSC
+                EDSCpre.append(array(preids)) # save EDSC presyn cells before adding IDSC input
+                invPops = [1, 0, 3, 2] # each postsyn ESDC cell will receive input from all the antagonistic muscle IDSCs
+                IDSCpre = [s.motorCmdCellRange[invPops[i]] - s.popGidStart[s.EDSC] + s.popGidStart[s.IDSC] for i in range(s.nMuscles) if gid in s.motorCmdCellRange[i]][0]
+                preids = concatenate([preids, IDSCpre]) # add IDSC presynaptic input to EDSC 
+            elif s.cellpops[gid] == s.IDSC: # use same presyn cells as for EDSC (antagonistic inhibition)
+                if s.colocatearm or (s.placement == 'roundrobin' and len(s.cellhosts) == s.nhosts): preids = array(EDSCpre.pop(0))
+                else: preids = connectivity.connPreIds(gid - s.popGidStart[s.IDSC] + s.popGidStart[s.EDSC]) # EDSC cell with the same index may be on another host
+            postids = array(gid+zeros(len(preids)),dtype='int') # Post-synaptic cell IDs
+            distances, distances3d = connectivity.cellDistances(gid, preids) # Distances from each presynaptic cell
+            if s.PMdinput == 'Plexon' and s.cellpops[gid] == s.ER5:
+                distances[preids == (gid % s.server.numPMd) + s.ncells - s.server.numPMd] = 300 # to make delay 5 in conndata[3]
+            s.conndata[0].append(preids) # Append pre-cell ID
+            s.conndata[1].append(postids) # Append post-cell ID
+            s.conndata[2].append(distances) # Distances
+            s.conndata[3].append(s.mindelay + distances3d/float(s.velocity)) # Calculate the delays
+            wt1 = s.scaleconnweight[s.EorI[preids],s.EorI[postids]] # N weight scale factors -- WARNING, might be flipped
+            wt2 = s.connweights[s.cellpops[preids],s.cellpops[postids],:] # NxM inter-population weights
+            wt3 = s.receptorweight[:] # M receptor weights
+            finalweights = transpose(wt1*transpose(wt2*wt3)) # Multiply out population weights with receptor weights to get NxM matrix
+            s.conndata[4].append(finalweights) # Initialize weights to 0, otherwise get memory leaks
+        for pp in range(s.nconnpars): s.conndata[pp] = array(concatenate([s.conndata[pp][c] for c in range(nPostCells)])) # Turn pre- and post- cell IDs lists into vectors
+        if s.conncompact: s.conndata = connectivity.packConnections(s.conndata) # One structured array instead of 5 float arrays
+        if s.conncachedir != '': connectivity.saveConnCache() # Save for later runs with the same parameters
+    s.nconnections = connectivity.numConnections(s.conndata) # Find out how many connections we're going to make
     conncalctime = time()-conncalcstart # See how long it took
     if s.rank==0: print('  Done; time = %0.1f s' % conncalctime)
-
-
-    # set plastic connections based on plasConnsType (from evol alg)
-    if s.plastConnsType == 0:
-        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC]] # only spinal cord 
-    elif s.plastConnsType == 1:
-        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC], [s.ER2,s.ER5], [s.ER5,s.EB5], [s.ER2,s.EB5], [s.ER5,s.ER2]] # + L2-L5
-    elif s.plastConnsType == 2:
-        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC], [s.ER2,s.ER5], [s.ER5,s.EB5], [s.ER2,s.EB5], [s.ER5,s.ER2],\
-        [s.ER5,s.ER6], [s.ER6,s.ER5], [s.ER6,s.EB5]] # + L6
-    elif s.plastConnsType == 3:
-        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC], [s.ER2,s.ER5], [s.ER5,s.EB5], [s.ER2,s.EB5], [s.ER5,s.ER2],\
-         [s.ER5,s.ER6], [s.ER6,s.ER5], [s.ER6,s.EB5], \
-         [s.ER2,s.IL2], [s.ER2,s.IF2], [s.ER5,s.IL5], [s.ER5,s.IF5], [s.EB5,s.IL5], [s.EB5,s.IF5]] # + Inh
-    # same with additional plasticity between PMd->L5A
-    elif s.plastConnsType == 4: 
-        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC], [s.PMd,s.ER5]] # only spinal cord + pmd
-    elif s.plastConnsType == 5:
-        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC], [s.PMd,s.ER5], # spinal cord + pmd
-         [s.ER2,s.ER5], [s.ER5,s.EB5], [s.ER2,s.EB5], [s.ER5,s.ER2]] # + L2-L5
-    elif s.plastConnsType == 6:
-        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC], [s.PMd,s.ER5], # spinal cord + pmd
-        [s.ER2,s.ER5], [s.ER5,s.EB5], [s.ER2,s.EB5], [s.ER5,s.ER2], # + L2-L5
-        [s.ER5,s.ER6], [s.ER6,s.ER5], [s.ER6,s.EB5]] # + L6
-    elif s.plastConnsType == 7:
-        s.plastConns = [[s.ASC,s.ER2], [s.EB5,s.EDSC], [s.EB5,s.IDSC], [s.PMd,s.ER5], # spinal cord + pmd 
-        [s.ER2,s.ER5], [s.ER5,s.EB5], [s.ER2,s.EB5], [s.ER5,s.ER2], # + L2-L5
-        [s.ER5,s.ER6], [s.ER6,s.ER5], [s.ER6,s.EB5], # + L6
-        [s.ER2,s.IL2], [s.ER2,s.IF2], [s.ER5,s.IL5], [s.ER5,s.IF5], [s.EB5,s.IL5], [s.EB5,s.IF5]]  # + Inh
-
+    if s.rank==0 and s.conncompact: print('  Compact connection data on host 0: %0.1f MB' % (s.conndata.nbytes/1e6))
+    if s.rank==0 and s.conncachedir != '': print('  Connectivity cache %s (%s)' % ('hit: loaded in %0.2f s' % conncalctime if s.conncached else 'miss: saved for later runs', s.conncachedir))
+    if s.rank==0 and not s.conncached and s.connmethod == 'sampled' and s.conncomparecells > 0: # Compare degree statistics with the Bernoulli rule
+        comparegids = []
+        for pop in range(s.npops):
+            if pop not in [s.PMd, s.ASC]: comparegids.extend([s.gidVec[c] for c in s.popLocalIds[pop][:s.conncomparecells]])
+        connectivity.compareDegrees(comparegids)
 
 
     ## Actually make connections
@@ -466,45 +548,226 @@ def createNetwork():
         s.stdpmechs = [] # Initialize array for STDP mechanisms
         s.precons = [] # Initialize array for presynaptic spike counters
         s.pstcons = [] # Initialize array for postsynaptic spike counters
-    for con in range(s.nconnections): # Loop over each connection
-        pregid = s.conndata[0][con] # GID of presynaptic cell    
-        pstgid = s.conndata[1][con] # Index of postsynaptic cell
-        pstid = s.gidDic[pstgid]# Index of postynaptic cell -- convert from GID to local
-        newcon = s.pc.gid_connect(pregid, s.cells[pstid]) # Create a connection
-        newcon.delay = s.conndata[3][con] # Set delay
-        for r in range(s.nreceptors): newcon.weight[r] = s.conndata[4][con][r] # Set weight of connection
-        s.connlist.append(newcon) # Connect the two cells
-        if s.usestdp and ([s.cellpops[pregid],s.cellpops[pstgid]] in s.plastConns): # If using STDP and these pops are set to be plastic connections
-            if sum(abs(s.stdprates[s.EorI[pregid],:]))>0 or sum(abs(s.RLrates[s.EorI[pregid],:]))>0: # Don't create an STDP connection if the learning rates are zero
-                for r in range(s.nreceptors): # Need a different STDP instances for each receptor
-                    if newcon.weight[r]>0: # Only make them for nonzero connections
-                        stdpmech = h.STDP(0,sec=s.dummies[pstid]) # Create STDP adjuster
-                        stdpmech.hebbwt = s.stdprates[s.EorI[pregid],0] # Potentiation rate
-                        stdpmech.antiwt = s.stdprates[s.EorI[pregid],1] # Depression rate
-                        stdpmech.wmax = s.maxweight # Maximum synaptic weight
-                        precon = s.pc.gid_connect(pregid,stdpmech); precon.weight[0] = 1 # Send presynaptic spikes to the STDP adjuster
-                        pstcon = s.pc.gid_connect(pstgid,stdpmech); pstcon.weight[0] = -1 # Send postsynaptic spikes to the STDP adjuster
-                        h.setpointer(s.connlist[-1]._ref_weight[r],'synweight',stdpmech) # Associate the STDP adjuster with this weight
-                        s.stdpmechs.append(stdpmech) # Save STDP adjuster
-                        s.precons.append(precon) # Save presynaptic spike source
-                        s.pstcons.append(pstcon) # Save postsynaptic spike source
-                        s.stdpconndata.append([pregid,pstgid,r]) # Store presynaptic cell ID, postsynaptic, and receptor
-                        if s.verbose: stdpmech.verbose = 1
-                        if s.useRL: # using RL
-                            stdpmech.RLon = 1 # make sure RL is on
-                            stdpmech.RLhebbwt = s.RLrates[s.EorI[pregid],0] # Potentiation rate
-                            stdpmech.RLantiwt = s.RLrates[s.EorI[pregid],1] # Depression rate
-                            stdpmech.tauhebb = stdpmech.tauanti = s.stdpwin # stdp time constant(ms)
-                            stdpmech.RLwindhebb = stdpmech.RLwindhebb = s.eligwin # RL eligibility trace window length (ms)
-                            stdpmech.useRLexp = s.useRLexp # RL 
-                            stdpmech.softthresh = s.useRLsoft # RL soft-thresholding
-                        else:
-                            stdpmech.RLon = 0 # make sure RL is off
+    conndata = connectivity.unpackConnections(s.conndata) # Pre, post, distances, delays, weights
+    if s.bulkconnect: makeConnectionsBulk(conndata) # A few hoc calls instead of one Python iteration per connection
+    else:
+        for con in range(s.nconnections): # Loop over each connection
+            pregid = conndata[0][con] # GID of presynaptic cell    
+            pstgid = conndata[1][con] # Index of postsynaptic cell
+            pstid = s.gidDic[pstgid]# Index of postynaptic cell -- convert from GID to local
+            newcon = s.pc.gid_connect(pregid, s.cells[pstid]) # Create a connection
+            newcon.delay = conndata[3][con] # Set delay
+            for r in range(s.nreceptors): newcon.weight[r] = conndata[4][con][r] # Set weight of connection
+            s.connlist.append(newcon) # Connect the two cells
+            if s.usestdp and not s.stdpvec and ([s.cellpops[pregid],s.cellpops[pstgid]] in s.plastConns): # If using STDP and these pops are set to be plastic connections
+                if sum(abs(s.stdprates[s.EorI[pregid],:]))>0 or sum(abs(s.RLrates[s.EorI[pregid],:]))>0: # Don't create an STDP connection if the learning rates are zero
+                    for r in range(s.nreceptors): # Need a different STDP instances for each receptor
+                        if newcon.weight[r]>0: # Only make them for nonzero connections
+                            stdpmech = h.STDP(0,sec=s.dummies[pstid]) # Create STDP adjuster
+                            stdpmech.hebbwt = s.stdprates[s.EorI[pregid],0] # Potentiation rate
+                            stdpmech.antiwt = s.stdprates[s.EorI[pregid],1] # Depression rate
+                            stdpmech.wmax = s.maxweight # Maximum synaptic weight
+                            precon = s.pc.gid_connect(pregid,stdpmech); precon.weight[0] = 1 # Send presynaptic spikes to the STDP adjuster
+                            pstcon = s.pc.gid_connect(pstgid,stdpmech); pstcon.weight[0] = -1 # Send postsynaptic spikes to the STDP adjuster
+                            h.setpointer(s.connlist[-1]._ref_weight[r],'synweight',stdpmech) # Associate the STDP adjuster with this weight
+                            s.stdpmechs.append(stdpmech) # Save STDP adjuster
+                            s.precons.append(precon) # Save presynaptic spike source
+                            s.pstcons.append(pstcon) # Save postsynaptic spike source
+                            s.stdpconndata.append([pregid,pstgid,r]) # Store presynaptic cell ID, postsynaptic, and receptor
+                            if s.verbose: stdpmech.verbose = 1
+                            if s.useRL: # using RL
+                                stdpmech.RLon = 1 # make sure RL is on
+                                stdpmech.RLhebbwt = s.RLrates[s.EorI[pregid],0] # Potentiation rate
+                                stdpmech.RLantiwt = s.RLrates[s.EorI[pregid],1] # Depression rate
+                                stdpmech.tauhebb = stdpmech.tauanti = s.stdpwin # stdp time constant(ms)
+                                stdpmech.RLwindhebb = stdpmech.RLwindhebb = s.eligwin # RL eligibility trace window length (ms)
+                                stdpmech.useRLexp = s.useRLexp # RL 
+                                stdpmech.softthresh = s.useRLsoft # RL soft-thresholding
+                            else:
+                                stdpmech.RLon = 0 # make sure RL is off
+    if s.usestdp and s.stdpvec: makeSTDPVec(conndata) # One STDPVEC per postsynaptic cell instead of one STDP per plastic synapse
                  
     s.nstdpconns = len(s.stdpconndata) # Get number of STDP connections
     conntime = time()-connstart # See how long it took
     if s.usestdp: print('  Number of STDP connections on host %i: %i' % (s.rank, s.nstdpconns))
-    if s.rank==0: print('  Done; time = %0.1f s' % conntime)
+    if s.rank==0: print('  Done; time = %0.1f s (%0.0f connections/s on host 0)' % (conntime, s.nconnections/max(conntime,1e-9)))
+
+
+###############################################################################
+### Make connections in bulk
+###############################################################################
+def makeConnectionsBulk(conndata):
+    ## Define hoc procedures that loop over all connections (and STDP adjusters) of this host
+    if not h.name_declared('bulkconnect'):
+        h('''
+            // $o1 ParallelContext, $o2 List of local cells, $o3 Vector of presynaptic gids, $o4 Vector of local postsynaptic ids, $o5 Vector of delays,
+            // $o6 Vector of weights ($7 receptors per connection), $o8 List to which the NetCons are appended
+            proc bulkconnect() { local i, r  localobj nc
+                for i=0, $o3.size-1 {
+                    nc = $o1.gid_connect($o3.x[i], $o2.o($o4.x[i]))
+                    nc.delay = $o5.x[i]
+                    for r=0, $7-1 nc.weight[r] = $o6.x[i*$7+r]
+                    $o8.append(nc)
+                }
+            }
+
+            // $o1 ParallelContext, $o2 List of NetCons, $o3 List of SectionRefs of local cells,
+            // $o4 List of Vectors with one entry per STDP adjuster: connection index, receptor, presynaptic gid, postsynaptic gid, local postsynaptic id, hebbwt, antiwt, RLhebbwt, RLantiwt
+            // $o5 Vector of common parameters: wmax, RLon, tauhebb/tauanti, RLwindhebb, useRLexp, softthresh, verbose
+            // $o6, $o7, $o8 Lists to which the STDP adjusters and presynaptic and postsynaptic NetCons are appended
+            proc bulkstdp() { local i, r  localobj stdp, precon, pstcon, nc
+                for i=0, $o4.o(0).size-1 {
+                    $o3.o($o4.o(4).x[i]).sec stdp = new STDP(0)
+                    stdp.hebbwt = $o4.o(5).x[i]
+                    stdp.antiwt = $o4.o(6).x[i]
+                    stdp.wmax = $o5.x[0]
+                    precon = $o1.gid_connect($o4.o(2).x[i], stdp)  precon.weight[0] = 1
+                    pstcon = $o1.gid_connect($o4.o(3).x[i], stdp)  pstcon.weight[0] = -1
+                    nc = $o2.o($o4.o(0).x[i])
+                    r = $o4.o(1).x[i]
+                    setpointer stdp.synweight, nc.weight[r]
+                    if ($o5.x[6]) stdp.verbose = 1
+                    if ($o5.x[1]) {
+                        stdp.RLon = 1
+                        stdp.RLhebbwt = $o4.o(7).x[i]
+                        stdp.RLantiwt = $o4.o(8).x[i]
+                        stdp.tauhebb = stdp.tauanti = $o5.x[2]
+                        stdp.RLwindhebb = $o5.x[3]
+                        stdp.useRLexp = $o5.x[4]
+                        stdp.softthresh = $o5.x[5]
+                    } else {
+                        stdp.RLon = 0
+                    }
+                    $o6.append(stdp)
+                    $o7.append(precon)
+                    $o8.append(pstcon)
+                }
+            }
+        ''')
+
+    ## Create the connections
+    pregids = array(conndata[0], dtype='int') # GIDs of presynaptic cells
+    pstgids = array(conndata[1], dtype='int') # GIDs of postsynaptic cells
+    localids = -ones(s.ncells, dtype='int') # Local id of each gid on this host
+    localids[s.gidVec] = range(len(s.gidVec))
+    pstids = localids[pstgids] # Local ids of postsynaptic cells
+    weights = array(conndata[4]).reshape(len(pregids), s.nreceptors)
+    cells = h.List()
+    for cell in s.cells: cells.append(cell)
+    netcons = h.List()
+    h.bulkconnect(s.pc, cells, h.Vector(pregids), h.Vector(pstids), h.Vector(conndata[3]), h.Vector(weights.ravel()), s.nreceptors, netcons)
+    s.connlist = [netcon for netcon in netcons]
+    if not s.usestdp or s.stdpvec: return
+
+    ## Create the STDP adjusters
+    cons, receptors = plasticSynapses(conndata)
+    EorI = s.EorI[pregids[cons]]
+    stdpvecs = h.List()
+    for vec in [cons, receptors, pregids[cons], pstgids[cons], pstids[cons], s.stdprates[EorI,0], s.stdprates[EorI,1], s.RLrates[EorI,0], s.RLrates[EorI,1]]: stdpvecs.append(h.Vector(vec))
+    stdppars = h.Vector([s.maxweight, int(s.useRL), s.stdpwin, s.eligwin, s.useRLexp, s.useRLsoft, int(s.verbose > 0)])
+    sections = h.List()
+    for dummy in s.dummies: sections.append(h.SectionRef(sec=dummy))
+    stdpmechs, precons, pstcons = h.List(), h.List(), h.List()
+    h.bulkstdp(s.pc, netcons, sections, stdpvecs, stdppars, stdpmechs, precons, pstcons)
+    s.stdpmechs = [stdpmech for stdpmech in stdpmechs]
+    s.precons = [precon for precon in precons]
+    s.pstcons = [pstcon for pstcon in pstcons]
+    s.stdpconndata = transpose([pregids[cons], pstgids[cons], receptors]).tolist() # Presynaptic cell ID, postsynaptic, and receptor
+
+
+## Connection index and receptor of each plastic synapse: one per nonzero receptor weight of connections between plastic populations with nonzero learning rates
+def plasticSynapses(conndata):
+    pregids = array(conndata[0], dtype='int') # GIDs of presynaptic cells
+    pstgids = array(conndata[1], dtype='int') # GIDs of postsynaptic cells
+    weights = array(conndata[4]).reshape(len(pregids), s.nreceptors)
+    isplastic = zeros((s.npops, s.npops), dtype='bool') # Whether each population pair is plastic
+    for prepop, pstpop in s.plastConns: isplastic[prepop, pstpop] = True
+    hasrates = (abs(s.stdprates).sum(1) > 0) | (abs(s.RLrates).sum(1) > 0) # Whether E and I presynaptic cells have nonzero learning rates
+    plasticconns = isplastic[s.cellpops[pregids], s.cellpops[pstgids]] & hasrates[s.EorI[pregids]]
+    return (plasticconns[:,None] & (weights > 0)).nonzero() # Same order as one loop over connections and receptors
+
+
+## Create one STDPVEC adjuster per postsynaptic cell holding all its plastic synapses, after the NetCons in s.connlist
+def makeSTDPVec(conndata):
+    cons, receptors = plasticSynapses(conndata)
+    pregids = array(conndata[0], dtype='int')[cons] # GIDs of presynaptic cells of each plastic synapse
+    pstgids = array(conndata[1], dtype='int')[cons] # GIDs of postsynaptic cells of each plastic synapse
+    s.stdpmechs = [] # One STDPVEC per postsynaptic cell
+    s.precons = [] # One presynaptic NetCon per plastic synapse
+    s.pstcons = [] # One postsynaptic NetCon per postsynaptic cell
+    s.stdpsynids = [] # STDPVEC id and synapse index of each plastic synapse
+    stdpvecs = {} # key = postsynaptic gid; value = STDPVEC
+    for ps in range(len(cons)):
+        pregid, pstgid, r = pregids[ps], pstgids[ps], receptors[ps]
+        if pstgid not in stdpvecs:
+            stdpmech = h.STDPVEC(0,sec=s.dummies[s.gidDic[pstgid]]) # Create STDP adjuster of this cell
+            stdpmech.wmax = s.maxweight # Maximum synaptic weight
+            if s.verbose: stdpmech.verbose = 1
+            if s.useRL: # using RL
+                stdpmech.RLon = 1 # make sure RL is on
+                stdpmech.tauhebb = stdpmech.tauanti = s.stdpwin # stdp time constant(ms)
+                stdpmech.RLwindhebb = s.eligwin # RL eligibility trace window length (ms)
+                stdpmech.useRLexp = s.useRLexp # RL 
+                stdpmech.softthresh = s.useRLsoft # RL soft-thresholding
+            else:
+                stdpmech.RLon = 0 # make sure RL is off
+            pstcon = s.pc.gid_connect(pstgid,stdpmech); pstcon.weight[0] = -1 # Send postsynaptic spikes to the STDP adjuster
+            s.stdpmechs.append(stdpmech)
+            s.pstcons.append(pstcon)
+            stdpvecs[pstgid] = stdpmech
+        stdpmech = stdpvecs[pstgid]
+        index = stdpmech.addsyn(s.connlist[cons[ps]]._ref_weight[r], s.stdprates[s.EorI[pregid],0], s.stdprates[s.EorI[pregid],1], s.RLrates[s.EorI[pregid],0], s.RLrates[s.EorI[pregid],1]) # Weight, potentiation and depression rates (STDP and RL)
+        precon = s.pc.gid_connect(pregid,stdpmech); precon.weight[0] = index # Send presynaptic spikes to the STDP adjuster, tagged with the synapse index
+        s.precons.append(precon)
+        s.stdpsynids.append([stdpmech.id, index])
+    s.stdpsyns = transpose([cons, receptors]).tolist() # Connection index and receptor of each plastic synapse
+    s.stdpconndata = transpose([pregids, pstgids, receptors]).tolist() # Presynaptic cell ID, postsynaptic, and receptor
+
+
+## Current weight of plastic synapse ps
+def stdpWeight(ps):
+    if s.stdpvec: return s.connlist[s.stdpsyns[ps][0]].weight[s.stdpsyns[ps][1]]
+    return s.stdpmechs[ps].synweight
+
+
+## Set the weight of plastic synapse ps
+def setStdpWeight(ps, weight):
+    if s.stdpvec: s.connlist[s.stdpsyns[ps][0]].weight[s.stdpsyns[ps][1]] = weight
+    else: s.stdpmechs[ps].synweight = weight
+
+
+## Start the log of weight changes of the plastic synapses on this host with their current weights; rows are (plastic synapse, time of save, weight)
+def setupWeightLog():
+    if s.stdpvec: ids, syns = array(s.stdpsynids, dtype='int').reshape(-1,2).T # STDPVEC id and synapse index
+    else: ids, syns = array([stdpmech.id for stdpmech in s.stdpmechs], dtype='int'), zeros(s.nstdpconns, dtype='int') # One STDP per plastic synapse
+    s.stdpkeystride = syns.max()+1 if s.nstdpconns else 1
+    keys = ids*s.stdpkeystride + syns # Key of each plastic synapse in the dirtyweights() readout
+    s.stdpkeyorder = argsort(keys) # Plastic synapse of each sorted key
+    s.stdpsortedkeys = keys[s.stdpkeyorder]
+    s.dirtyvecs = [h.Vector() for i in range(3)] # Ids, synapse indexes and weights filled by dirtyweights()
+    if len(s.stdpmechs): s.stdpmechs[0].dirtyweights(*s.dirtyvecs) # Clear the flags of changes before this run
+    s.lastweights = array([stdpWeight(ps) for ps in range(s.nstdpconns)]) # Last saved weight of each plastic synapse
+    s.weightlog = zeros((max(2*s.nstdpconns, 1024), 3)) # Preallocated, doubled when full
+    s.weightlog[:s.nstdpconns,0] = arange(s.nstdpconns)
+    s.weightlog[:s.nstdpconns,2] = s.lastweights # Time of save 0 = initial
+    s.nweightlog = s.nstdpconns
+
+
+## Append the weights that changed since the last save to the weight log, reading only the synapses flagged by the STDP mechanisms
+def logWeightChanges(t):
+    if len(s.stdpmechs) == 0: return
+    s.stdpmechs[0].dirtyweights(*s.dirtyvecs) # All STDP (or STDPVEC) instances on this host
+    ids, syns, weights = [array(vec) for vec in s.dirtyvecs]
+    pss = s.stdpkeyorder[searchsorted(s.stdpsortedkeys, ids.astype('int')*s.stdpkeystride + syns.astype('int'))] # Plastic synapse of each flagged weight
+    changed = weights != s.lastweights[pss] # Only store weights that differ from the last save
+    pss, weights = pss[changed], weights[changed]
+    s.lastweights[pss] = weights
+    n = s.nweightlog + len(pss)
+    if n > len(s.weightlog): s.weightlog = concatenate((s.weightlog, zeros((max(n, 2*len(s.weightlog)) - len(s.weightlog), 3))))
+    s.weightlog[s.nweightlog:n,0] = pss
+    s.weightlog[s.nweightlog:n,1] = t
+    s.weightlog[s.nweightlog:n,2] = weights
+    s.nweightlog = n
 
 
 ###############################################################################
@@ -580,50 +843,48 @@ def addBackground():
     if s.savebackground:
         s.backgroundspikevecs=[] # A list for storing actual cell voltages (WARNING, slow!)
         s.backgroundrecorders=[] # And for recording spikes
-    for c in range(s.cellsperhost): 
+    for c in s.izhiLocalIds: # ASC and PMd won't receive background stimulations
         gid = s.gidVec[c]
-        if s.cellnames[gid] == 'ASC' or s.cellnames[gid] == 'PMd' : # These pops won't receive background stimulations.
-            pass
+        pop = s.cellpops[gid]
+        backgroundrand = h.Random()
+        backgroundrand.MCellRan4(gid,gid*2)
+        backgroundrand.negexp(1)
+        s.backgroundrands.append(backgroundrand)
+        if pop == s.EDSC or pop == s.IDSC:
+            backgroundsource = h.NSLOC() # Create a NSLOC  
+            backgroundsource.interval = s.backgroundrateMin**-1*1e3 # Take inverse of the frequency and then convert from Hz^-1 to ms
+            backgroundsource.noise = 0.3 # Fractional noise in timing
+        elif pop == s.EB5:
+            backgroundsource = h.NSLOC() # Create a NSLOC  
+            backgroundsource.interval = s.backgroundrate**-1*1e3 # Take inverse of the frequency and then convert from Hz^-1 to ms
+            backgroundsource.noise = s.backgroundnoise # Fractional noise in timing
         else:
-            backgroundrand = h.Random()
-            backgroundrand.MCellRan4(gid,gid*2)
-            backgroundrand.negexp(1)
-            s.backgroundrands.append(backgroundrand)
-            if s.cellnames[gid] == 'EDSC' or s.cellnames[gid] == 'IDSC':
-                backgroundsource = h.NSLOC() # Create a NSLOC  
-                backgroundsource.interval = s.backgroundrateMin**-1*1e3 # Take inverse of the frequency and then convert from Hz^-1 to ms
-                backgroundsource.noise = 0.3 # Fractional noise in timing
-            elif s.cellnames[gid] == 'EB5':
-                backgroundsource = h.NSLOC() # Create a NSLOC  
-                backgroundsource.interval = s.backgroundrate**-1*1e3 # Take inverse of the frequency and then convert from Hz^-1 to ms
-                backgroundsource.noise = s.backgroundnoise # Fractional noise in timing
-            else:
-                backgroundsource = h.NetStim() # Create a NetStim
-                backgroundsource.interval = s.backgroundrate**-1*1e3 # Take inverse of the frequency and then convert from Hz^-1 to ms
-                backgroundsource.noiseFromRandom(backgroundrand) # Set it to use this random number generator
-                backgroundsource.noise = s.backgroundnoise # Fractional noise in timing
-
-            backgroundsource.number = s.backgroundnumber # Number of spikes
-            s.backgroundsources.append(backgroundsource) # Save this NetStim
-            s.backgroundgid.append(gid) # append cell gid associated to this netstim
-            
-            backgroundconn = h.NetCon(backgroundsource, s.cells[c]) # Connect this noisy input to a cell
-            for r in range(s.nreceptors): backgroundconn.weight[r]=0 # Initialize weights to 0, otherwise get memory leaks
-            if s.cellnames[gid] == 'EDSC' or s.cellnames[gid] == 'IDSC':
-                backgroundconn.weight[s.backgroundreceptor] = s.backgroundweightExplor # Specify the weight for the EDSC, IDSC and PMd background input
-            elif s.cellnames[gid] == 'EB5' and s.explorMovs == 2: 
-                backgroundconn.weight[s.backgroundreceptor] = s.backgroundweightExplor # Weight for EB5 input if explor movs via EB5 
-            else:
-                backgroundconn.weight[s.backgroundreceptor] = s.backgroundweight[s.EorI[gid]] # Specify the weight -- 1 is NMDA receptor for smoother, more summative activation
-            backgroundconn.delay=2 # Specify the delay in ms -- shouldn't make a spot of difference
-            s.backgroundconns.append(backgroundconn) # Save this connnection
+            backgroundsource = h.NetStim() # Create a NetStim
+            backgroundsource.interval = s.backgroundrate**-1*1e3 # Take inverse of the frequency and then convert from Hz^-1 to ms
+            backgroundsource.noiseFromRandom(backgroundrand) # Set it to use this random number generator
+            backgroundsource.noise = s.backgroundnoise # Fractional noise in timing
+
+        backgroundsource.number = s.backgroundnumber # Number of spikes
+        s.backgroundsources.append(backgroundsource) # Save this NetStim
+        s.backgroundgid.append(gid) # append cell gid associated to this netstim
         
-            if s.savebackground:
-                backgroundspikevec = h.Vector() # Initialize vector
-                s.backgroundspikevecs.append(backgroundspikevec) # Keep all those vectors
-                backgroundrecorder = h.NetCon(backgroundsource, None)
-                backgroundrecorder.record(backgroundspikevec) # Record simulation time
-                s.backgroundrecorders.append(backgroundrecorder)
+        backgroundconn = h.NetCon(backgroundsource, s.cells[c]) # Connect this noisy input to a cell
+        for r in range(s.nreceptors): backgroundconn.weight[r]=0 # Initialize weights to 0, otherwise get memory leaks
+        if pop == s.EDSC or pop == s.IDSC:
+            backgroundconn.weight[s.backgroundreceptor] = s.backgroundweightExplor # Specify the weight for the EDSC, IDSC and PMd background input
+        elif pop == s.EB5 and s.explorMovs == 2: 
+            backgroundconn.weight[s.backgroundreceptor] = s.backgroundweightExplor # Weight for EB5 input if explor movs via EB5 
+        else:
+            backgroundconn.weight[s.backgroundreceptor] = s.backgroundweight[s.EorI[gid]] # Specify the weight -- 1 is NMDA receptor for smoother, more summative activation
+        backgroundconn.delay=2 # Specify the delay in ms -- shouldn't make a spot of difference
+        s.backgroundconns.append(backgroundconn) # Save this connnection
+    
+        if s.savebackground:
+            backgroundspikevec = h.Vector() # Initialize vector
+            s.backgroundspikevecs.append(backgroundspikevec) # Keep all those vectors
+            backgroundrecorder = h.NetCon(backgroundsource, None)
+            backgroundrecorder.record(backgroundspikevec) # Record simulation time
+            s.backgroundrecorders.append(backgroundrecorder)
     print('  Number created on host %i: %i' % (s.rank, len(s.backgroundsources)))
     s.pc.barrier()
 
@@ -639,26 +900,24 @@ def setupSim():
 
     # Initialize STDP -- just for recording
     if s.usestdp:
-        s.weightchanges = []
         if s.rank==0: print('\nSetting up STDP...')
-        if s.usestdp:
-            s.weightchanges = [[] for ps in range(s.nstdpconns)] # Create an empty list for each STDP connection -- warning, slow with large numbers of connections!
-        for ps in range(s.nstdpconns): s.weightchanges[ps].append([0, s.stdpmechs[ps].synweight]) # Time of save (0=initial) and the weight
+        setupWeightLog() # Initial weight of each STDP connection
 
 
     ## Set up LFP recording
     s.lfptime = [] # List of times that the LFP was recorded at
     s.nlfps = len(s.lfppops) # Number of distinct LFPs to calculate
     s.hostlfps = [] # Voltages for calculating LFP
-    s.lfpcellids = [[] for pop in range(s.nlfps)] # Create list of lists of cell IDs
-    for c in range(s.cellsperhost): # Loop over each cell and decide which LFP population, if any, it belongs to
-        gid = s.gidVec[c] # Get this cell's GID
-        if s.cellnames[gid] == 'ASC' or s.cellnames[gid] == 'PMd': # 'ER2' won't be fired by background stimulations.
-                continue 
-        for pop in range(s.nlfps): # Loop over each LFP population
-            thispop = s.cellpops[gid] # Population of this cell
-            if sum(s.lfppops[pop]==thispop)>0: # There's a match
-                s.lfpcellids[pop].append(gid) # Flag this cell as belonging to this LFP population
+    s.lfpvecs = [[] for pop in range(s.nlfps)] # Create list of lists of voltage vectors
+    if s.savelfps:
+        lfpdt = s.lfpdt if s.lfpdt > 0 else s.loopstep # Sampling interval, following loopstep by default
+        s.lfptimevec = h.Vector() # Sample times, so hosts without LFP cells know the number of samples
+        s.lfptimevec.record(h._ref_t, lfpdt)
+        for pop in range(s.nlfps): # Loop over each LFP population and record the voltages of the local cells belonging to it
+            lfplocalids = sort(concatenate([s.popLocalIds[lfppop] for lfppop in s.lfppops[pop]])) # Local ids in local order
+            for c in lfplocalids:
+                s.lfpvecs[pop].append(h.Vector())
+                s.lfpvecs[pop][-1].record(s.cells[c]._ref_V, lfpdt) # Sampled every lfpdt, summed in finalizeSim()
 
 
     ## Set up raw recording
@@ -667,10 +926,7 @@ def setupSim():
         if s.rank==0: print('\nSetting up raw recording...')
         s.nquantities = 5 # Number of variables from each cell to record from
         # Later this part should be modified because NSLOC doesn't have V, u and I.
-        for c in range(s.cellsperhost):
-            gid = s.gidVec[c] # Get this cell's GID
-            if s.cellnames[gid] == 'ASC' or s.cellnames[gid] == 'PMd': # NSLOC doesn't have V, u and I
-                continue 
+        for c in s.izhiLocalIds: # NSLOC doesn't have V, u and I
             recvecs = [h.Vector() for q in range(s.nquantities)] # Initialize vectors
             recvecs[0].record(h._ref_t) # Record simulation time
             recvecs[1].record(s.cells[c]._ref_V) # Record cell voltage
@@ -760,7 +1016,7 @@ def setupSim():
 def runSim():
     if s.rank == 0:
         print('\nRunning...')
-        runstart = time() # See how long the run takes
+    s.runstart = time() # See how long the run takes
 
     # set cache_efficient on
     h('objref cvode')
@@ -768,72 +1024,37 @@ def runSim():
     h.cvode.cache_efficient(1)
 
     s.pc.set_maxstep(10) # MPI: Set the maximum integration time in ms -- not very important
+    if s.runmode == 'loop': runLoop()
+    elif s.runmode == 'events': runEvents()
+    else: raise Exception('Undefined runmode "%s"' % s.runmode) # No match? Cause an error
+                
+    if s.rank==0: 
+        s.runtime = time()-s.runstart # See how long it took
+        print('  Done; run time = %0.1f s; real-time ratio: %0.2f.' % (s.runtime, s.duration/1000/s.runtime))
+    if s.useArm != 'None': s.arm.reportComm(s)
+    s.pc.barrier() # Wait for all hosts to get to this point
+
+
+## Run in chunks of loopstep ms, with the progress, weight saves and virtual arm after each chunk (runmode 'loop')
+def runLoop():
     init() # Initialize the simulation
+    if s.checkpoint is not None: restoreCheckpoint() # Continue from the checkpoint loaded by loadCheckpoint(resume=True)
 
+    tstep = h.t # nominal time at the end of each chunk, since h.t accumulates rounding errors
     while round(h.t) < s.duration:
-        run(min(s.duration,h.t+s.loopstep)) # MPI: Get ready to run the simulation (it isn't actually run until pc.runworker() is called I think)
-        if s.server.simMode == 0:
-            if s.rank==0 and (round(h.t) % s.progupdate)==0: print('  t = %0.1f s (%i%%; time consumed: %0.1f s)' % (h.t/1e3, int(h.t/s.duration*100), (time()-runstart)))
+        tstep = min(s.duration,tstep+s.loopstep)
+        run(tstep) # MPI: Get ready to run the simulation (it isn't actually run until pc.runworker() is called I think)
+        if s.PMdinput != 'Plexon' or s.server.simMode == 0:
+            if (round(h.t) % s.progupdate)==0: printProgress(h.t)
         else:
-            if s.rank==0: print('  t = %0.1f s (%i%%; time consumed: %0.1f s)' % (h.t/1e3, int(h.t/s.duration*100), (time()-runstart)))
-
-        # Calculate LFP -- WARNING, need to think about how to optimize
-        if s.savelfps:
-            s.lfptime.append(h.t) # Append current time
-            tmplfps = zeros((s.nlfps)) # Create empty array for storing LFP voltages
-            for pop in range(s.nlfps):
-                for c in range(len(s.lfpcellids[pop])):
-                    id = s.gidDic[s.lfpcellids[pop][c]]# Index of postynaptic cell -- convert from GID to local
-                    tmplfps[pop] += s.cells[id].V # Add voltage to LFP estimate
-                if s.verbose:
-                    if s.server.Manager.ns.isnan(tmplfps[pop]) or s.server.Manager.ns.isinf(tmplfps[pop]):
-                        print "Nan or inf"
-            s.hostlfps.append(tmplfps) # Add voltages
-
-        # Periodic weight saves
-        if s.usestdp: 
-            timesincelastsave = h.t - s.timeoflastsave
-            if timesincelastsave >= s.timebetweensaves:
-                s.timeoflastsave = h.t
-                #if s.rank == 0: print 'Recording weight changes at time ', h.t
-                for ps in range(s.nstdpconns):
-                    if s.stdpmechs[ps].synweight != s.weightchanges[ps][-1][-1]: # Only store connections that changed; [ps] = this connection; [-1] = last entry; [-1] = weight
-                        s.weightchanges[ps].append([s.timeoflastsave, s.stdpmechs[ps].synweight])
-                       
-        ## Virtual arm 
-        if s.useArm != 'None':
-            armStart = time()
-            s.arm.run(h.t, s) # run virtual arm apparatus (calculate command, move arm, feedback)
-            if s.useRL and (h.t - s.timeoflastRL >= s.RLinterval): # if time for next RL
-                s.timeoflastRL = h.t
-                vec = h.Vector()
-                if s.rank == 0:
-                    critic = s.arm.RLcritic(h.t) # get critic signal (-1, 0 or 1)
-                    s.pc.broadcast(vec.from_python([critic]), 0) # convert python list to hoc vector for broadcast data received from arm
-                    #print critic
-                else: # other workers
-                    s.pc.broadcast(vec, 0)
-                    critic = vec.to_python()[0]
-                if critic != 0: # if critic signal indicates punishment (-1) or reward (+1)
-                    for stdp in s.stdpmechs: # for all connections in stdp conn list
-                        #print 'stdp_before: ', stdp.synweight
-                        stdp.reward_punish(float(critic)) # run stds.mod method to update syn weights based on RL
-                        #print stdp.tlastpre
-                        #print stdp.tlastpost
-                        #stdp.adjustweight(float(0.5))
-                        #sleep(0.001)
-                        #print 'stdp_after: ', stdp.synweight
-            # Synaptic scaling?
-        
-            #print(' Arm time = %0.4f s') % (time() - armStart)
+            printProgress(h.t)
+
+        runStep(tstep)
 
         ## Time adjustment for online mode simulation
         if s.PMdinput == 'Plexon' and s.server.simMode == 1:                   
             # To avoid izhi cell's over shooting when h.t moves forward because sim is slow.
-            for c in range(s.cellsperhost): 
-                gid = s.gidVec[c]
-                if s.cellnames[gid] == 'PMd': # 'PMds don't have t0 variable.
-                    continue
+            for c in s.izhiLocalIds: # PMd and ASC (NSLOC) don't have t0 variable.
                 s.cells[c].t0 = s.server.newCurrTime.value - h.dt             
             dtSave = h.dt # save original dt
             h.dt = s.server.newCurrTime.value - h.t # new dt
@@ -844,11 +1065,65 @@ def runSim():
             if active != 0:
                 h.cvode.active(1)         
             h.dt = dtSave # Restore orignal dt   
-                
-    if s.rank==0: 
-        s.runtime = time()-runstart # See how long it took
-        print('  Done; run time = %0.1f s; real-time ratio: %0.2f.' % (s.runtime, s.duration/1000/s.runtime))
-    s.pc.barrier() # Wait for all hosts to get to this point
+            tstep = h.t # follow the real time
+
+
+## Run with a single psolve(), with the progress, weight saves and virtual arm called from the event queue, each on its own schedule (runmode 'events')
+def runEvents():
+    if s.PMdinput == 'Plexon': raise Exception('runmode "events" does not support the online Plexon input') # The time adjustment needs the loop
+    s.intervalevents = [] # FInitializeHandlers scheduling the events
+    addIntervalEvent(s.progupdate, printProgress)
+    if s.usestdp: addIntervalEvent(s.loopstep, saveWeights, loopSteps(s.timebetweensaves)) # Same times as in runLoop(); added before the arm, so at the same time it runs first, as in runLoop()
+    if s.useArm != 'None': addIntervalEvent(s.loopstep, runArm) # RL updates stay in the arm step: the critic comes from its error, and travels with the arm state
+    init() # Initialize the simulation, which schedules the first events
+    s.pc.psolve(s.duration)
+    s.intervalevents = []
+
+
+## Weight saves and virtual arm after each loopstep ms chunk of the run (runmode 'loop')
+def runStep(t):
+    if s.usestdp and t - s.timeoflastsave >= s.timebetweensaves: saveWeights(t) # Periodic weight saves
+    if s.useArm != 'None': runArm(t) # Virtual arm
+
+
+## Save the weights that changed since the last save
+def saveWeights(t):
+    s.timeoflastsave = t
+    #if s.rank == 0: print 'Recording weight changes at time ', t
+    logWeightChanges(s.timeoflastsave) # Only store connections that changed
+
+
+## Number of loopstep ms chunks after which runLoop() has reached interval ms since an event
+def loopSteps(interval):
+    return max(1, int(ceil(interval/float(s.loopstep) - 1e-9))) # Tolerance for intervals that are multiples of loopstep
+
+
+## Call func(t) at t = interval, (1+every)*interval, (1+2*every)*interval, ... up to the end of the run, from the event queue; the first event is scheduled by init().
+## Events at the same time run in the order they were added (the event queue is first in, first out for equal times)
+def addIntervalEvent(interval, func, every=1):
+    nextevent = [1] # number of the next event
+    def callback():
+        tevent = nextevent[0]*interval # nominal time, since h.t accumulates rounding errors
+        func(tevent)
+        nextevent[0] += every
+        if nextevent[0]*interval <= s.duration: h.cvode.event(nextevent[0]*interval, callback)
+    def schedule():
+        nextevent[0] = 1
+        if interval <= s.duration: h.cvode.event(interval, callback)
+    s.intervalevents.append(h.FInitializeHandler(schedule))
+
+
+## Print the progress of the run
+def printProgress(t):
+    if s.rank==0: print('  t = %0.1f s (%i%%; time consumed: %0.1f s)' % (t/1e3, int(t/s.duration*100), (time()-s.runstart)))
+
+
+## Run the virtual arm apparatus and apply the RL critic signal to the STDP mechanisms
+def runArm(t):
+    critic = s.arm.run(t, s) # run virtual arm apparatus (calculate command, move arm, feedback); returns the RL critic signal (0 if not time for RL)
+    if critic != 0 and len(s.stdpmechs) > 0: # if critic signal indicates punishment (-1) or reward (+1)
+        s.stdpmechs[0].reward_punish_all(float(critic)) # run stdp.mod method to update syn weights based on RL, for all STDP mechanisms on this node in one call
+    # Synaptic scaling?
 
 
 ###############################################################################
@@ -871,11 +1146,18 @@ def finalizeSim():
                 hostspiketimes = concatenate((hostspiketimes, thesespikes)) # Add spikes from this cell to the list
                 #hostspikecells = concatenate((hostspikecells, (c+host*s.cellsperhost)*ones(nthesespikes))) # Add this cell's ID to the list
                 hostspikecells = concatenate((hostspikecells, s.gidVec[c]*ones(nthesespikes))) # Add this cell's ID to the list
+            if s.savelfps: # Sum the recorded voltages of each LFP population
+                s.hostlfps = zeros((len(s.lfptimevec)-1, s.nlfps))
+                for pop in range(s.nlfps):
+                    for vec in s.lfpvecs[pop]: s.hostlfps[:,pop] += array(vec)[1:] # Add voltage to LFP estimate, without the sample at t = 0
+                if s.verbose:
+                    if isnan(s.hostlfps).any() or isinf(s.hostlfps).any():
+                        print "Nan or inf"
             if s.saveraw:
                 for c in range(len(s.rawrecordings)):
                     for q in range(len(s.rawrecordings[c])):
                         s.rawrecordings[c][q] = array(s.rawrecordings[c][q])
-            messageid=s.pc.pack([hostspiketimes, hostspikecells, s.hostlfps, s.conndata, s.stdpconndata, s.weightchanges, s.rawrecordings]) # Create a mesage ID and store this value
+            messageid=s.pc.pack([hostspiketimes, hostspikecells, s.hostlfps, s.conndata, s.stdpconndata, s.weightlog[:s.nweightlog], s.rawrecordings]) # Create a mesage ID and store this value
             s.pc.post(host,messageid) # Post this message
 
 
@@ -883,6 +1165,7 @@ def finalizeSim():
     if s.rank==0: # Only act on a single host
         s.allspikecells = array([])
         s.allspiketimes = array([])
+        if s.savelfps: s.lfptime = array(s.lfptimevec)[1:] # Times of the LFP samples, the same on all hosts; from lfpdt, as the LFP was sampled at the end of each loopstep
         s.lfps = zeros((len(s.lfptime),s.nlfps)) # Create an empty array for appending LFP data; first entry is for time
         s.allconnections = [array([]) for i in range(s.nconnpars)] # Store all connections
         s.allconnections[s.nconnpars-1] = zeros((0,s.nreceptors)) # Create an empty array for appending connections
@@ -898,16 +1181,20 @@ def finalizeSim():
             s.allspiketimes = concatenate((s.allspiketimes, hostdata[0])) # Add spikes from this cell to the list
             s.allspikecells = concatenate((s.allspikecells, hostdata[1])) # Add this cell's ID to the list
             if s.savelfps: s.lfps += array(hostdata[2]) # Sum LFP voltages
-            for pp in range(s.nconnpars): s.allconnections[pp] = concatenate((s.allconnections[pp], hostdata[3][pp])) # Append pre/post synapses
+            hostconndata = connectivity.unpackConnections(hostdata[3]) # Pre, post, distances, delays, weights
+            for pp in range(s.nconnpars): s.allconnections[pp] = concatenate((s.allconnections[pp], hostconndata[pp])) # Append pre/post synapses
             if s.usestdp and len(hostdata[4]): # Using STDP and at least one STDP connection
                 s.allstdpconndata = concatenate((s.allstdpconndata, hostdata[4])) # Add data on STDP connections
-                for ps in range(len(hostdata[4])): s.allweightchanges.append(hostdata[5][ps]) # "ps" stands for "plastic synapse"
+                offset = len(s.allweightchanges)
+                s.allweightchanges.extend([[] for ps in range(len(hostdata[4]))]) # One list of [time, weight] per plastic synapse; "ps" stands for "plastic synapse"
+                for ps, tsave, w in hostdata[5]: s.allweightchanges[offset+int(ps)].append([tsave, w])
             if s.saveraw:
                 for c in range(len(hostdata[6])): s.allraw.append(hostdata[6][c]) # Append cell-by-cell
 
         s.totalspikes = len(s.allspiketimes) # Keep a running tally of the number of spikes
         s.totalconnections = len(s.allconnections[0]) # Total number of connections
         s.totalstdpconns = len(s.allstdpconndata) # Total number of STDP connections
+        if s.placementcalib != '' and not os.path.exists(s.placementcalib): placement.saveCalibration() # Calibration run for placement
         
 
     # Record background spike data (cliff: only for one node since takes too long to pack for all and just needed for debugging)
@@ -1043,12 +1330,118 @@ def saveData():
             print('  Done; time = %0.1f s' % savetime)
 
 
+###############################################################################
+### Checkpoints
+###############################################################################
+
+## Save the state of the network at the end of a run, to be restored by loadCheckpoint() into a network built with the same parameters and number of hosts:
+## filestem_host<rank>.dat has the NEURON state (SaveState: cells, synapses, inputs, event queue and t), and filestem_host<rank>.pkl what SaveState does not
+## save (plastic weights, STDP timing, random number generators, virtual arm and trial state)
+def saveCheckpoint(filestem):
+    if s.rank==0: print('Saving checkpoint %s...' % filestem)
+    savestart = time()
+    state = h.SaveState()
+    state.save()
+    f = h.File('%s_host%i.dat' % (filestem, s.rank))
+    f.wopen()
+    state.fwrite(f)
+    f.close()
+
+    checkpoint = {'nhosts': s.nhosts, 'gids': list(s.gidVec), 't': h.t}
+    checkpoint['weights'] = [stdpWeight(ps) for ps in range(s.nstdpconns)]
+    checkpoint['stdpconndata'] = s.stdpconndata # Presynaptic cell ID, postsynaptic, and receptor of each weight, to load them with another number of hosts
+    checkpoint['stdp'] = [] # Timing state of each STDP adjuster
+    for stdpmech in s.stdpmechs:
+        if s.stdpvec:
+            vec = h.Vector()
+            stdpmech.getstate(vec)
+            checkpoint['stdp'].append(array(vec))
+        else: checkpoint['stdp'].append([stdpmech.tlastpre, stdpmech.tlastpost, stdpmech.tlasthebbelig, stdpmech.tlastantielig, stdpmech.interval])
+    checkpoint['rands'] = [rand.seq() for rand in s.backgroundrands + (s.stimrands if s.usestims else [])] # Sequence position of each random number generator
+    checkpoint['times'] = dict((var, getattr(s, var)) for var in ['timeoflastRL', 'timeoflastsave', 'timeoflastexplor', 'timeoflastreset', 'targetid'])
+    if s.useArm != 'None': checkpoint['arm'] = s.arm.getState()
+    with open('%s_host%i.pkl' % (filestem, s.rank), 'wb') as f:
+        pickle.dump(checkpoint, f)
+    s.pc.barrier()
+    if s.rank==0: print('  Done; time = %0.1f s' % (time()-savestart))
+
+
+## Restore a checkpoint saved by saveCheckpoint() into a freshly built network with the same parameters. The plastic weights are set now, which is all a new
+## run starting at t = 0 keeps from the saved network, and can be loaded with any number of hosts; with resume, the next run also restores the rest of the state
+## after init(), so that the run continues from the time of the checkpoint (s.duration is then the time at which it ends; runmode 'loop' and same number of hosts only)
+def loadCheckpoint(filestem, resume=False):
+    with open('%s_host%i.pkl' % (filestem, min(s.rank, checkpointHosts(filestem)-1)), 'rb') as f:
+        checkpoint = pickle.load(f)
+    if checkpoint['nhosts'] == s.nhosts:
+        if checkpoint['gids'] != list(s.gidVec) or len(checkpoint['weights']) != s.nstdpconns:
+            raise Exception('Checkpoint %s was saved from a different network' % filestem) # Cells, placement or plastic synapses don't match
+        weights = checkpoint['weights']
+    elif resume: raise Exception('Resuming from checkpoint %s needs the %i hosts it was saved with' % (filestem, checkpoint['nhosts'])) # SaveState is per host
+    elif not (idscPairedByIndex(checkpoint['nhosts']) and idscPairedByIndex(s.nhosts)): raise Exception('Checkpoint %s needs the %i hosts it was saved with: with roundrobin placement, the IDSC inputs depend on the number of hosts' % (filestem, checkpoint['nhosts']))
+    else: weights = checkpointWeights(filestem, checkpoint['nhosts'])
+    for ps, weight in enumerate(weights): setStdpWeight(ps, weight)
+    if resume:
+        if s.runmode != 'loop': raise Exception('Resuming from a checkpoint needs runmode "loop"') # Restoring the event queue would drop the events of runmode 'events'
+        s.checkpoint = (filestem, checkpoint) # Restored by runLoop()
+    if s.rank==0: print('  Restored checkpoint %s (t = %0.1f s)%s' % (filestem, checkpoint['t']/1e3, ' -- the state will be restored by the next run' if resume else ''))
+
+
+## Number of hosts a checkpoint was saved with
+def checkpointHosts(filestem):
+    with open('%s_host0.pkl' % filestem, 'rb') as f:
+        return pickle.load(f)['nhosts']
+
+
+## Whether each IDSC cell gets the presynaptic cells of the EDSC cell with the same index with this number of hosts. With roundrobin placement over all hosts,
+## makeConnections() pairs the EDSC and IDSC cells of each host in order, which only matches the indices if the populations start a multiple of nhosts apart
+def idscPairedByIndex(nhosts):
+    if s.colocatearm or s.placement != 'roundrobin' or (s.armhost and nhosts > 1): return True # Paired by index (same rule as makeConnections())
+    return (s.popGidStart[s.IDSC] - s.popGidStart[s.EDSC]) % nhosts == 0
+
+
+## Weights of the local plastic synapses from a checkpoint saved with another number of hosts, matched by presynaptic cell, postsynaptic cell and receptor (the
+## connections of each cell only depend on the placement through the IDSC inputs, checked by idscPairedByIndex(), and several synapses with the same ones are
+## in the same order)
+def checkpointWeights(filestem, nhosts):
+    savedweights = {} # key = (presynaptic cell ID, postsynaptic, receptor); value = weights of these synapses, in order
+    for host in range(nhosts):
+        with open('%s_host%i.pkl' % (filestem, host), 'rb') as f:
+            checkpoint = pickle.load(f)
+        for conn, weight in zip(checkpoint['stdpconndata'], checkpoint['weights']): savedweights.setdefault(tuple(int(x) for x in conn), []).append(weight)
+    weights = []
+    for conn in s.stdpconndata:
+        key = tuple(int(x) for x in conn)
+        if not savedweights.get(key): raise Exception('Checkpoint %s was saved from a different network' % filestem) # Plastic synapses don't match
+        weights.append(savedweights[key].pop(0))
+    return weights
+
+
+## Restore the state saved in the checkpoint loaded by loadCheckpoint(resume=True); called by runLoop() after init()
+def restoreCheckpoint():
+    filestem, checkpoint = s.checkpoint
+    s.checkpoint = None
+    state = h.SaveState()
+    f = h.File('%s_host%i.dat' % (filestem, s.rank))
+    f.ropen()
+    state.fread(f)
+    f.close()
+    state.restore() # Also sets t
+    for stdpmech, stdpstate in zip(s.stdpmechs, checkpoint['stdp']):
+        if s.stdpvec: stdpmech.setstate(h.Vector(stdpstate))
+        else: stdpmech.tlastpre, stdpmech.tlastpost, stdpmech.tlasthebbelig, stdpmech.tlastantielig, stdpmech.interval = stdpstate
+    for rand, seq in zip(s.backgroundrands + (s.stimrands if s.usestims else []), checkpoint['rands']): rand.seq(seq)
+    for var in checkpoint['times']: setattr(s, var, checkpoint['times'][var])
+    if s.useArm != 'None': s.arm.setState(checkpoint['arm'], h.t, s)
+
+
 ###############################################################################
 ### Plot data
 ###############################################################################
 def plotData():
     ## Plotting
     if s.rank == 0:
+        import analysis # Only import matplotlib when plotting
+        from pylab import show
         if s.plotraster: # Whether or not to plot
             if (s.totalspikes>s.maxspikestoplot): 
                 disp('  Too many spikes (%i vs. %i)' % (s.totalspikes, s.maxspikestoplot)) # Plot raster, but only if not too many spikes
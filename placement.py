@@ -0,0 +1,118 @@
+"""
+placement.py
+
+Functions to assign cells (gids) to hosts, used by network.createNetwork()
+
+Two placements are available, selected with s.placement:
+- 'roundrobin': gid c on host c % nhosts
+- 'lpt': estimate the cost of each cell (cell type, in-degree, plastic
+  inputs, input and output spike rates) and assign the most expensive
+  cells first, each to the least loaded host (longest processing time)
+
+With s.armhost, host 0 is reserved for the virtual arm and RL critic and
+no cells are placed on it (if there is more than one host). With
+s.colocatearm, the spinal cord (EDSC, IDSC) and proprioceptive (ASC) cells
+are all placed on host 0 with the virtual arm, and the other cells are
+distributed as above.
+
+Firing rates are taken from s.placementcalib if that file exists (it is
+written by a calibration run with the same file name), otherwise every
+cell is assumed to fire at s.placementrate.
+
+Usage example:
+    import placement
+    placement.placeCells() # sets s.gidhosts, s.cellcosts, s.hostloads
+    localgids = (s.gidhosts == s.rank).nonzero()[0]
+
+Version: 2016aug01
+"""
+
+from numpy import array, zeros, ones, arange, argsort, bincount, where, in1d, save, load
+import heapq
+import os
+import shared as s
+import connectivity
+
+
+###############################################################################
+### Cost model
+###############################################################################
+
+## Expected in-degree from each population (rows) onto one cell of each population (columns), including the hard-wired PMd and spinal cord inputs of createNetwork()
+def expectedInDegrees():
+    indegrees = zeros((s.npops, s.npops))
+    for prepop in range(s.npops):
+        for postpop in range(s.npops):
+            if s.connprobs[prepop,postpop] > 0: indegrees[prepop,postpop] = connectivity.pairDistanceTable(prepop, postpop)[0]
+    if s.PMdinput == 'Plexon': indegrees[s.PMd,s.ER5] = 1 # One PMd cell per ER5 cell
+    elif s.PMdinput == 'targetSplit': indegrees[s.PMd,s.ER5] += 1 # Plus one PMd cell per ER5 cell
+    indegrees[:,s.IDSC] = indegrees[:,s.EDSC] # IDSC cells copy the inputs of EDSC cells
+    indegrees[s.IDSC,s.EDSC] += s.popnumbers[s.IDSC]/float(s.nMuscles) # EDSC cells receive input from the IDSC cells of the antagonist muscle
+    return indegrees
+
+## Firing rate (Hz) of each cell, from the calibration file if available
+def firingRates():
+    if s.placementcalib != '' and os.path.exists(s.placementcalib):
+        rates = load(s.placementcalib)
+        if len(rates) == s.ncells: return rates
+        if s.rank==0: print('  Ignoring placement calibration %s (%i cells instead of %i)' % (s.placementcalib, len(rates), s.ncells))
+    return s.placementrate * ones(s.ncells)
+
+## Save the firing rate of each cell from the spikes gathered in finalizeSim(), for placement of later runs
+def saveCalibration():
+    rates = bincount(array(s.allspikecells, dtype='int'), minlength=s.ncells) / (s.duration/1e3)
+    save(s.placementcalib, rates)
+    print('  Saved firing rates for placement to %s' % s.placementcalib)
+
+## Estimated cost of simulating each cell (arbitrary units; an Izhikevich cell without inputs costs 1)
+def cellCosts():
+    indegrees = expectedInDegrees()
+    rates = firingRates()
+    poprates = array([rates[s.cellpops==pop].mean() if s.popnumbers[pop] else 0 for pop in range(s.npops)])
+    plastic = zeros((s.npops, s.npops)) # Whether each population pair is plastic
+    if s.usestdp:
+        for prepop, pstpop in s.plastConns: plastic[prepop, pstpop] = 1
+    inputrates = (indegrees * poprates[:,None]).sum(0) # Input spikes/s received by one cell of each population
+    plasticrates = (indegrees * plastic * poprates[:,None]).sum(0) # Input spikes/s received by the STDP adjusters of one cell of each population
+    costs = where(array(s.cellclasses) == -1, s.placementcosts['artificial'], s.placementcosts['izhi']) # NSLOC/VecStim vs. Izhikevich cells
+    costs += s.placementcosts['syn'] * indegrees.sum(0)[s.cellpops] # NetCons
+    costs += s.placementcosts['stdp'] * (indegrees * plastic).sum(0)[s.cellpops] # STDP adjusters
+    costs += s.placementcosts['event'] * (inputrates + plasticrates)[s.cellpops] # Delivered events
+    costs += s.placementcosts['spike'] * rates # Spikes sent
+    return costs
+
+
+###############################################################################
+### Placement
+###############################################################################
+
+## Host of each gid, assigning the most expensive cells first, each to the least loaded of the given hosts (the cells in armcells stay on host 0)
+def lptPlacement(costs, hosts, armcells):
+    gidhosts = zeros(s.ncells, dtype='int')
+    loads = [(costs[armcells].sum() if host == 0 else 0.0, host) for host in hosts] # Heap of (load, host)
+    for gid in argsort(-costs, kind='mergesort'): # Stable, so equal costs are assigned in gid order
+        if armcells[gid]: continue
+        load_, host = heapq.heappop(loads)
+        gidhosts[gid] = host
+        heapq.heappush(loads, (load_ + costs[gid], host))
+    return gidhosts
+
+## Assign every gid to a host according to s.placement, and report the estimated load imbalance
+def placeCells():
+    s.cellcosts = cellCosts()
+    s.cellhosts = arange(s.nhosts) # Hosts that simulate cells
+    if s.armhost and s.nhosts > 1: s.cellhosts = s.cellhosts[1:] # Host 0 only runs the virtual arm and RL critic
+    armcells = in1d(s.cellpops, [s.EDSC, s.IDSC, s.ASC]) if s.colocatearm else zeros(s.ncells, dtype='bool') # Cells placed on host 0 with the virtual arm
+    othergids = (~armcells).nonzero()[0]
+    roundrobin = s.cellhosts[arange(s.ncells) % len(s.cellhosts)]
+    if s.placement == 'roundrobin':
+        s.gidhosts = zeros(s.ncells, dtype='int')
+        s.gidhosts[othergids] = s.cellhosts[arange(len(othergids)) % len(s.cellhosts)]
+    elif s.placement == 'lpt': s.gidhosts = lptPlacement(s.cellcosts, s.cellhosts, armcells)
+    else: raise Exception('Undefined placement "%s"' % s.placement) # No match? Cause an error
+    s.hostloads = bincount(s.gidhosts, weights=s.cellcosts, minlength=s.nhosts) # Estimated load of each host
+    if s.rank==0:
+        loads = s.hostloads[s.hostloads > 0] # Hosts with cells
+        roundrobinloads = bincount(roundrobin, weights=s.cellcosts, minlength=s.nhosts)[s.cellhosts]
+        print('  Estimated load imbalance (max/mean over %i hosts): %0.3f with %s placement (round-robin: %0.3f)' % (len(loads), loads.max()/loads.mean(), s.placement, roundrobinloads.max()/roundrobinloads.mean()))
+        if s.colocatearm: print('  Spinal cord and proprioceptive cells on host 0: %i cells, estimated load %0.0f%% of mean' % (armcells.sum(), 100*s.hostloads[0]/loads.mean()))
@@ -11,14 +11,22 @@ Version: 2015feb12 by salvadord
 ### IMPORT MODULES
 ###############################################################################
 
-from pylab import array, inf, zeros, seed
+from time import time
+importtimes = [] # Time taken to import each group of modules, printed with the benchmark
+importstart = time()
+from numpy import array, inf, zeros, arange, repeat, cumsum
+from numpy.random import seed
+importtimes.append(('numpy', time()-importstart)); importstart = time()
 from neuron import h # Import NEURON
+importtimes.append(('NEURON', time()-importstart)); importstart = time()
 from izhi import RS, IB, CH, LTS, FS, TC, RTN # Import Izhikevich model
 from nsloc import nsloc # NetStim with location unit type
-import server # Server for plexon interface
-from time import time
+importtimes.append(('cell models', time()-importstart))
 from math import radians
+from socket import gethostname
 import hashlib
+import os
+import sys
 def id32(obj): return int(hashlib.md5(obj).hexdigest()[0:8],16)# hash(obj) & 0xffffffff # for random seeds (bitwise AND to retain only lower 32 bits)
 
 
@@ -26,6 +34,7 @@ def id32(obj): return int(hashlib.md5(obj).hexdigest()[0:8],16)# hash(obj) & 0xf
 pc = h.ParallelContext() # MPI: Initialize the ParallelContext class
 nhosts = int(pc.nhost()) # Find number of hosts
 rank = int(pc.id())     # rank 0 will be the master
+ismpi = nhosts > 1 or '-mpi' in sys.argv or 'OMPI_COMM_WORLD_SIZE' in os.environ or 'PMI_SIZE' in os.environ # Whether MPI is in use, which it can be with a single host too (nrniv -mpi, mpirun -np 1)
 
 if rank==0: 
     pc.gid_clear()
@@ -47,35 +56,26 @@ popyfrac =   [[-1,-1], [-1,-1], [-1,-1], [-1,-1], [0.1,0.31], [0.1,0.31], [0.1,0
 receptornames = ['AMPA', 'NMDA', 'GABAA', 'GABAB', 'opsin'] # Names of the different receptors
 npops = len(popnames) # Number of populations
 nreceptors = len(receptornames) # Number of receptors
-popGidStart = [] # gid starts for each popnames
-popGidEnd= [] # gid starts for each popnames
-popnumbers = []
 PMdinput = 'spikes' # 'Plexon', 'spikes', 'SSM', 'targetSplit'
+if PMdinput == 'Plexon': # Server for plexon interface -- only imported when used, since it starts a multiprocessing Manager process
+    importstart = time()
+    import server
+    importtimes.append(('server', time()-importstart))
+else: server = None
 
     
 # Define params for each cell: cellpops, cellnames, cellclasses, EorI 
-cellpops = [] # Store list of populations for each cell -- e.g. 1=ER2 vs. 2=IF2
-cellnames = [] # Store list of names for each cell -- e.g. 'ER2' vs. 'IF2'
-cellclasses = [] # Store list of classes types for each cell -- e.g. pyramidal vs. interneuron
-EorI = [] # Store list of excitatory/inhibitory for each cell
 popnumbers = scale*array(popratios) # Number of neurons in each population
 if PMdinput == 'Plexon' and 'PMd' in popnames:    
     popratios[popnames.index('PMd')] = server.numPMd
     popnumbers[popnames.index('PMd')] = server.numPMd # Number of PMds is fixed.
 ncells = int(sum(popnumbers))# Calculate the total number of cells 
-for c in range(len(popnames)):
-    start = sum(popnumbers[:c])
-    popGidStart.append(start)
-    popGidEnd.append(start + popnumbers[c] - 1)
-for pop in range(npops): # Loop over each population
-    for c in range(int(popnumbers[pop])): # Loop over each cell in that population
-        cellpops.append(pop) # Append this cell's population type to the list
-        cellnames.append(popnames[pop]) # Append this cell's population type to the list
-        cellclasses.append(popclasses[pop]) # Just use integers to index them
-        EorI.append(popEorI[pop]) # Append this cell's excitatory/inhibitory state to the list
-cellpops = array(cellpops) 
-cellnames = array(cellnames)
-EorI = array(EorI)
+popGidStart = list(cumsum(popnumbers) - popnumbers) # gid starts for each popnames
+popGidEnd = list(cumsum(popnumbers) - 1) # gid ends for each popnames
+cellpops = repeat(arange(npops), popnumbers) # Store list of populations for each cell -- e.g. 1=ER2 vs. 2=IF2
+cellnames = array(popnames)[cellpops] # Store list of names for each cell -- e.g. 'ER2' vs. 'IF2'
+cellclasses = array(popclasses)[cellpops] # Store list of classes types for each cell -- e.g. pyramidal vs. interneuron
+EorI = array(popEorI)[cellpops] # Store list of excitatory/inhibitory for each cell
 
 
 # Assign numbers to each of the different variables so they can be used in the other functions
@@ -86,10 +86,13 @@ for i,name in enumerate(receptornames): exec(name+'=i') # Set population names t
 allpops = array(range(npops)) # Create an array with all the population numbers
 Epops = allpops[array(popEorI)==0] # Pick out numbers corresponding to excitatory populations
 Ipops = allpops[array(popEorI)==1] # Pick out numbers corresponding to inhibitory populations
+cellartificial = (cellpops == PMd) | (cellpops == ASC) # Whether each cell is an artificial (NSLOC/VecStim) PMd or ASC cell, i.e. without Izhikevich dynamics or background input
 
 
 # for creating natural and artificial stimuli (need to import after init of population and receptor indices)
+importstart = time()
 from stimuli import touch, stimmod, makestim 
+importtimes.append(('stimuli', time()-importstart))
 
 
 PMdconnprob = 2.0
@@ -212,8 +215,9 @@ trainTime = 1*1e3 # duration of traininig phase, in ms
 testTime = 1*1e3 # duration of testing/evaluation phase, in ms
 duration = 1*1e3 # Duration of the simulation, in ms
 h.dt = 0.5 # Internal integration timestep to use
-loopstep = 10 # Step size in ms for simulation loop -- not coincidentally the step size for the LFP
+loopstep = 10 # Step size in ms for simulation loop -- by default also the sampling interval of the LFP (lfpdt)
 progupdate = 5000 # How frequently to update progress, in ms
+runmode = 'loop' # 'loop': run in chunks of loopstep ms from Python; 'events': single psolve(), with the progress, weight saves and arm called from the event queue at the same times as in 'loop'
 randseed = 1 # Random seed to use
 limitmemory = False # Whether or not to limit RAM usage
 
@@ -222,10 +226,17 @@ limitmemory = False # Whether or not to limit RAM usage
 ## Saving and plotting parameters
 outfilestem = '' # filestem to save fitness result
 savemat = True # Whether or not to write spikes etc. to a .mat file
+checkpointout = '' # Filestem to save a checkpoint of the network to after training (runTrainTest2targets*), so tests can be rerun without retraining ('' = don't save)
+checkpointin = '' # Filestem of a checkpoint to load the trained network from instead of training (runTrainTest2targets*) ('' = train)
+checkpoint = None # (filestem, data) of the checkpoint to continue from in the next run, set by network.loadCheckpoint(resume=True)
+forktests = False # Whether runTrainTest2targetsOptim runs the test of each target in its own forked copy of the trained process, at the same time (single process without MPI only)
+optimrun = False # Whether main.py runs runTrainTest2targetsOptim (evolutionary optimization, batch) instead of runTrainTest2targets
+testtargets = [0, 1] # Targets runTrainTest2targetsOptim tests: [] = train only (save the trained network with checkpointout); a single target = test it alone from checkpointin, in a job running at the same time as the job of the other target (e.g. with MPI), the last one to finish saving the fitness
 armMinimalSave = False # save only arm data and spikes (for target reaching evol opt)
 savetxt = False # save spikes and conn to txt file
 savelfps = False # Whether or not to save LFPs
 lfppops = [[ER2], [ER5], [EB5], [ER6]] # Populations for calculating the LFP from
+lfpdt = 0 # Sampling interval of the LFP (ms); any multiple of h.dt, or 0 to use loopstep
 savebackground = False # save background (NetStims) inputs
 saveraw = False # Whether or not to record raw voltages etc.
 verbose = 0 # Whether to write nothing (0), diagnostic information on events (1), or everything (2) a file directly from izhi.mod
@@ -250,6 +261,18 @@ receptorweight = [1, 1, 1, 1, 1] # Scale factors for each receptor
 scaleconnprob = 200/scale*array([[1, 1], [1, 1]]) # scale*1* Connection probabilities for EE, EI, IE, II synapses, respectively -- scale for scale since size fixed
 connfalloff = 100*array([2, 3]) # Connection length constants in um for E and I synapses, respectively
 toroidal = True # Whether or not to have toroidal topology
+connmethod = 'bernoulli' # Connection rule: 'bernoulli' (test each presynaptic candidate) or 'sampled' (draw the expected number of partners for each population pair; cost scales with number of connections)
+conncomparecells = 0 # Number of cells per population on which to compare in-degree statistics of the 'sampled' rule with the 'bernoulli' rule (0 = don't compare)
+connrandom = 'seeded' # Random numbers for the 'bernoulli' rule: 'seeded' (stream seeded per postsynaptic cell) or 'philox' (counter-based, one number per pre/post pair, same connections for any number of hosts or generation order)
+connspatialindex = False # Whether or not to use a (periodic if toroidal) KD-tree so only presynaptic candidates within a cutoff distance are visited
+connmincutoffprob = 1e-6 # Connection probability at the cutoff distance of the spatial index -- lower values give a looser cutoff (identical conndata if loose enough)
+conncompact = False # Whether to store connections as one structured array (int32 gids, float32 distance/delay/weight, uint8 receptor; a row per nonzero receptor) instead of 5 float64 arrays
+conncachedir = '' # Directory in which to save (and look up) cell positions and connections, keyed by a hash of the parameters that determine them ('' = don't cache)
+bulkconnect = True # Whether to create NetCons and STDP adjusters with a few calls to hoc procedures instead of one Python loop iteration per connection
+placement = 'roundrobin' # How to assign cells to hosts: 'roundrobin' (gid % nhosts) or 'lpt' (balance the estimated cost of each cell)
+placementcalib = '' # File with the firing rate of each cell used to estimate costs for placement -- written at the end of the run if it doesn't exist ('' = assume placementrate)
+placementrate = 10 # Firing rate (Hz) assumed for every cell without a placement calibration file
+placementcosts = {'izhi': 1.0, 'artificial': 0.1, 'syn': 0.002, 'stdp': 0.004, 'event': 0.01, 'spike': 0.01} # Relative costs of a cell, per input connection, per STDP adjuster, per input spike/s and per output spike/s
 if useconnprobdata == False: connprobs = array(connprobs>0,dtype='int') # Optionally cnvert from float data into binary yes/no
 if useconnweightdata == False: connweights = array(connweights>0,dtype='int') # Optionally convert from float data into binary yes/no
 
@@ -261,6 +284,7 @@ corticalthick = 1740
 
 ## STDP and RL parameters
 usestdp = True # Whether or not to use STDP
+stdpvec = False # Whether to use one STDPVEC adjuster per postsynaptic cell (stdpvec.mod) instead of one STDP adjuster per plastic synapse (stdp.mod) -- same learning rules
 useRL = True #True # Where or not to use RL
 plastConnsType = 5 # predefined sets of plastic connections (use with evol alg)
 plastConns = [[ASC,ER2], [EB5,EDSC], [ER2,ER5], [ER5,EB5]] # list of plastic connections
@@ -277,7 +301,8 @@ useRLsoft = 1 # Use soft thresholding
 maxweight = 8 # Maximum synaptic weight
 timebetweensaves = 5*1e3 # How many ms between saving weights(can't be smaller than loopstep)
 timeoflastsave = -inf # Never saved
-weightchanges = [] # to periodically store weigth changes
+weightlog = zeros((0,3)) # to periodically store weight changes: rows of (plastic synapse, time, weight), see network.logWeightChanges()
+nweightlog = 0 # Number of rows of weightlog in use
 
 
 ## Background input parameters
@@ -295,6 +320,9 @@ backgroundreceptor = NMDA # Which receptor to stimulate
 useArm =  'dummyArm' # what type of arm to use: 'randomOutput', 'dummyArm' (simple python arm), 'musculoskeletal' (C++ full arm model)
 animArm = False # shows arm animation
 graphsArm = False # shows graphs (arm trajectory etc) when finisheds
+armhost = False # Whether to reserve host 0 for the virtual arm and RL critic (no cells; with more than one host): the workers exchange motor command and arm state with it in a single allreduce per step, and see the arm state one step later
+colocatearm = False # Whether to place the spinal cord (EDSC, IDSC) and proprioceptive (ASC) cells on host 0 with the virtual arm, so that the motor command and proprioception need no communication and only the critic is broadcast (at RL updates)
+armDelay = 0 # steps by which the musculoskeletal arm feedback is delayed: 0 = wait for the arm every step; 1 = pipelined, the arm computes step k while the network runs step k+1
 targetid = 1 # initial target 
 minRLerror = 0.002 # minimum error change for RL (m)
 armLen = [0.4634 - 0.173, 0.7169 - 0.4634] # elbow - shoulder from MSM;radioulnar - elbow from MSM;  
@@ -367,13 +395,22 @@ stimpars = [stimmod(touch,name='LTP',sta=ltptimes[0],fin=ltptimes[1]), stimmod(t
 
 
 
-## Peform a mini-benchmarking test for future time estimates
+## Peform a mini-benchmarking test for future time estimates, or use the result cached for this machine
+benchmarkfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.benchmark-%s' % gethostname()) # File caching the benchmark result ('' = always run the benchmark)
 if rank==0:
-    print('Benchmarking...')
-    benchstart = time()
-    for i in range(int(1.36e6)): tmp=0 # Number selected to take 0.1 s on my machine
-    performance = 1/(10*(time() - benchstart))*100
+    if benchmarkfile != '' and os.path.exists(benchmarkfile):
+        print('Using cached benchmark %s...' % benchmarkfile)
+        performance = float(open(benchmarkfile).read())
+    else:
+        print('Benchmarking...')
+        benchstart = time()
+        for i in range(int(1.36e6)): tmp=0 # Number selected to take 0.1 s on my machine
+        performance = 1/(10*(time() - benchstart))*100
+        if benchmarkfile != '':
+            try: open(benchmarkfile, 'w').write('%r' % performance)
+            except IOError: pass # E.g. read-only directory; benchmark again next time
     print('  Running at %0.0f%% default speed (%0.0f%% total)' % (performance, performance*nhosts))
+    print('  Import times: %s' % ', '.join(['%s %0.2f s' % importtime for importtime in importtimes]))
 
 
 
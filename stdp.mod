@@ -29,6 +29,16 @@ stdpmech = h.STDP(0,sec=dummy) # Create the STDP mechanism
 presyn = h.NetCon(cells[0],stdpmech, threshold, delay, 1) # Feed presynaptic spikes to the STDP mechanism -- must have weight >0
 pstsyn = h.NetCon(cells[1],stdpmech, threshold, delay, -1) # Feed postsynaptic spikes to the STDP mechanism -- must have weight <0
 h.setpointer(singlesyn._ref_weight[0],'synweight',stdpmech) # Point the STDP mechanism to the connection weight
+stdpmech.reward_punish_all(1.0) # Reward all STDP mechanisms (same as calling reward_punish() of each one)
+
+reward_punish_all() only visits the instances in the eligible list: an instance
+is added when it is initialized or when one of its eligibility traces starts,
+and dropped once none of its traces can change the weight any more.
+
+Weights changed by adjustweight() are flagged as dirty; dirtyweights(ids, syns,
+weights) fills the Vectors with the id, synapse index (always 0) and weight of
+every instance whose weight changed since the previous call, and clears the
+flags, so periodic weight saves only read the changed weights.
 
 Version: 2013oct24 by cliffk
 
@@ -54,6 +64,7 @@ NEURON {
     RANGE deltaw : The calculated weight change.
     RANGE newweight : New calculated weight.
     RANGE skip : Flag to skip 2nd set of conditions
+    RANGE id : Index of this instance in the list used by reward_punish_all() (set by the constructor).
 }
 
 ASSIGNED {
@@ -65,6 +76,69 @@ ASSIGNED {
     interval    (ms)    
     deltaw
     newweight          
+    id
+}
+
+VERBATIM
+static Prop** stdpprops = (Prop**)0; /* all STDP instances, indexed by id, for reward_punish_all() */
+static int nstdpprops = 0;
+static int* stdpelig = (int*)0; /* ids of the instances whose eligibility traces may be active */
+static int nstdpelig = 0, sizestdpelig = 0;
+static char* stdpiselig = (char*)0; /* whether each id is in stdpelig */
+static int* stdpdirty = (int*)0; /* ids of the instances whose weight changed since the last dirtyweights() */
+static int nstdpdirty = 0, sizestdpdirty = 0;
+static char* stdpisdirty = (char*)0; /* whether each id is in stdpdirty */
+
+#ifndef NRN_VERSION_GTEQ_8_2_0
+typedef void IvocVect;
+extern IvocVect* vector_arg(int);
+extern double* vector_vec(IvocVect*);
+extern IvocVect* vector_resize(IvocVect*, int);
+#endif
+
+static void stdp_markeligible(int i) {
+    if (stdpiselig[i]) { return; }
+    if (nstdpelig == sizestdpelig) {
+        sizestdpelig = sizestdpelig ? 2*sizestdpelig : 1024;
+        stdpelig = (int*)realloc(stdpelig, sizestdpelig*sizeof(int));
+    }
+    stdpelig[nstdpelig++] = i;
+    stdpiselig[i] = 1;
+}
+
+static void stdp_markdirty(int i) {
+    if (stdpisdirty[i]) { return; }
+    if (nstdpdirty == sizestdpdirty) {
+        sizestdpdirty = sizestdpdirty ? 2*sizestdpdirty : 1024;
+        stdpdirty = (int*)realloc(stdpdirty, sizestdpdirty*sizeof(int));
+    }
+    stdpdirty[nstdpdirty++] = i;
+    stdpisdirty[i] = 1;
+}
+ENDVERBATIM
+
+CONSTRUCTOR {
+VERBATIM
+  { int i;
+    for (i = 0; i < nstdpprops; i++) { if (!stdpprops[i]) { break; } } /* Reuse a free slot */
+    if (i == nstdpprops) {
+        nstdpprops += 1;
+        stdpprops = (Prop**)realloc(stdpprops, nstdpprops*sizeof(Prop*));
+        stdpiselig = (char*)realloc(stdpiselig, nstdpprops*sizeof(char));
+        stdpiselig[i] = 0;
+        stdpisdirty = (char*)realloc(stdpisdirty, nstdpprops*sizeof(char));
+        stdpisdirty[i] = 0;
+    }
+    stdpprops[i] = _prop;
+    id = i;
+  }
+ENDVERBATIM
+}
+
+DESTRUCTOR {
+VERBATIM
+    stdpprops[(int)id] = (Prop*)0;
+ENDVERBATIM
 }
 
 INITIAL {
@@ -75,6 +149,7 @@ INITIAL {
     interval = 0
     deltaw = 0
     newweight = 0
+    markeligible() : The first reward after initialization visits every instance, since reward_punish() also clips the weight to [0, wmax]
 }
 
 PARAMETER {
@@ -131,7 +206,7 @@ NET_RECEIVE (w) {
                     if (verbose > 1) {printf("net_send(1,1)\n")}
                     net_send(1,1) : instead of updating weight directly, use net_send to check if simultaneous spike occurred (otherwise bug when using mpi)
                 }
-                if ((RLon == 1) && (-interval <= RLwindanti)) { tlastantielig = t } : If RL and anti-Hebbian eligibility traces are turned on, and the interval falls within the maximum window for eligibility, remember the eligibilty trace start at the current time.
+                if ((RLon == 1) && (-interval <= RLwindanti)) { tlastantielig = t  markeligible() } : If RL and anti-Hebbian eligibility traces are turned on, and the interval falls within the maximum window for eligibility, remember the eligibilty trace start at the current time.
             }
             tlastpre = t : Remember the current spike time for next NET_RECEIVE.  
         
@@ -144,7 +219,7 @@ NET_RECEIVE (w) {
                     net_send(1,-1) : instead of updating weight directly, use net_send to check if simultaneous spike occurred (otherwise bug when using mpi)
                 }
                 if ((RLon == 1) && (interval <= RLwindhebb)) { 
-                    tlasthebbelig = t} : If RL and Hebbian eligibility traces are turned on, and the interval falls within the maximum window for eligibility, remember the eligibilty trace start at the current time.
+                    tlasthebbelig = t  markeligible() } : If RL and Hebbian eligibility traces are turned on, and the interval falls within the maximum window for eligibility, remember the eligibilty trace start at the current time.
             }
             tlastpost = t : Remember the current spike time for next NET_RECEIVE.
         }
@@ -163,6 +238,35 @@ PROCEDURE reward_punish(reinf) {
     }
 }
 
+PROCEDURE reward_punish_all(reinf) { : Call reward_punish(reinf) of every STDP instance with a possibly active eligibility trace, so a global reward/punishment takes a single call
+VERBATIM
+  { int i, j;
+    for (j = 0; j < nstdpelig; ) {
+        i = stdpelig[j];
+        if (stdpprops[i]) {
+            _setdata(stdpprops[i]);
+            reward_punish(_threadargscomma_ _lreinf);
+            if (!expired(_threadargs_)) { j++; continue; }
+        }
+        stdpiselig[i] = 0; /* Destroyed or expired: drop it (swap with the last entry) */
+        stdpelig[j] = stdpelig[--nstdpelig];
+    }
+  }
+ENDVERBATIM
+}
+
+PROCEDURE markeligible() { : Add this instance to the list visited by reward_punish_all()
+VERBATIM
+    stdp_markeligible((int)id);
+ENDVERBATIM
+}
+
+FUNCTION expired() { : Whether neither eligibility trace can change the weight at this or any later reward (exponential traces never expire once started)
+    expired = 1
+    if ((tlasthebbelig >= 0.0) && ((useRLexp != 0) || (t - tlasthebbelig <= RLlenhebb))) { expired = 0 }
+    if ((tlastantielig >= 0.0) && ((useRLexp != 0) || (t - tlastantielig <= RLlenanti))) { expired = 0 }
+}
+
 FUNCTION hebbRL() {
     if ((RLon == 0) || (tlasthebbelig < 0.0)) { hebbRL = 0.0  } : If RL is turned off or eligibility has not occurred yet, return 0.0.
     else if (useRLexp == 0) { : If we are using a binary (i.e. square-wave) eligibility traces...
@@ -188,7 +292,41 @@ FUNCTION softthreshold(rawwc) {
 }
 
 PROCEDURE adjustweight(wc) {
+   LOCAL oldweight
+   oldweight = synweight
    synweight = synweight + wc : apply the synaptic modification, and then clip the weight if necessary to make sure it's between 0 and wmax.
    if (synweight > wmax) { synweight = wmax }
    if (synweight < 0) { synweight = 0 }
+   if (synweight != oldweight) { markdirty() } : Flag the weight for the next dirtyweights()
+}
+
+PROCEDURE markdirty() {
+VERBATIM
+    stdp_markdirty((int)id);
+ENDVERBATIM
+}
+
+: Fill Vectors $o1, $o2, $o3 with the id, synapse index (0) and current weight of every STDP instance whose weight changed since the last call, and clear the flags; returns the number of instances
+FUNCTION dirtyweights() {
+VERBATIM
+  { int i, j, n = 0;
+    IvocVect* vids = vector_arg(1);
+    IvocVect* vsyns = vector_arg(2);
+    IvocVect* vweights = vector_arg(3);
+    double *ids, *syns, *weights;
+    vector_resize(vids, nstdpdirty); vector_resize(vsyns, nstdpdirty); vector_resize(vweights, nstdpdirty);
+    ids = vector_vec(vids); syns = vector_vec(vsyns); weights = vector_vec(vweights);
+    for (j = 0; j < nstdpdirty; j++) {
+        i = stdpdirty[j];
+        stdpisdirty[i] = 0;
+        if (!stdpprops[i]) { continue; } /* Destroyed since it was flagged */
+        _setdata(stdpprops[i]);
+        ids[n] = i; syns[n] = 0; weights[n] = synweight;
+        n++;
+    }
+    nstdpdirty = 0;
+    vector_resize(vids, n); vector_resize(vsyns, n); vector_resize(vweights, n);
+    _ldirtyweights = n;
+  }
+ENDVERBATIM
 }
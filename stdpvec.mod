@@ -0,0 +1,501 @@
+COMMENT
+
+Vectorized STDP + RL weight adjuster mechanism
+
+Same Hebbian/anti-Hebbian, soft-thresholding and RL eligibility rules as
+stdp.mod, but a single instance per postsynaptic cell holds the state of all
+its plastic inputs (weight pointer, last pre- and post-synaptic spike times,
+eligibility times), so the number of point processes and of postsynaptic
+spike events scales with the number of cells rather than with the number of
+plastic synapses.
+
+Each plastic synapse is added with addsyn(), which returns its index. The
+NetCon feeding presynaptic spikes of that synapse must have weight = index
+(>= 0); a single NetCon feeding the postsynaptic spikes must have weight < 0.
+As in stdp.mod, weight updates happen 1 ms after the spike that causes them,
+including when the cell fires again within that 1 ms.
+
+As in stdp.mod, dirtyweights(ids, syns, weights) returns the instance id,
+synapse index and weight of every synapse whose weight changed since the
+previous call.
+
+Example Python usage:
+
+from neuron import h
+
+## Create cells
+dummy = h.Section() # Create a dummy section to put the point processes in
+ncells = 3
+cells = []
+for c in range(ncells): cells.append(h.IntFire4(0,sec=dummy)) # Create the cells
+
+## Create synapses onto cell 2
+threshold = 10 # Set voltage threshold
+delay = 1 # Set connection delay
+syns = [h.NetCon(cells[c],cells[2], threshold, delay, 0.5) for c in range(2)] # Create connections from cells 0 and 1
+stdpmech = h.STDPVEC(0,sec=dummy) # Create the STDP mechanism of cell 2
+presyns = []
+for c in range(2):
+    index = stdpmech.addsyn(syns[c]._ref_weight[0], 1.0, -1.0, 1.0, -1.0) # Weight pointer, hebbwt, antiwt, RLhebbwt, RLantiwt
+    presyns.append(h.NetCon(cells[c],stdpmech, threshold, delay, index)) # Feed presynaptic spikes to the STDP mechanism -- weight = synapse index
+pstsyn = h.NetCon(cells[2],stdpmech, threshold, delay, -1) # Feed postsynaptic spikes to the STDP mechanism -- must have weight <0
+
+Version: 2016aug01
+
+ENDCOMMENT
+
+NEURON {
+    POINT_PROCESS STDPVEC : Definition of mechanism
+    RANGE tauhebb, tauanti : LTP/LTD decay time constants (in ms) for the Hebbian (pre-before-post-synaptic spikes), and anti-Hebbian (post-before-pre-synaptic) cases.
+    RANGE RLwindhebb, RLwindanti : Maximum interval between pre- and post-synaptic events for an starting an eligibility trace.  There are separate ones for the Hebbian and anti-Hebbian events.
+    RANGE useRLexp : Use exponentially decaying eligibility traces?  If 0, then the eligibility traces are binary, turning on at the beginning and completely off after time has passed corresponding to RLlen.
+    RANGE RLlenhebb, RLlenanti : Length of the eligibility Hebbian and anti-Hebbian eligibility traces, or the decay time constants if the traces are decaying exponentials.
+    RANGE wmax : The maximum weight for the synapses.
+    RANGE softthresh : Flag turning on "soft thresholding" for the maximal adjustment parameters.
+    RANGE STDPon : Flag for turning STDP adjustment on / off.
+    RANGE RLon : Flag for turning RL adjustment on / off.
+    RANGE verbose : Flag for turning off prints of weight update events for debugging.
+    RANGE nsyn : Number of synapses added with addsyn().
+    RANGE id : Index of the synapse arrays of this instance (set by the constructor).
+}
+
+ASSIGNED {
+    nsyn
+    id
+}
+
+PARAMETER {
+    tauhebb  = 10  (ms)
+    tauanti  = 10  (ms)
+    RLwindhebb = 10 (ms)
+    RLwindanti = 10 (ms)
+    useRLexp = 0   : default to using binary eligibility traces
+    RLlenhebb = 100 (ms)
+    RLlenanti = 100 (ms)
+    wmax  = 15.0
+    softthresh = 0
+    STDPon = 1
+    RLon = 1
+    verbose = 0
+}
+
+VERBATIM
+#include <string.h>
+#ifndef NRN_VERSION_GTEQ_8_2_0
+extern double* hoc_pgetarg(int);
+typedef void IvocVect;
+extern IvocVect* vector_arg(int);
+extern double* vector_vec(IvocVect*);
+extern IvocVect* vector_resize(IvocVect*, int);
+extern int vector_capacity(IvocVect*);
+#endif
+
+/* State and learning rates of the plastic synapses of one STDPVEC instance */
+typedef struct {
+    Prop* prop; /* the STDPVEC instance, for reward_punish_all() */
+    int slot; /* index in stdpsynlists (the id of the instance) */
+    int n, size; /* number of synapses, allocated size of the arrays */
+    int isdirty; /* whether the instance is in stdpvecdirty */
+    int ndirty; /* number of synapses in dirtysyns */
+    int* dirtysyns; /* synapses whose weight changed since the last dirtyweights() */
+    char* dirty; /* whether each synapse is in dirtysyns */
+    double** synweight; /* pointers to the weights (in NetCon objects) to be adjusted */
+    double* tlastpre; /* remembered times for last pre- and post-synaptic spikes */
+    double* tlastpost;
+    double* tlasthebbelig; /* remembered times for Hebbian and anti-Hebbian eligibility traces */
+    double* tlastantielig;
+    double* interval; /* interval between the last spike and the previous spike of the other side */
+    int* hebbpending; /* number of pending Hebbian updates */
+    double* hebbdue; /* time of the earliest pending Hebbian update (-1 = none) */
+    int nlater, sizelater; /* number of pending Hebbian updates after the earliest one of their synapse, allocated size */
+    int* latersyn; /* synapse and time of each of them, in order of time for each synapse */
+    double* laterdue;
+    double* hebbwt; /* maximal adjustments (as in stdp.mod) */
+    double* antiwt;
+    double* RLhebbwt;
+    double* RLantiwt;
+} StdpSyns;
+
+static StdpSyns** stdpsynlists = (StdpSyns**)0; /* synapses of each instance, indexed by id */
+static int nstdpsynlists = 0;
+static int* stdpvecdirty = (int*)0; /* ids of the instances with synapses in their dirtysyns */
+static int nstdpvecdirty = 0, sizestdpvecdirty = 0;
+
+static double* stdpvec_grow(double* x, int size) { return (double*)realloc(x, size*sizeof(double)); }
+
+/* Scale a weight change by the distance of the weight to its bounds */
+static double stdpvec_softthreshold(double rawwc, double w, double maxw) {
+    if (rawwc >= 0) { return rawwc * (1.0 - w / maxw); } /* If the weight change is non-negative, scale by 1 - weight / wmax */
+    return rawwc * w / maxw; /* Otherwise (the weight change is negative), scale by weight / wmax */
+}
+
+/* Flag synapse i for the next dirtyweights() */
+static void stdpvec_markdirty(StdpSyns* sl, int i) {
+    if (sl->dirty[i]) { return; }
+    sl->dirty[i] = 1;
+    sl->dirtysyns[sl->ndirty++] = i;
+    if (sl->isdirty) { return; }
+    if (nstdpvecdirty == sizestdpvecdirty) {
+        sizestdpvecdirty = sizestdpvecdirty ? 2*sizestdpvecdirty : 1024;
+        stdpvecdirty = (int*)realloc(stdpvecdirty, sizestdpvecdirty*sizeof(int));
+    }
+    stdpvecdirty[nstdpvecdirty++] = sl->slot;
+    sl->isdirty = 1;
+}
+
+/* Apply a weight change to synapse i, and clip the weight to [0, wmax] */
+static void stdpvec_adjustweight(StdpSyns* sl, int i, double wc, double maxw) {
+    double* w = sl->synweight[i];
+    double oldw = *w;
+    *w = *w + wc;
+    if (*w > maxw) { *w = maxw; }
+    if (*w < 0) { *w = 0; }
+    if (*w != oldw) { stdpvec_markdirty(sl, i); }
+}
+
+/* Queue a Hebbian update of synapse i at time tdue */
+static void stdpvec_pushhebb(StdpSyns* sl, int i, double tdue) {
+    if (sl->hebbpending[i]++ == 0) { sl->hebbdue[i] = tdue; return; }
+    if (sl->nlater == sl->sizelater) { /* The cell fired again before the update of its previous spike */
+        sl->sizelater = sl->sizelater ? 2*sl->sizelater : 16;
+        sl->latersyn = (int*)realloc(sl->latersyn, sl->sizelater*sizeof(int));
+        sl->laterdue = stdpvec_grow(sl->laterdue, sl->sizelater);
+    }
+    sl->latersyn[sl->nlater] = i; sl->laterdue[sl->nlater] = tdue;
+    sl->nlater++;
+}
+
+/* Remove the earliest pending Hebbian update of synapse i */
+static void stdpvec_pophebb(StdpSyns* sl, int i) {
+    int j;
+    sl->hebbdue[i] = -1;
+    if (--sl->hebbpending[i] == 0) { return; }
+    for (j = 0; sl->latersyn[j] != i; j++) {}
+    sl->hebbdue[i] = sl->laterdue[j];
+    sl->nlater--;
+    memmove(sl->latersyn + j, sl->latersyn + j + 1, (sl->nlater - j)*sizeof(int)); /* Keep the order of the others */
+    memmove(sl->laterdue + j, sl->laterdue + j + 1, (sl->nlater - j)*sizeof(double));
+}
+
+/* Presynaptic spike on synapse i at time tspk; returns 1 if an anti-Hebbian update is due 1 ms later */
+static int stdpvec_pre(StdpSyns* sl, int i, double tspk, double stdpon, double rlon, double rlwind) {
+    int due = 0;
+    sl->interval[i] = sl->tlastpost[i] - tspk; /* Get the interval; interval is negative */
+    if ((sl->tlastpost[i] > -1) && (-sl->interval[i] > 1.0)) { /* If we had a post-synaptic spike and a non-zero interval... */
+        if (stdpon == 1) { due = 1; }
+        if ((rlon == 1) && (-sl->interval[i] <= rlwind)) { sl->tlastantielig[i] = tspk; } /* Remember the anti-Hebbian eligibility trace start */
+    }
+    sl->tlastpre[i] = tspk; /* Remember the current spike time */
+    return due;
+}
+
+/* Postsynaptic spike seen by synapse i at time tspk; returns 1 if a Hebbian update is due 1 ms later */
+static int stdpvec_post(StdpSyns* sl, int i, double tspk, double stdpon, double rlon, double rlwind) {
+    int due = 0;
+    sl->interval[i] = tspk - sl->tlastpre[i]; /* Get the interval; interval is positive */
+    if ((sl->tlastpre[i] > -1) && (sl->interval[i] > 1.0)) { /* If we had a pre-synaptic spike and a non-zero interval... */
+        if (stdpon == 1) { due = 1; stdpvec_pushhebb(sl, i, tspk + 1); }
+        if ((rlon == 1) && (sl->interval[i] <= rlwind)) { sl->tlasthebbelig[i] = tspk; } /* Remember the Hebbian eligibility trace start */
+    }
+    sl->tlastpost[i] = tspk; /* Remember the current spike time */
+    return due;
+}
+ENDVERBATIM
+
+CONSTRUCTOR {
+VERBATIM
+  { int i;
+    StdpSyns* sl = (StdpSyns*)calloc(1, sizeof(StdpSyns));
+    for (i = 0; i < nstdpsynlists; i++) { if (!stdpsynlists[i]) { break; } } /* Reuse a free slot */
+    if (i == nstdpsynlists) {
+        nstdpsynlists += 1;
+        stdpsynlists = (StdpSyns**)realloc(stdpsynlists, nstdpsynlists*sizeof(StdpSyns*));
+    }
+    sl->prop = _prop;
+    sl->slot = i;
+    stdpsynlists[i] = sl;
+    id = i;
+    nsyn = 0;
+  }
+ENDVERBATIM
+}
+
+DESTRUCTOR {
+VERBATIM
+  { StdpSyns* sl = stdpsynlists[(int)id];
+    free(sl->synweight); free(sl->tlastpre); free(sl->tlastpost); free(sl->tlasthebbelig); free(sl->tlastantielig);
+    free(sl->interval); free(sl->hebbpending); free(sl->hebbdue); free(sl->latersyn); free(sl->laterdue); free(sl->hebbwt); free(sl->antiwt); free(sl->RLhebbwt); free(sl->RLantiwt);
+    free(sl->dirtysyns); free(sl->dirty);
+    free(sl);
+    stdpsynlists[(int)id] = (StdpSyns*)0;
+  }
+ENDVERBATIM
+}
+
+INITIAL {
+VERBATIM
+  { int i;
+    StdpSyns* sl = stdpsynlists[(int)id];
+    for (i = 0; i < sl->n; i++) {
+        sl->tlastpre[i] = -1; /* no spike yet */
+        sl->tlastpost[i] = -1; /* no spike yet */
+        sl->tlasthebbelig[i] = -1; /* no eligibility yet */
+        sl->tlastantielig[i] = -1; /* no eligibility yet */
+        sl->interval[i] = 0;
+        sl->hebbpending[i] = 0; /* no pending update */
+        sl->hebbdue[i] = -1;
+    }
+    sl->nlater = 0;
+  }
+ENDVERBATIM
+}
+
+: Add a synapse -- arguments: pointer to the weight, hebbwt, antiwt, RLhebbwt, RLantiwt; returns the index of the synapse
+FUNCTION addsyn() {
+VERBATIM
+  { StdpSyns* sl = stdpsynlists[(int)id];
+    int i = sl->n;
+    if (sl->n == sl->size) {
+        sl->size = sl->size ? 2*sl->size : 16;
+        sl->synweight = (double**)realloc(sl->synweight, sl->size*sizeof(double*));
+        sl->tlastpre = stdpvec_grow(sl->tlastpre, sl->size);
+        sl->tlastpost = stdpvec_grow(sl->tlastpost, sl->size);
+        sl->tlasthebbelig = stdpvec_grow(sl->tlasthebbelig, sl->size);
+        sl->tlastantielig = stdpvec_grow(sl->tlastantielig, sl->size);
+        sl->interval = stdpvec_grow(sl->interval, sl->size);
+        sl->hebbpending = (int*)realloc(sl->hebbpending, sl->size*sizeof(int));
+        sl->hebbdue = stdpvec_grow(sl->hebbdue, sl->size);
+        sl->hebbwt = stdpvec_grow(sl->hebbwt, sl->size);
+        sl->antiwt = stdpvec_grow(sl->antiwt, sl->size);
+        sl->RLhebbwt = stdpvec_grow(sl->RLhebbwt, sl->size);
+        sl->RLantiwt = stdpvec_grow(sl->RLantiwt, sl->size);
+        sl->dirtysyns = (int*)realloc(sl->dirtysyns, sl->size*sizeof(int));
+        sl->dirty = (char*)realloc(sl->dirty, sl->size*sizeof(char));
+    }
+    sl->synweight[i] = hoc_pgetarg(1);
+    sl->hebbwt[i] = *getarg(2);
+    sl->antiwt[i] = *getarg(3);
+    sl->RLhebbwt[i] = *getarg(4);
+    sl->RLantiwt[i] = *getarg(5);
+    sl->tlastpre[i] = -1;
+    sl->tlastpost[i] = -1;
+    sl->tlasthebbelig[i] = -1;
+    sl->tlastantielig[i] = -1;
+    sl->interval[i] = 0;
+    sl->hebbpending[i] = 0;
+    sl->hebbdue[i] = -1;
+    sl->dirty[i] = 0;
+    sl->n += 1;
+    nsyn = sl->n;
+    _laddsyn = i;
+  }
+ENDVERBATIM
+}
+
+NET_RECEIVE (w) {
+    : Hebbian weight updates happen 1ms later to check for simultaneous spikes (otherwise bug when using mpi)
+    if (flag == -1) {
+        if (hebbupdates() == 1) { net_send(1,-1) }
+    }
+
+    : Anti-hebbian weight update of synapse w happens 1ms later to check for simultaneous spikes (otherwise bug when using mpi)
+    else if (flag == 1) {
+        if (antiupdate(w) == 1) { net_send(1,1) }
+    }
+
+    : If we receive a non-negative weight value, we are receiving a pre-synaptic spike on synapse w (and thus need to check for an anti-Hebbian event, since the post-synaptic spike must be earlier).
+    else if (w >= 0) {
+        if (prespike(w) == 1) { net_send(1,1) }
+
+    : Else, if we receive a negative weight value, we are receiving a post-synaptic spike (and thus need to check for Hebbian events on all synapses, since the pre-synaptic spikes must be earlier).
+    } else {
+        if (postspike() == 1) { net_send(1,-1) }
+    }
+}
+
+: Presynaptic spike on synapse i; returns 1 if an anti-Hebbian update is due
+FUNCTION prespike(i) {
+VERBATIM
+    _lprespike = stdpvec_pre(stdpsynlists[(int)id], (int)_li, t, STDPon, RLon, RLwindanti);
+    if (verbose > 1 && _lprespike) { printf("net_send(1,1)\n"); }
+ENDVERBATIM
+}
+
+: Postsynaptic spike on all synapses; returns 1 if any Hebbian update is due
+FUNCTION postspike() {
+VERBATIM
+  { int i;
+    StdpSyns* sl = stdpsynlists[(int)id];
+    _lpostspike = 0;
+    for (i = 0; i < sl->n; i++) {
+        if (stdpvec_post(sl, i, t, STDPon, RLon, RLwindhebb)) { _lpostspike = 1; }
+    }
+    if (verbose > 1 && _lpostspike) { printf("net_send(1,-1)\n"); }
+  }
+ENDVERBATIM
+}
+
+: Pending Hebbian updates; returns 1 if any new Hebbian update is due
+FUNCTION hebbupdates() {
+VERBATIM
+  { int i;
+    double deltaw;
+    StdpSyns* sl = stdpsynlists[(int)id];
+    _lhebbupdates = 0;
+    for (i = 0; i < sl->n; i++) {
+        if (sl->hebbpending[i] == 0 || sl->hebbdue[i] != t) { continue; }
+        stdpvec_pophebb(sl, i); /* As in stdp.mod, the update uses the current interval */
+        if (sl->tlastpre[i] != t-1) {
+            deltaw = sl->hebbwt[i] * exp(-sl->interval[i] / tauhebb); /* Use the Hebbian decay to set the Hebbian weight adjustment */
+            if (softthresh == 1) { deltaw = stdpvec_softthreshold(deltaw, *sl->synweight[i], wmax); } /* If we have soft-thresholding on, apply it */
+            stdpvec_adjustweight(sl, i, deltaw, wmax);
+            if (verbose > 1) { printf("Hebbian STDP event: t = %f ms; tlastpre = %f; synapse = %d; deltaw = %f\n",t,sl->tlastpre[i],i,deltaw); }
+        } else { /* As in stdp.mod, the update event is then handled as a postsynaptic spike */
+            if (stdpvec_post(sl, i, t, STDPon, RLon, RLwindhebb)) { _lhebbupdates = 1; }
+        }
+    }
+  }
+ENDVERBATIM
+}
+
+: Anti-Hebbian update of synapse i; returns 1 if a new anti-Hebbian update is due
+FUNCTION antiupdate(i) {
+VERBATIM
+  { double deltaw;
+    int i = (int)_li;
+    StdpSyns* sl = stdpsynlists[(int)id];
+    _lantiupdate = 0;
+    if (sl->tlastpost[i] != t-1) {
+        deltaw = sl->antiwt[i] * exp(sl->interval[i] / tauanti); /* Use the anti-Hebbian decay to set the anti-Hebbian weight adjustment */
+        if (softthresh == 1) { deltaw = stdpvec_softthreshold(deltaw, *sl->synweight[i], wmax); } /* If we have soft-thresholding on, apply it */
+        stdpvec_adjustweight(sl, i, deltaw, wmax);
+        if (verbose > 1) { printf("anti-Hebbian STDP event: t = %f ms; synapse = %d; deltaw = %f\n",t,i,deltaw); }
+    } else { /* As in stdp.mod, the update event is then handled as a presynaptic spike */
+        _lantiupdate = stdpvec_pre(sl, i, t, STDPon, RLon, RLwindanti);
+    }
+  }
+ENDVERBATIM
+}
+
+: Apply the reward (reinf > 0) or punishment (reinf < 0) to all synapses according to their eligibility traces
+PROCEDURE reward_punish(reinf) {
+VERBATIM
+  { int i;
+    double deltaw, hebbRL, antiRL;
+    StdpSyns* sl = stdpsynlists[(int)id];
+    if (RLon == 1) { /* If RL is turned on... */
+        for (i = 0; i < sl->n; i++) {
+            hebbRL = 0.0; /* If eligibility has not occurred yet, 0.0 */
+            if (sl->tlasthebbelig[i] >= 0.0) {
+                if (useRLexp == 0) { hebbRL = (t - sl->tlasthebbelig[i] <= RLlenhebb) ? sl->RLhebbwt[i] : 0.0; } /* Binary (i.e. square-wave) eligibility trace */
+                else { hebbRL = sl->RLhebbwt[i] * exp((sl->tlasthebbelig[i] - t) / RLlenhebb); } /* Exponentially decaying eligibility trace */
+            }
+            antiRL = 0.0;
+            if (sl->tlastantielig[i] >= 0.0) {
+                if (useRLexp == 0) { antiRL = (t - sl->tlastantielig[i] <= RLlenanti) ? sl->RLantiwt[i] : 0.0; }
+                else { antiRL = sl->RLantiwt[i] * exp((sl->tlastantielig[i] - t) / RLlenanti); }
+            }
+            deltaw = 0.0; /* Start the weight change as being 0 */
+            deltaw = deltaw + _lreinf * hebbRL; /* Add the effect of the Hebbian eligibility trace */
+            deltaw = deltaw + _lreinf * antiRL; /* Add the effect of the anti-Hebbian eligibility trace */
+            if (softthresh == 1) { deltaw = stdpvec_softthreshold(deltaw, *sl->synweight[i], wmax); } /* If we have soft-thresholding on, apply it */
+            stdpvec_adjustweight(sl, i, deltaw, wmax);
+            if (verbose > 0) { printf("RL event: t = %f ms; reinf = %f; synapse = %d; tlasthebbelig = %f; deltaw = %f\n",t,_lreinf,i,sl->tlasthebbelig[i],deltaw); }
+        }
+    }
+  }
+ENDVERBATIM
+}
+
+: Call reward_punish(reinf) of every STDPVEC instance, so a global reward/punishment takes a single call
+PROCEDURE reward_punish_all(reinf) {
+VERBATIM
+  { int i;
+    for (i = 0; i < nstdpsynlists; i++) {
+        if (!stdpsynlists[i]) { continue; }
+        _setdata(stdpsynlists[i]->prop);
+        reward_punish(_threadargscomma_ _lreinf);
+    }
+  }
+ENDVERBATIM
+}
+
+: Fill Vectors $o1, $o2, $o3 with the instance id, synapse index and current weight of every synapse (of all STDPVEC instances) whose weight changed since the last call, and clear the flags; returns the number of synapses
+FUNCTION dirtyweights() {
+VERBATIM
+  { int i, j, k, n = 0;
+    StdpSyns* sl;
+    IvocVect* vids = vector_arg(1);
+    IvocVect* vsyns = vector_arg(2);
+    IvocVect* vweights = vector_arg(3);
+    double *ids, *syns, *weights;
+    for (j = 0; j < nstdpvecdirty; j++) { /* Count the dirty synapses (an upper bound if an instance is listed twice) */
+        sl = stdpsynlists[stdpvecdirty[j]];
+        if (sl && sl->isdirty) { n += sl->ndirty; }
+    }
+    vector_resize(vids, n); vector_resize(vsyns, n); vector_resize(vweights, n);
+    ids = vector_vec(vids); syns = vector_vec(vsyns); weights = vector_vec(vweights);
+    n = 0;
+    for (j = 0; j < nstdpvecdirty; j++) {
+        sl = stdpsynlists[stdpvecdirty[j]];
+        if (!sl || !sl->isdirty) { continue; } /* Destroyed since it was flagged, or listed twice after its slot was reused */
+        for (k = 0; k < sl->ndirty; k++) {
+            i = sl->dirtysyns[k];
+            sl->dirty[i] = 0;
+            ids[n] = sl->slot; syns[n] = i; weights[n] = *sl->synweight[i];
+            n++;
+        }
+        sl->ndirty = 0;
+        sl->isdirty = 0;
+    }
+    nstdpvecdirty = 0;
+    vector_resize(vids, n); vector_resize(vsyns, n); vector_resize(vweights, n);
+    _ldirtyweights = n;
+  }
+ENDVERBATIM
+}
+
+: Fill Vector $o1 with the timing state of the synapses (tlastpre, tlastpost, tlasthebbelig, tlastantielig, interval, hebbpending and hebbdue of each one, then the synapse and time of each later pending Hebbian update), for checkpoints; returns the number of synapses
+FUNCTION getstate() {
+VERBATIM
+  { int i;
+    StdpSyns* sl = stdpsynlists[(int)id];
+    IvocVect* vstate = vector_arg(1);
+    double* x;
+    vector_resize(vstate, 7*sl->n + 2*sl->nlater);
+    x = vector_vec(vstate);
+    for (i = 0; i < sl->n; i++) {
+        x[7*i] = sl->tlastpre[i]; x[7*i+1] = sl->tlastpost[i];
+        x[7*i+2] = sl->tlasthebbelig[i]; x[7*i+3] = sl->tlastantielig[i];
+        x[7*i+4] = sl->interval[i]; x[7*i+5] = sl->hebbpending[i]; x[7*i+6] = sl->hebbdue[i];
+    }
+    x += 7*sl->n;
+    for (i = 0; i < sl->nlater; i++) { x[2*i] = sl->latersyn[i]; x[2*i+1] = sl->laterdue[i]; }
+    _lgetstate = sl->n;
+  }
+ENDVERBATIM
+}
+
+: Set the timing state of the synapses from Vector $o1, filled by getstate() of the same instance in an identical network
+PROCEDURE setstate() {
+VERBATIM
+  { int i, nlater = 0;
+    StdpSyns* sl = stdpsynlists[(int)id];
+    IvocVect* vstate = vector_arg(1);
+    double* x = vector_vec(vstate);
+    for (i = 0; i < sl->n && 7*i+5 < vector_capacity(vstate); i++) { if (x[7*i+5] > 1) { nlater += (int)x[7*i+5] - 1; } }
+    if (vector_capacity(vstate) != 7*sl->n + 2*nlater) { hoc_execerror("STDPVEC setstate:", "the state is from an instance with a different number of synapses"); }
+    for (i = 0; i < sl->n; i++) {
+        sl->tlastpre[i] = x[7*i]; sl->tlastpost[i] = x[7*i+1];
+        sl->tlasthebbelig[i] = x[7*i+2]; sl->tlastantielig[i] = x[7*i+3];
+        sl->interval[i] = x[7*i+4]; sl->hebbpending[i] = (int)x[7*i+5]; sl->hebbdue[i] = x[7*i+6];
+    }
+    x += 7*sl->n;
+    sl->nlater = 0;
+    for (i = 0; i < nlater; i++) {
+        sl->hebbpending[(int)x[2*i]]--; /* Counted again by stdpvec_pushhebb() */
+        stdpvec_pushhebb(sl, (int)x[2*i], x[2*i+1]);
+    }
+  }
+ENDVERBATIM
+}
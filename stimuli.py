@@ -6,7 +6,8 @@ and defines functions to generate the stimuli
 
 """
 
-from pylab import array, rand, exp, zeros, hstack
+from numpy import array, exp, zeros, hstack
+from numpy.random import rand
 import shared as s # Import population and connection data
 
 #PMd, ASC, DSC, ER2, IF2, IL2, ER5, EB5, IF5, IL5, ER6, IF6, IL6, AMPA, NMDA, GABAA, GABAB, opsin, Epops, Ipops, allpops = cpd.names2inds() # Define populations
@@ -61,7 +62,7 @@ def stimmod(stimclass, name=None, receptor=None, isi=None, var=None, width=None,
 
 ## Define stimulus-making code
 def makestim(isi=1, variation=0, width=0.05, weight=10, start=0, finish=1, stimshape='gaussian'):
-    from pylab import r_, convolve, shape
+    from numpy import r_, convolve, shape
     
     # Create event times
     timeres = 0.005 # Time resolution = 5 ms = 200 Hz